@@ -12,6 +12,7 @@ import urllib2
 import httplib
 import shutil
 import socket
+import threading
 if os.name != 'nt':
     import fcntl
 from time import time, sleep
@@ -132,6 +133,101 @@ def http_call(method, url, body='', headers={}):
     
     
 
+class ConnectionPool(object):
+    """ Keeps idle HTTP connections per (host, port) so that repeated calls to
+    the same device reuse a socket instead of connecting every time.
+    """
+
+    def __init__(self, max_idle=2):
+        """ Constructor for the ConnectionPool class.
+
+        @param max_idle: max idle connections kept per (host, port)
+        @type max_idle: integer
+        """
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port):
+        """ Returns an idle connection to host:port or a new one.
+
+        @rtype: httplib.HTTPConnection
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((host, port))
+            if idle:
+                return idle.pop()
+        finally:
+            self._lock.release()
+        return httplib.HTTPConnection(host, port)
+
+    def put(self, host, port, con, response=None):
+        """ Gives a connection back to the pool. It is closed instead if the
+        response asked for it or the pool is full.
+        """
+        if response is not None and response.will_close:
+            con.close()
+            return
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((host, port), [])
+            if len(idle) < self.max_idle:
+                idle.append(con)
+                return
+        finally:
+            self._lock.release()
+        con.close()
+
+    def call(self, method, url, body='', headers={}):
+        """ Performs a HTTP call on a pooled connection and returns the
+        HTTPResponse with its body already read (available as
+        response.data). A failed reused connection is retried once on a new
+        one.
+
+        @param method: HTTP method (SUBSCRIBE, NOTIFY, etc...)
+        @param url: receiver URL
+        @param body: body of the message
+        @param headers: additional headers
+
+        @type method: string
+        @type url: string
+        @type body: string
+        @type headers: dictionary
+        """
+        parsed_url = urlparse(url)
+        host, port = parsed_url.hostname, parsed_url.port or 80
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+
+        for attempt in range(2):
+            con = self.get(host, port)
+            try:
+                con.request(method, path, body=body, headers=headers)
+                response = con.getresponse()
+                response.data = response.read()
+            except (httplib.HTTPException, socket.error):
+                con.close()
+                if attempt:
+                    raise
+                continue
+            self.put(host, port, con, response)
+            return response
+
+    def close(self):
+        """ Closes all idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for cons in idle.values():
+            for con in cons:
+                con.close()
+
+
 def url_fetch(url, filename='', attempts=0, interval=0, silent=False):
     """ Fetches an URL into a file or returns a file descriptor. If attempts
     and interval are not specified, they get their values from
@@ -237,6 +333,22 @@ def parse_xml(data):
     return ElementTree.ElementTree(p.close())
 
 
+_header_line_re = re.compile(r'^([^:\r\n]+):[ \t]?([^\r\n]*)', re.M)
+
+
+def parse_http_headers(header):
+    """ Parses the header block of a HTTP message (without the first line)
+    into a dictionary with lowercased keys.
+
+    @param header: raw header lines separated by CRLF
+    @type header: string
+
+    @return: headers
+    @rtype: dictionary
+    """
+    return dict([(k.lower(), v) for k, v in _header_line_re.findall(header)])
+
+
 def parse_http_response(data):
     """ Parses HTTP response data into a tuple in the form (cmd, headers).
 
@@ -249,13 +361,10 @@ def parse_http_response(data):
     
 #    print "data: " + str(data)
     
-    header, payload = data.split('\r\n\r\n')
-    lines = header.split('\r\n')
-    cmd = lines[0].split(' ')
-    lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
-    lines = filter(lambda x: len(x) > 0, lines)
-    headers = [x.split(':', 1) for x in lines]
-    headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+    header, payload = data.split('\r\n\r\n', 1)
+    first, sep, rest = header.partition('\r\n')
+    cmd = first.split(' ')
+    headers = parse_http_headers(rest)
 
     return cmd, headers
 
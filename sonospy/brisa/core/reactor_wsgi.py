@@ -0,0 +1,786 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php or see LICENSE file.
+# Copyright 2007-2008 Brisa Team <brisa-develop@garage.maemo.org>
+
+""" Non-blocking WSGI server driven by the brisa reactor.
+
+Connections are accepted, read and written on the reactor thread with
+non-blocking sockets, so idle and keep-alive connections do not hold a
+thread. The WSGI application is called from bounded worker pools - SOAP
+actions (POST) on a pool of their own, so that Search/Browse requests never
+queue behind other requests. Response bodies are written as the socket
+becomes writable: file bodies are read on the reactor thread, other
+iterables are advanced one chunk at a time on a stream pool, so a slow
+client or a slow source only holds a thread while a chunk is produced.
+"""
+
+__all__ = ('ReactorWSGIServer', 'WorkerPool')
+
+import re
+import sys
+import errno
+import socket
+import rfc822
+import threading
+
+from time import time
+from urllib import unquote
+from urlparse import urlparse
+from StringIO import StringIO
+from Queue import Queue, Full, Empty
+
+from brisa.core import log, reactor
+from brisa.core.ireactor import EVENT_TYPE_READ, EVENT_TYPE_WRITE
+
+log = log.getLogger('core.reactor-wsgi')
+
+quoted_slash = re.compile("(?i)%2F")
+
+comma_separated_headers = ['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
+    'ACCEPT-LANGUAGE', 'ACCEPT-RANGES', 'ALLOW', 'CACHE-CONTROL',
+    'CONNECTION', 'CONTENT-ENCODING', 'CONTENT-LANGUAGE', 'EXPECT',
+    'IF-MATCH', 'IF-NONE-MATCH', 'PRAGMA', 'PROXY-AUTHENTICATE', 'TE',
+    'TRAILER', 'TRANSFER-ENCODING', 'UPGRADE', 'VARY', 'VIA', 'WARNING',
+    'WWW-AUTHENTICATE']
+
+nonblocking_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 10 * 1024 * 1024
+READ_SIZE = 65536
+CHUNK_SIZE = 65536
+
+READING, HANDLING, WRITING, CLOSED = range(4)
+
+status_messages = {400: 'Bad Request',
+                   413: 'Request Entity Too Large',
+                   500: 'Internal Server Error',
+                   501: 'Not Implemented',
+                   503: 'Service Unavailable',
+                   505: 'HTTP Version Not Supported'}
+
+
+def wakeup_pair():
+    """ Returns a pair of connected sockets (reader, writer) used to wake up
+    the reactor from other threads. Built over the loopback interface where
+    socketpair() is not available.
+
+    @rtype: tuple
+    """
+    if hasattr(socket, 'socketpair'):
+        r, w = socket.socketpair()
+    else:
+        l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        l.bind(('127.0.0.1', 0))
+        l.listen(1)
+        w = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        w.connect(l.getsockname())
+        r, addr = l.accept()
+        l.close()
+    r.setblocking(0)
+    w.setblocking(0)
+    return r, w
+
+
+def decode_chunked(data):
+    """ Decodes a chunked request body. Returns (body, length consumed), or
+    None if data does not hold the whole body yet.
+
+    @param data: data received after the request headers
+    @type data: string
+
+    @rtype: tuple
+    """
+    body = []
+    pos = 0
+    while True:
+        eol = data.find('\r\n', pos)
+        if eol < 0:
+            return None
+        size = int(data[pos:eol].split(';', 1)[0].strip(), 16)
+        pos = eol + 2
+        if size == 0:
+            break
+        if len(data) < pos + size + 2:
+            return None
+        body.append(data[pos:pos + size])
+        pos += size + 2
+    # Trailer headers are ignored
+    end = data.find('\r\n', pos)
+    while end > pos:
+        pos = end + 2
+        end = data.find('\r\n', pos)
+    if end < 0:
+        return None
+    return ''.join(body), end + 2
+
+
+class WorkerPool(object):
+    """ Bounded pool of threads running jobs for the server.
+    """
+
+    def __init__(self, name, workers, max_pending=0):
+        """ Constructor for the WorkerPool class.
+
+        @param name: name of the pool threads
+        @param workers: number of threads
+        @param max_pending: maximum number of jobs waiting for a thread, 0
+                            for no limit
+
+        @type name: string
+        @type workers: integer
+        @type max_pending: integer
+        """
+        self.name = name
+        self.workers = workers
+        self._jobs = Queue(max_pending)
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run,
+                                 name='%s-%d' % (self.name, i))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        for t in self._threads:
+            # Unblocks the worker even if the pool is full
+            self._jobs.queue.append(None)
+            self._jobs.not_empty.acquire()
+            self._jobs.not_empty.notify()
+            self._jobs.not_empty.release()
+        self._threads = []
+
+    def pending(self):
+        return self._jobs.qsize()
+
+    def submit(self, function, args, callback):
+        """ Queues function(*args). callback is called on the worker thread
+        with (result, exc_info), where exc_info is None on success.
+
+        @return: False if the pool is full
+        @rtype: bool
+        """
+        try:
+            self._jobs.put_nowait((function, args, callback))
+            return True
+        except Full:
+            return False
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            function, args, callback = job
+            try:
+                result = function(*args)
+                error = None
+            except:
+                result = None
+                error = sys.exc_info()
+            try:
+                callback(result, error)
+            except Exception, e:
+                log.error('Error on %s callback: %s', self.name, e)
+
+
+class ReactorWSGIServer(object):
+    """ WSGI server on the brisa reactor. See the module documentation.
+    """
+    version = 'BRisa Reactor WSGI Server'
+
+    def __init__(self, bind_addr, wsgi_app, server_name=None, workers=4,
+                 action_workers=4, max_pending=32, timeout=60,
+                 max_connections=512):
+        """ Constructor for the ReactorWSGIServer class.
+
+        @param bind_addr: (host, port) to listen on
+        @param wsgi_app: WSGI application
+        @param server_name: SERVER_NAME of the requests
+        @param workers: threads calling the application for requests other
+                        than POST, and producing body chunks
+        @param action_workers: threads calling the application for POST
+                               requests (SOAP actions)
+        @param max_pending: requests waiting for a thread on each pool before
+                            503 is answered
+        @param timeout: seconds an idle connection, or one with a partial
+                        request, is kept open
+        @param max_connections: connections over this are refused. select()
+                                cannot watch more than FD_SETSIZE (usually
+                                1024) descriptors.
+
+        @type bind_addr: tuple
+        @type wsgi_app: callable
+        @type server_name: string
+        @type workers: integer
+        @type action_workers: integer
+        @type max_pending: integer
+        @type timeout: integer
+        @type max_connections: integer
+        """
+        self.bind_addr = bind_addr
+        self.wsgi_app = wsgi_app
+        self.server_name = server_name or socket.gethostname()
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.request_pool = WorkerPool('wsgi-request', workers, max_pending)
+        self.action_pool = WorkerPool('wsgi-action', action_workers,
+                                      max_pending)
+        # Each streaming connection waits for at most one chunk at a time,
+        # so the stream pool is bounded by the number of connections
+        self.stream_pool = WorkerPool('wsgi-stream', workers)
+        self.socket = None
+        self.connections = {}
+        self.ready = False
+        self._calls = Queue()
+        self._wake_r = None
+        self._wake_w = None
+        self._timer = None
+
+    def start(self):
+        """ Starts listening. Returns immediately, requests are served by the
+        reactor.
+        """
+        if self.ready:
+            return
+        host, port = self.bind_addr
+        info = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                  socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+        af, socktype, proto, canonname, sa = info[0]
+        self.socket = socket.socket(af, socktype, proto)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(sa)
+        self.socket.listen(64)
+        self.socket.setblocking(0)
+
+        self._wake_r, self._wake_w = wakeup_pair()
+        self.request_pool.start()
+        self.action_pool.start()
+        self.stream_pool.start()
+        self.ready = True
+        reactor.add_fd(self._wake_r, self._on_wake, EVENT_TYPE_READ)
+        reactor.add_fd(self.socket, self._on_accept, EVENT_TYPE_READ)
+        self._timer = reactor.add_timer(max(self.timeout / 4, 1),
+                                        self._close_idle)
+        log.debug('Listening on %s:%s', host, port)
+
+    def stop(self):
+        """ Stops listening and closes all connections.
+        """
+        if not self.ready:
+            return
+        self.ready = False
+        reactor.rem_timer(self._timer)
+        reactor.rem_fd(self.socket)
+        reactor.rem_fd(self._wake_r)
+        self.socket.close()
+        for conn in self.connections.values():
+            conn.close()
+        self.request_pool.stop()
+        self.action_pool.stop()
+        self.stream_pool.stop()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def call_in_reactor(self, function, *args):
+        """ Runs function(*args) on the reactor thread. May be called from
+        any thread.
+        """
+        self._calls.put((function, args))
+        try:
+            self._wake_w.send('x')
+        except socket.error:
+            # Buffer full, a wake up is already pending
+            pass
+
+    def _on_wake(self, fd, evt):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while True:
+            try:
+                function, args = self._calls.get_nowait()
+            except Empty:
+                break
+            try:
+                function(*args)
+            except Exception, e:
+                log.error('Error running %s on the reactor: %s', function, e)
+        return True
+
+    def _on_accept(self, fd, evt):
+        while True:
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] not in nonblocking_errors:
+                    log.debug('accept() failed: %s', e)
+                return True
+            if len(self.connections) >= self.max_connections:
+                log.warning('Refusing connection from %s, %d connections '\
+                            'open', addr, len(self.connections))
+                sock.close()
+                continue
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[sock] = HTTPConnection(self, sock, addr)
+
+    def _close_idle(self):
+        limit = time() - self.timeout
+        for conn in self.connections.values():
+            if conn.state == READING and conn.last_active < limit:
+                log.debug('Closing idle connection from %s', conn.addr)
+                conn.close()
+
+
+class HTTPConnection(object):
+    """ HTTP/1.1 connection of a ReactorWSGIServer. All methods run on the
+    reactor thread, except call_application() and next_chunk() which run on
+    the worker pools.
+    """
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.state = READING
+        self.last_active = time()
+        self.rbuf = ''
+        self.wbuf = ''
+        self.continue_sent = False
+        self._reset_response()
+        reactor.add_fd(sock, self._on_read, EVENT_TYPE_READ)
+
+    def _reset_response(self):
+        self.body = None
+        self.body_iter = None
+        self.body_file = None
+        self.fetching = False
+        self.chunked_write = False
+        self.close_connection = False
+        self.content_length = None
+        self.body_sent = 0
+        self.is_head = False
+
+    def close(self):
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        reactor.rem_fd(self.sock)
+        self.server.connections.pop(self.sock, None)
+        self._close_body()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def _close_body(self):
+        body = self.body
+        self.body = None
+        self.body_file = None
+        if hasattr(body, 'close'):
+            try:
+                body.close()
+            except Exception, e:
+                log.debug('Error closing response body: %s', e)
+
+    def _watch(self, event_type, callback):
+        reactor.rem_fd(self.sock)
+        if event_type:
+            reactor.add_fd(self.sock, callback, event_type)
+
+    # Reading
+
+    def _on_read(self, fd, evt):
+        if self.state != READING:
+            return True
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except socket.error, e:
+            if e.args[0] not in nonblocking_errors:
+                self.close()
+            return True
+        if not data:
+            self.close()
+            return True
+        self.rbuf += data
+        self.last_active = time()
+        self._parse_request()
+        return True
+
+    def _parse_request(self):
+        end = self.rbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(self.rbuf) > MAX_HEADER_SIZE:
+                self._error(413)
+            return
+        try:
+            environ = self._build_environ(self.rbuf[:end])
+        except ValueError, e:
+            log.debug('Bad request from %s: %s', self.addr, e)
+            self._error(400)
+            return
+        if environ is None:
+            return
+        data = self.rbuf[end + 4:]
+
+        te = environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+        if te:
+            if te != 'chunked':
+                self._error(501)
+                return
+            try:
+                decoded = decode_chunked(data)
+            except ValueError:
+                self._error(400)
+                return
+            if decoded is None:
+                length = -1
+            else:
+                body, length = decoded
+                environ['CONTENT_LENGTH'] = str(len(body))
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                self._error(400)
+                return
+            if length > len(data):
+                length = -1
+            else:
+                body = data[:length]
+
+        if length < 0:
+            # Waiting for the rest of the body
+            if len(data) > MAX_BODY_SIZE:
+                self._error(413)
+            elif not self.continue_sent and \
+               environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+                self.continue_sent = True
+                self._send_now('HTTP/1.1 100 Continue\r\n\r\n')
+            return
+
+        self.rbuf = data[length:]
+        self.continue_sent = False
+        environ['wsgi.input'] = StringIO(body)
+        self._dispatch(environ)
+
+    def _build_environ(self, head):
+        lines = head.split('\r\n')
+        while lines and not lines[0]:
+            # Ignore empty lines before the request line
+            lines.pop(0)
+        if not lines:
+            raise ValueError('Empty request')
+        try:
+            method, uri, req_protocol = lines[0].strip().split(' ', 2)
+        except ValueError:
+            raise ValueError('Malformed Request-Line')
+        if not req_protocol.startswith('HTTP/') or len(req_protocol) != 8:
+            raise ValueError('Bad protocol %r' % req_protocol)
+        rp = int(req_protocol[5]), int(req_protocol[7])
+        if rp[0] != 1:
+            self._error(505)
+            return None
+
+        scheme, location, path, params, qs, frag = urlparse(uri)
+        if params:
+            path = path + ';' + params
+
+        server_host, server_port = self.server.bind_addr[:2]
+        environ = {'wsgi.version': (1, 0),
+                   'wsgi.url_scheme': scheme or 'http',
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': False,
+                   'wsgi.run_once': False,
+                   'wsgi.errors': sys.stderr,
+                   'REQUEST_METHOD': method,
+                   'SCRIPT_NAME': '',
+                   'PATH_INFO': '%2F'.join([unquote(x) for x in
+                                            quoted_slash.split(path)]),
+                   'QUERY_STRING': qs,
+                   'SERVER_PROTOCOL': req_protocol,
+                   'ACTUAL_SERVER_PROTOCOL': 'HTTP/1.1',
+                   'SERVER_NAME': location or self.server.server_name,
+                   'SERVER_PORT': str(server_port),
+                   'SERVER_SOFTWARE': self.server.version,
+                   'REMOTE_ADDR': self.addr[0],
+                   'REMOTE_PORT': str(self.addr[1])}
+
+        envname = None
+        for line in lines[1:]:
+            if not line:
+                continue
+            if line[0] in ' \t':
+                # Continuation line
+                if envname is None:
+                    raise ValueError('Bad header continuation')
+                environ[envname] = '%s %s' % (environ[envname], line.strip())
+                continue
+            k, sep, v = line.partition(':')
+            if not sep:
+                raise ValueError('Bad header line %r' % line)
+            k, v = k.strip().upper(), v.strip()
+            envname = 'HTTP_' + k.replace('-', '_')
+            if k in comma_separated_headers and envname in environ:
+                v = ', '.join((environ[envname], v))
+            environ[envname] = v
+
+        if 'HTTP_CONTENT_TYPE' in environ:
+            environ['CONTENT_TYPE'] = environ.pop('HTTP_CONTENT_TYPE')
+        if 'HTTP_CONTENT_LENGTH' in environ:
+            environ['CONTENT_LENGTH'] = environ.pop('HTTP_CONTENT_LENGTH')
+
+        # Persistent connection support, as CherryPy
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if rp >= (1, 1):
+            self.close_connection = connection == 'close'
+        else:
+            self.close_connection = connection != 'keep-alive'
+        self.response_protocol = rp >= (1, 1) and 'HTTP/1.1' or 'HTTP/1.0'
+        self.is_head = method == 'HEAD'
+        return environ
+
+    # Application
+
+    def _dispatch(self, environ):
+        self.state = HANDLING
+        self._watch(0, None)
+        if environ['REQUEST_METHOD'] == 'POST':
+            pool = self.server.action_pool
+        else:
+            pool = self.server.request_pool
+        if not pool.submit(self.call_application, (environ, ),
+                           self._application_done):
+            log.warning('%s pool full, answering 503 to %s', pool.name,
+                        self.addr)
+            self._error(503)
+
+    def call_application(self, environ):
+        """ Calls the application and gets the start of the response body.
+        Runs on a worker thread.
+
+        @return: (status, headers, data, rest of the body)
+        @rtype: tuple
+        """
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if 'status' in response and not exc_info:
+                raise AssertionError('WSGI start_response called a second '
+                                     'time with no exc_info.')
+            response['status'] = status
+            response['headers'] = list(headers)
+            return written.append
+
+        body = self.server.wsgi_app(environ, start_response)
+        rest = None
+        if isinstance(body, str):
+            written.append(body)
+        elif isinstance(body, (list, tuple)):
+            written.extend(body)
+        elif isinstance(body, file):
+            rest = body
+        elif body is not None:
+            # The application may call start_response on the first
+            # iteration of the body
+            rest = iter(body)
+            for chunk in rest:
+                if chunk:
+                    written.append(chunk)
+                    break
+            else:
+                rest = None
+            if hasattr(body, 'close'):
+                rest = (rest, body)
+        if 'status' not in response:
+            raise AssertionError('WSGI application did not call '
+                                 'start_response.')
+        return response['status'], response['headers'], ''.join(written), rest
+
+    def _application_done(self, result, error):
+        self.server.call_in_reactor(self._start_response, result, error)
+
+    def _start_response(self, result, error):
+        if self.state == CLOSED:
+            if result and result[3] is not None:
+                self.body = result[3]
+                self._close_body()
+            return
+        if error:
+            log.error('Error handling request from %s: %s', self.addr,
+                      error[1], exc_info=error)
+            self._error(500)
+            return
+        status, headers, data, rest = result
+        if isinstance(rest, tuple):
+            # Generator with a close() method
+            rest, self.body = rest
+        else:
+            self.body = rest
+        if isinstance(rest, file):
+            self.body_file = rest
+        self.body_iter = rest
+
+        hkeys = [k.lower() for k, v in headers]
+        code = int(status[:3])
+        if 'content-length' in hkeys:
+            for k, v in headers:
+                if k.lower() == 'content-length':
+                    try:
+                        self.content_length = int(v)
+                    except ValueError:
+                        self.close_connection = True
+        elif code < 200 or code in (204, 205, 304) or self.is_head:
+            pass
+        elif self.response_protocol == 'HTTP/1.1':
+            self.chunked_write = True
+            headers.append(('Transfer-Encoding', 'chunked'))
+        else:
+            # Closing the connection is the only way to tell the length
+            self.close_connection = True
+
+        if 'connection' not in hkeys:
+            if self.response_protocol == 'HTTP/1.1':
+                if self.close_connection:
+                    headers.append(('Connection', 'close'))
+            elif not self.close_connection:
+                headers.append(('Connection', 'Keep-Alive'))
+        if 'date' not in hkeys:
+            headers.append(('Date', rfc822.formatdate()))
+        if 'server' not in hkeys:
+            headers.append(('Server', self.server.version))
+
+        buf = ['HTTP/1.1 ', status, '\r\n']
+        buf += ['%s: %s\r\n' % (k, v) for k, v in headers]
+        buf.append('\r\n')
+        self.wbuf = ''.join(buf)
+        if self.is_head:
+            self._close_body()
+            self.body_iter = None
+        else:
+            self._add_data(data)
+        self.state = WRITING
+        self._watch(EVENT_TYPE_WRITE, self._on_write)
+
+    # Writing
+
+    def _add_data(self, data):
+        if not data:
+            return
+        self.body_sent += len(data)
+        if self.chunked_write:
+            self.wbuf += '%x\r\n%s\r\n' % (len(data), data)
+        else:
+            self.wbuf += data
+
+    def _on_write(self, fd, evt):
+        if self.state != WRITING:
+            return True
+        if len(self.wbuf) < CHUNK_SIZE and self.body_file is not None:
+            # File bodies are read on the reactor thread
+            try:
+                data = self.body_file.read(CHUNK_SIZE)
+            except (IOError, OSError), e:
+                log.error('Error reading response body: %s', e)
+                self.close()
+                return True
+            if data:
+                self._add_data(data)
+            else:
+                self._end_body()
+        if self.wbuf:
+            try:
+                sent = self.sock.send(self.wbuf)
+            except socket.error, e:
+                if e.args[0] not in nonblocking_errors:
+                    log.debug('Connection from %s lost: %s', self.addr, e)
+                    self.close()
+                return True
+            self.wbuf = self.wbuf[sent:]
+            self.last_active = time()
+            if self.wbuf:
+                return True
+        if self.body_iter is None:
+            self._finish_response()
+        elif self.body_file is None and not self.fetching:
+            # Other bodies are produced on the stream pool, the socket is
+            # not watched while a chunk is produced
+            self.fetching = True
+            self._watch(0, None)
+            self.server.stream_pool.submit(self.next_chunk, (self.body_iter, ),
+                                           self._chunk_done)
+        return True
+
+    def next_chunk(self, body_iter):
+        """ Returns the next non-empty chunk of the body, or None at its end.
+        Runs on a worker thread.
+        """
+        for chunk in body_iter:
+            if chunk:
+                return chunk
+        return None
+
+    def _chunk_done(self, chunk, error):
+        self.server.call_in_reactor(self._add_chunk, chunk, error)
+
+    def _add_chunk(self, chunk, error):
+        self.fetching = False
+        if self.state != WRITING:
+            self._close_body()
+            return
+        if error:
+            log.error('Error producing response body for %s: %s', self.addr,
+                      error[1])
+            self.close()
+            return
+        if chunk is None:
+            self._end_body()
+        else:
+            self._add_data(chunk)
+        self._watch(EVENT_TYPE_WRITE, self._on_write)
+
+    def _end_body(self):
+        self.body_iter = None
+        self.body_file = None
+        if self.chunked_write:
+            self.wbuf += '0\r\n\r\n'
+        elif self.content_length is not None and \
+             self.content_length != self.body_sent:
+            # The length sent does not match, the next response would be
+            # garbled
+            self.close_connection = True
+
+    def _finish_response(self):
+        self._close_body()
+        if self.close_connection or not self.server.ready:
+            self.close()
+            return
+        self._reset_response()
+        self.state = READING
+        self.last_active = time()
+        self._watch(EVENT_TYPE_READ, self._on_read)
+        if self.rbuf:
+            # Pipelined request
+            self._parse_request()
+
+    def _send_now(self, data):
+        try:
+            self.sock.send(data)
+        except socket.error:
+            pass
+
+    def _error(self, code):
+        """ Answers a simple error response and closes the connection.
+        """
+        msg = status_messages[code]
+        self._send_now('HTTP/1.1 %d %s\r\nContent-Length: %d\r\n'
+                       'Content-Type: text/plain\r\nConnection: close\r\n'
+                       '\r\n%s' % (code, msg, len(msg), msg))
+        self.close()
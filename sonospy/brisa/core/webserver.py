@@ -15,7 +15,7 @@ some_adapter was retrieved with get_available_adapters().
 
 __all__ = ('Resource', 'CustomResource', 'WebServer', 'StaticFile', 'adapters',
            'get_available_adapters', 'AdapterInterface', 'CherrypyAdapter',
-           'PasteAdapter', 'CircuitsWebAdapter')
+           'PasteAdapter', 'CircuitsWebAdapter', 'ReactorAdapter')
 
 import transcode
 
@@ -1340,9 +1340,42 @@ class CircuitsWebAdapter(AdapterInterface):
             return False
 
 
+class ReactorAdapter(AdapterInterface):
+    """ Non-blocking WSGI server adapter running on the brisa reactor. Idle
+    and keep-alive connections do not hold a thread; the application is called
+    from bounded worker pools (see brisa.core.reactor_wsgi).
+    """
+
+    def setup(self, server_name, host, port, app_callback):
+        from brisa.core.reactor_wsgi import ReactorWSGIServer
+        kwargs = {}
+        for name, param in (('workers', 'reactor_webserver_workers'),
+                            ('action_workers',
+                             'reactor_webserver_action_workers'),
+                            ('max_pending', 'reactor_webserver_max_pending'),
+                            ('timeout', 'reactor_webserver_timeout')):
+            try:
+                kwargs[name] = int(config.get_parameter('brisa', param))
+            except:
+                pass
+        self._server = ReactorWSGIServer((host, port), app_callback,
+                                         server_name=server_name, **kwargs)
+
+    def start(self):
+        self._server.start()
+
+    def stop(self):
+        self._server.stop()
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+
 adapters = {'cherrypy': CherrypyAdapter,
             'paste': PasteAdapter,
-            'circuits.web': CircuitsWebAdapter}
+            'circuits.web': CircuitsWebAdapter,
+            'reactor': ReactorAdapter}
 
 
 def client_host(server_host):
@@ -1439,9 +1472,10 @@ class WebServer(Resource):
         self.host = host
         self.port = port
         
-        # force Cherrypy
-        adapter = CherrypyAdapter
-        
+        if not adapter:
+            # Cherrypy unless another adapter is configured
+            adapter = get_preferred_adapter() or CherrypyAdapter
+
         self.adapter = adapter
         self.running = False
 
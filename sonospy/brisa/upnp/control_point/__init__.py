@@ -11,3 +11,5 @@ from brisa.upnp.control_point.event import EventListener, EventListenerServer
 from brisa.upnp.control_point.service import Service
 from brisa.upnp.control_point.device import Device
 from brisa.upnp.control_point.msearch import MSearch
+from brisa.upnp.control_point.subscription import SubscriptionManager, \
+                                                get_subscription_manager
@@ -198,13 +198,15 @@ class EventListenerServer(object):
         @rtype: tuple
         """
         if not self.srv:
-            self.srv = webserver.WebServer(port=self.port)
+            self.srv = webserver.WebServer(port=self.port,
+                                           adapter=webserver.ReactorAdapter)
             self.srv.start()
         return (self.srv.get_host(), self.srv.get_port())
 
     def start(self, event_host=None):
         if not self.srv:
-            self.srv = webserver.WebServer(port=self.port)
+            self.srv = webserver.WebServer(port=self.port,
+                                           adapter=webserver.ReactorAdapter)
             self.srv.start()
         if event_host:
             self.srv.listen_url = 'http://%s:%d' % event_host
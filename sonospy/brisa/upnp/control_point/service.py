@@ -30,12 +30,12 @@ import re
 from brisa.core import log
 from brisa.core.network import url_fetch, parse_url, http_call
 from brisa.core.threaded_call import run_async_call
-from brisa.core.threaded_call import ThreadedCall
 from brisa.upnp.soap import SOAPProxy, SOAPProxyFile
 from brisa.upnp.base_service import BaseService, BaseStateVariable,\
                                     format_rel_url
 from brisa.upnp.control_point.action import Action, Argument
 from brisa.upnp.base_service_builder import BaseServiceBuilder
+from brisa.upnp.control_point.subscription import AutoRenew
 
 
 class StateVariable(BaseStateVariable):
@@ -233,8 +233,9 @@ class Service(BaseService):
         @param callback: callback
         @param cargo: callback parameters
         @param auto_renew: if True, the framework will automatically renew the
-        subscription before it expires. If False, the program need to call
-        event_renew method before the subscription timeout.
+        subscription before it expires, subscribing again if the renewal
+        fails (the new sid is passed to callback). If False, the program
+        need to call event_renew method before the subscription timeout.
         @param renew_callback: renew callback. It will be used when auto_renew
                                is True
 
@@ -243,9 +244,13 @@ class Service(BaseService):
         @type auto_renew: boolean
         @type renew_callback: callable
         """
+        if self._auto_renew_subs:
+            self._auto_renew_subs.stop_auto_renew()
+            self._auto_renew_subs = None
         if auto_renew:
             self._auto_renew_subs = AutoRenew(self, event_host,
-                                              renew_callback, cargo)
+                                              renew_callback, cargo,
+                                              callback)
         SubscribeRequest(self, event_host, callback, cargo)
 
     def event_unsubscribe(self, event_host, callback, cargo):
@@ -258,6 +263,9 @@ class Service(BaseService):
         @type event_host: tuple
         @type callback: callable
         """
+        if self._auto_renew_subs:
+            self._auto_renew_subs.stop_auto_renew()
+            self._auto_renew_subs = None
         if not self.event_sid:
             # not registered
             return
@@ -547,32 +555,3 @@ class RenewSubscribeRequest(object):
             self.callback(self.cargo, sid, timeout)
 
         return True
-
-
-class AutoRenew(object):
-
-    def __init__(self, service, event_host, callback, cargo):
-        self.event_host = event_host
-        self.callback = callback
-        self.cargo = cargo
-        self.service = service
-
-    def start_auto_renew(self):
-        self._auto_renew()
-
-    def _auto_renew(self):
-        renew_delay = int(self.service.event_timeout) - 10
-        if renew_delay <= 0:
-            renew_delay = int(self.service.event_timeout) - 0.5
-        t_call = ThreadedCall(self._renew, delay=renew_delay)
-        t_call.start()
-
-    def _renew(self):
-        RenewSubscribeRequest(self.service, self.event_host,
-                              self._renew_callback, self.cargo)
-
-    def _renew_callback(self, cargo, sid, timeout):
-        if timeout != 0:
-            self._auto_renew()
-        if self.callback:
-            self.callback(cargo, sid, timeout)
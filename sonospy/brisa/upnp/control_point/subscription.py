@@ -0,0 +1,369 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php or see LICENSE file.
+# Copyright 2007-2008 Brisa Team <brisa-develop@garage.maemo.org>
+
+""" Central renewal of event subscriptions.
+
+All auto renewed subscriptions of a control point are kept in one deadline
+heap. A single scheduler thread takes the subscriptions that are due (plus
+those due within a short batch window) and hands them to a small pool of
+worker threads, which renew them over pooled HTTP connections. A renewal
+that fails is retried as a new subscription.
+"""
+
+import heapq
+import threading
+
+from time import time
+from Queue import Queue
+
+from brisa.core import log
+from brisa.core.network import ConnectionPool, parse_url
+
+log = log.getLogger('control-point.subscription')
+
+
+def parse_subscribe_response(http_response):
+    """ Returns the (sid, timeout) of a SUBSCRIBE response. sid is None if
+    the response has no SID header.
+
+    @param http_response: response object
+    @type http_response: HTTPResponse
+
+    @rtype: tuple
+    """
+    sid = http_response.getheader('sid')
+    if sid:
+        sid = sid.strip()
+    timeout = 1800
+    stimeout = (http_response.getheader('timeout') or '').strip().lower()
+    if stimeout[0:7] == "second-":
+        try:
+            timeout = int(stimeout[7:])
+        except ValueError:
+            pass
+    return sid, timeout
+
+
+class SubscriptionManager(object):
+    """ Renews the event subscriptions of all services from a deadline heap.
+    """
+
+    def __init__(self, workers=3, renew_margin=10, batch_window=5,
+                 retry_interval=30):
+        """ Constructor for the SubscriptionManager class.
+
+        @param workers: number of renewal worker threads
+        @param renew_margin: seconds before expiry a subscription is renewed
+        @param batch_window: subscriptions due within this many seconds of
+                             the first due one are renewed in the same batch
+        @param retry_interval: seconds between attempts to resubscribe a
+                               failed subscription
+
+        @type workers: integer
+        @type renew_margin: integer
+        @type batch_window: float
+        @type retry_interval: float
+        """
+        self.workers = workers
+        self.renew_margin = renew_margin
+        self.batch_window = batch_window
+        self.retry_interval = retry_interval
+        self.pool = ConnectionPool()
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._work = Queue()
+        self._threads = []
+        self._running = False
+
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        """ Starts the scheduler and worker threads.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._threads = [threading.Thread(target=self._schedule_loop)]
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._work_loop))
+        for t in self._threads:
+            t.setDaemon(True)
+            t.start()
+
+    def stop(self):
+        """ Stops the threads and closes pooled connections. Subscriptions
+        are kept, so the manager can be started again.
+        """
+        if not self._running:
+            return
+        self._cond.acquire()
+        try:
+            self._running = False
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        for i in range(self.workers):
+            self._work.put(None)
+        self._threads = []
+        self.pool.close()
+
+    def schedule(self, renewal, delay=None):
+        """ Schedules the next renewal of a subscription. If delay is not
+        given, the subscription is renewed renew_margin seconds before its
+        timeout.
+
+        @param renewal: subscription to renew
+        @param delay: seconds from now
+
+        @type renewal: AutoRenew
+        @type delay: float
+        """
+        if delay is None:
+            timeout = int(renewal.service.event_timeout)
+            delay = timeout - self.renew_margin
+            if delay <= 0:
+                delay = timeout * 0.5
+        deadline = time() + delay
+        self._cond.acquire()
+        try:
+            # Entries left in the heap with another deadline are stale and
+            # are skipped when popped
+            self._deadlines[renewal] = deadline
+            heapq.heappush(self._heap, (deadline, id(renewal), renewal))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if not self._running:
+            self.start()
+
+    def remove(self, renewal):
+        """ Stops renewing a subscription.
+
+        @type renewal: AutoRenew
+        """
+        self._cond.acquire()
+        try:
+            self._deadlines.pop(renewal, None)
+        finally:
+            self._cond.release()
+
+    def get_deadline(self, renewal):
+        return self._deadlines.get(renewal)
+
+    def get_table(self):
+        """ Returns one dictionary per managed subscription with its sid,
+        service, next renewal time and renewal statistics.
+
+        @rtype: list
+        """
+        self._cond.acquire()
+        try:
+            items = self._deadlines.items()
+        finally:
+            self._cond.release()
+        table = []
+        for renewal, deadline in sorted(items, key=lambda x: x[1]):
+            row = renewal.get_status()
+            row['next_renewal'] = deadline
+            table.append(row)
+        return table
+
+    def _schedule_loop(self):
+        while True:
+            self._cond.acquire()
+            try:
+                if not self._running:
+                    return
+                batch = self._pop_due()
+                if not batch:
+                    if self._heap:
+                        self._cond.wait(max(self._heap[0][0] - time(), 0.1))
+                    else:
+                        self._cond.wait()
+                    continue
+            finally:
+                self._cond.release()
+            log.debug('Renewing %d subscriptions', len(batch))
+            for renewal in batch:
+                self._work.put(renewal)
+
+    def _pop_due(self):
+        # Must be called with the lock held
+        batch = []
+        now = time()
+        while self._heap:
+            deadline, key, renewal = self._heap[0]
+            if self._deadlines.get(renewal) != deadline:
+                heapq.heappop(self._heap)
+                continue
+            if batch:
+                limit = now + self.batch_window
+            else:
+                limit = now
+            if deadline > limit:
+                break
+            heapq.heappop(self._heap)
+            del self._deadlines[renewal]
+            batch.append(renewal)
+        return batch
+
+    def _work_loop(self):
+        while True:
+            renewal = self._work.get()
+            if renewal is None:
+                return
+            try:
+                renewal.renew(self)
+            except Exception, e:
+                log.error('Renewal of %s failed: %s', renewal, e)
+                self.schedule(renewal, self.retry_interval)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_subscription_manager():
+    """ Returns the subscription manager shared by all services.
+
+    @rtype: SubscriptionManager
+    """
+    global _manager
+    _manager_lock.acquire()
+    try:
+        if _manager is None:
+            _manager = SubscriptionManager()
+        return _manager
+    finally:
+        _manager_lock.release()
+
+
+class AutoRenew(object):
+    """ Auto renewed subscription of a service, renewed by the
+    SubscriptionManager. If a renewal fails the service is subscribed again
+    and the subscribe callback gets the new sid.
+    """
+
+    def __init__(self, service, event_host, callback, cargo,
+                 subscribe_callback=None):
+        """ Constructor for the AutoRenew class.
+
+        @param service: subscribed service
+        @param event_host: 2-tuple (host, port) of the event listener server
+        @param callback: renew callback, receives (cargo, sid, timeout)
+        @param cargo: callback parameters
+        @param subscribe_callback: called with (cargo, sid, timeout) when the
+                                   service had to be subscribed again
+
+        @type service: Service
+        @type event_host: tuple
+        @type callback: callable
+        @type subscribe_callback: callable
+        """
+        self.event_host = event_host
+        self.callback = callback
+        self.subscribe_callback = subscribe_callback
+        self.cargo = cargo
+        self.service = service
+        self.renewals = 0
+        self.failures = 0
+        self.resubscriptions = 0
+        self.last_latency = None
+        self.last_renewal = None
+
+    def __repr__(self):
+        return '<AutoRenew %s %s>' % (self.service.id, self.service.event_sid)
+
+    def start_auto_renew(self):
+        get_subscription_manager().schedule(self)
+
+    def stop_auto_renew(self):
+        get_subscription_manager().remove(self)
+
+    def get_status(self):
+        """ Returns the sid, service and renewal statistics.
+
+        @rtype: dict
+        """
+        return {'sid': self.service.event_sid,
+                'service': self.service.id,
+                'url': self._event_url(),
+                'timeout': self.service.event_timeout,
+                'renewals': self.renewals,
+                'failures': self.failures,
+                'resubscriptions': self.resubscriptions,
+                'last_renewal': self.last_renewal,
+                'last_latency': self.last_latency}
+
+    def renew(self, manager):
+        """ Renews the subscription, or subscribes again if there is no sid
+        or the renewal is refused. Called from a manager worker thread.
+
+        @type manager: SubscriptionManager
+        """
+        url = self._event_url()
+        Paddr = parse_url(url)
+        headers = {}
+        headers["HOST"] = '%s:%d' % (Paddr.hostname, Paddr.port)
+        headers["TIMEOUT"] = 'Second-1800'
+
+        sid = self.service.event_sid
+        if sid:
+            headers["SID"] = sid
+            start = time()
+            try:
+                response = manager.pool.call('SUBSCRIBE', url,
+                                             headers=headers)
+            except Exception, e:
+                log.debug('Renew of %s failed: %s', sid, e)
+                response = None
+            if response is not None and response.status == 200:
+                new_sid, timeout = parse_subscribe_response(response)
+                self._renewed(manager, new_sid or sid, timeout,
+                              time() - start)
+                if self.callback:
+                    self.callback(self.cargo, self.service.event_sid,
+                                  timeout)
+                return
+            self.failures += 1
+            self.service.event_sid = ""
+            self.service.event_timeout = 0
+            if self.callback:
+                self.callback(self.cargo, "", 0)
+            del headers["SID"]
+
+        headers["User-agent"] = 'BRisa UPnP Framework'
+        headers["NT"] = 'upnp:event'
+        headers["CALLBACK"] = "<http://%s:%d/eventSub>" % self.event_host
+        start = time()
+        try:
+            response = manager.pool.call('SUBSCRIBE', url, headers=headers)
+        except Exception, e:
+            log.debug('Resubscribe to %s failed: %s', url, e)
+            response = None
+        new_sid = None
+        if response is not None and response.status == 200:
+            new_sid, timeout = parse_subscribe_response(response)
+        if not new_sid:
+            self.failures += 1
+            manager.schedule(self, manager.retry_interval)
+            return
+        log.debug('Resubscribed to %s, sid: %s', url, new_sid)
+        self.resubscriptions += 1
+        self._renewed(manager, new_sid, timeout, time() - start)
+        if self.subscribe_callback:
+            self.subscribe_callback(self.cargo, new_sid, timeout)
+
+    def _renewed(self, manager, sid, timeout, latency):
+        self.service.event_sid = sid
+        self.service.event_timeout = timeout
+        self.renewals += 1
+        self.last_latency = latency
+        self.last_renewal = time()
+        manager.schedule(self)
+
+    def _event_url(self):
+        return "%s%s" % (self.service.url_base, self.service.event_sub_url)
@@ -53,6 +53,8 @@ class Device(BaseDevice):
                                  address. If it's not possible to listen on
                                  that address, another random one will be
                                  generated and used automatically.
+        @param webserver_adapter: adapter for the webserver, see
+                                  brisa.core.webserver.adapters
 
         @type device_type: string
         @type friendly_name: string
@@ -69,10 +71,12 @@ class Device(BaseDevice):
         @type presentation_url: string
         @type create_webserver: bool
         @type force_listen_url: url to use for webserver
+        @type webserver_adapter: AdapterInterface
         """
         create_webserver = kwargs.pop('create_webserver', True)
         force_listen_url = kwargs.pop('force_listen_url', '')
         udp_listener = kwargs.pop('udp_listener', '')
+        self.webserver_adapter = kwargs.pop('webserver_adapter', None)
         BaseDevice.__init__(self, *args, **kwargs)
         self._generate_xml()
         self.SSDP = SSDPServer(self.friendly_name, self.xml_filename, udp_listener=udp_listener)
@@ -97,9 +101,11 @@ class Device(BaseDevice):
     def _create_webserver(self, force_listen_url=''):
         if force_listen_url:
             p = network.parse_url(force_listen_url)
-            self.webserver = webserver.WebServer(host=p.hostname, port=p.port)
+            self.webserver = webserver.WebServer(host=p.hostname, port=p.port,
+                                            adapter=self.webserver_adapter)
         else:
-            self.webserver = webserver.WebServer()
+            self.webserver = webserver.WebServer(
+                                            adapter=self.webserver_adapter)
 
         self.location = self.webserver.get_listen_url()
 
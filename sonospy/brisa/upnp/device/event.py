@@ -7,17 +7,21 @@
 """
 
 import uuid
+import socket
+import httplib
+import threading
 
+from time import time
 from xml.etree import ElementTree
 from datetime import datetime
 
 from brisa.core import log, reactor, webserver
 #log = log.getLogger('device-events')
 
-from brisa.core.network import http_call, parse_url
+from brisa.core.network import parse_url, parse_http_response
 from brisa.core.network_senders import UDPTransport
 from brisa.core.network_listeners import UDPListener
-from brisa.core.threaded_call import run_async_call, ThreadedCall
+from brisa.core.threaded_call import ThreadedCall
 from brisa.utils.looping_call import LoopingCall
 from brisa.upnp import soap
 from brisa.upnp.upnp_defaults import map_upnp_value, UPnPDefaults
@@ -33,13 +37,15 @@ class EventController(webserver.CustomResource):
     eventing.
     """
 
-    def __init__(self, service, event_reload_time, force_event_reload):
+    def __init__(self, service, event_reload_time, force_event_reload,
+                 coalesce_window=0.2):
         webserver.CustomResource.__init__(self, 'eventSub')
         #FIXME - This list is not thread safe
         self.subscribers = []
         self.service = service
         self.event_reload_time = event_reload_time
         self.force_event_reload = force_event_reload
+        self.coalesce_window = coalesce_window
 
     def render(self, uri, request, response):
         """ Event renderer method.
@@ -126,7 +132,8 @@ class EventController(webserver.CustomResource):
             subscriber = Subscriber(self.service, timeout,
                                 callback, request.server_protocol,
                                 self.event_reload_time,
-                                self.force_event_reload)
+                                self.force_event_reload,
+                                self.coalesce_window)
             response_body = self._get_subscribe_response(request,
                                                          response, subscriber)
             self.subscribers.append(subscriber)
@@ -137,7 +144,7 @@ class EventController(webserver.CustomResource):
                 # TODO: check if we need to do this change anywhere else
                 if state_var.send_events:
                     eventing_variables[var_name] = state_var.get_value()
-            EventMessage(subscriber, eventing_variables, 1, "")
+            subscriber.queue_event(eventing_variables, 1)
 
             # Try to unsubscribe after the timeout
             t_call = ThreadedCall(self._auto_remove_subscriber, None, None,
@@ -316,7 +323,7 @@ class EventController(webserver.CustomResource):
 class Subscriber:
 
     def __init__(self, service, subscription_duration, delivery_url, http_version,
-                 event_reload_time, force_event_reload):
+                 event_reload_time, force_event_reload, coalesce_window=0.2):
 
         self.service = service
         self.subscription_id = uuid.uuid4()
@@ -327,6 +334,7 @@ class Subscriber:
         self.subscription_duration = subscription_duration
         self.http_version = http_version
         self.timestamp = datetime.now()
+        self.event_queue = EventQueue(self, coalesce_window)
 
         self.eventing_variables = {}
         for name, state_var in self.service.get_variables().items():
@@ -358,14 +366,29 @@ class Subscriber:
 
         self.eventing_variables[name] = value
 
+    def queue_event(self, variables, delay=0):
+        """ Queues variables for delivery to this subscriber.
+
+        @param variables: variables of the event
+        @param delay: minimum time to wait before sending the event
+
+        @type variables: dict
+        @type delay: float
+        """
+        if not variables:
+            log.error("There are no variables to send")
+            return
+        self.event_queue.put(variables, delay)
+
     def _send_variables(self):
         if self.eventing_variables:
-            EventMessage(self, self.eventing_variables, 0, "")
+            self.queue_event(self.eventing_variables)
             self.eventing_variables = {}
 
     def stop(self):
         for name, state_var in self.service.get_variables().items():
             state_var.unsubscribe_for_update(self._update_variable)
+        self.event_queue.stop()
 
         # When called stop() manually, remove the before stop callback
         if not self.force_event_reload:
@@ -402,45 +425,31 @@ class EventMessage:
     """ Wrapper for an event message.
     """
 
-    def __init__(self, subscriber, variables, event_delay, cargo):
-        """ Constructor for the EventMessage class.
+    def __init__(self, subscriber, variables):
+        """ Constructor for the EventMessage class. Takes the next SEQ of the
+        subscriber, so messages must be built in delivery order.
 
         @param subscriber: subscriber that will receive the message
         @param variables: variables of the event
-        @param event_delay: delay to wait before sending the event
-        @param cargo: callback parameters
 
         @type subscriber: Subscriber
         @type variables: dict
-        @type event_delay: float
         """
         log.debug("event message")
 
-        if not variables:
-            log.error("There are no variables to send")
-            return
-
-        self.cargo = cargo
-
-        headers = {}
-#        headers["HOST"] = subscriber.delivery_url
-        headers["HOST"] = subscriber.host
-        headers["CONTENT-TYPE"] = 'text/xml'
-        headers["NT"] = 'upnp:event'
-        headers["NTS"] = 'upnp:propchange'
-        headers["SID"] = "uuid:" + str(subscriber.subscription_id)
-        headers["SEQ"] = str(subscriber.event_key)
+        self.headers = {}
+#        self.headers["HOST"] = subscriber.delivery_url
+        self.headers["HOST"] = subscriber.host
+        self.headers["CONTENT-TYPE"] = 'text/xml'
+        self.headers["NT"] = 'upnp:event'
+        self.headers["NTS"] = 'upnp:propchange'
+        self.headers["SID"] = "uuid:" + str(subscriber.subscription_id)
+        self.headers["SEQ"] = str(subscriber.event_key)
         subscriber.event_key_increment()
 
-        event_body = self._build_message_body(variables)
+        self.body = self._build_message_body(variables)
 
-        headers["CONTENT-LENGTH"] = str(len(event_body))
-
-        log.debug("Running http call")
-        run_async_call(http_call, success_callback=self.response,
-                       error_callback=self.error, delay=event_delay,
-                       method='NOTIFY', url=subscriber.delivery_url,
-                       body=event_body, headers=headers)
+        self.headers["CONTENT-LENGTH"] = str(len(self.body))
 
     def _build_message_body(self, variables):
         log.debug("Building unicast message body to variables: %s" 
@@ -448,31 +457,266 @@ class EventMessage:
         preamble = """<?xml version="1.0" encoding="utf-8"?>"""
         return '%s%s' % (preamble, build_notify_message_body(variables))
 
-    def error(self, cargo, error):
-        """ Callback for receiving an error.
 
-        @param cargo: callback parameters passed at construction
-        @param error: exception raised
+class EventDeliveryMetrics(object):
+    """ Delivery counters and latencies shared by all event queues. Latency
+    is measured from the first queued change of a message to the subscriber
+    response.
+    """
 
-        @type error: Exception
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
 
-        @rtype: boolean
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.queued = 0
+            self.coalesced = 0
+            self.sent = 0
+            self.failures = 0
+            self.total_latency = 0.0
+            self.max_latency = 0.0
+        finally:
+            self._lock.release()
+
+    def record_queued(self, coalesced):
+        self._lock.acquire()
+        try:
+            self.queued += 1
+            if coalesced:
+                self.coalesced += 1
+        finally:
+            self._lock.release()
+
+    def record_sent(self, latency):
+        self._lock.acquire()
+        try:
+            self.sent += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        finally:
+            self._lock.release()
+
+    def record_failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+        finally:
+            self._lock.release()
+
+    def get(self):
+        """ Returns a snapshot of the metrics.
+
+        @rtype: dict
         """
-        log.debug("error", error)
-        return True
+        self._lock.acquire()
+        try:
+            avg = 0.0
+            if self.sent:
+                avg = self.total_latency / self.sent
+            return {'queued': self.queued,
+                    'coalesced': self.coalesced,
+                    'sent': self.sent,
+                    'failures': self.failures,
+                    'avg_latency': avg,
+                    'max_latency': self.max_latency}
+        finally:
+            self._lock.release()
 
-    def response(self, http_response, cargo):
-        """ Callback for receiving the HTTP response on a successful HTTP call.
 
-        @param http_response: response object
-        @param cargo: callback parameters passed at construction
+delivery_metrics = EventDeliveryMetrics()
 
-        @type http_response: HTTPResponse
 
-        @rtype: boolean
+def get_delivery_metrics():
+    """ Returns the event delivery metrics of all subscribers.
+
+    @rtype: dict
+    """
+    return delivery_metrics.get()
+
+
+def merge_container_update_ids(old, new):
+    """ Merges two ContainerUpdateIDs values, keeping the latest update id
+    of each container and the order the containers were first changed in.
+
+    @param old: value already queued
+    @param new: value being queued
+
+    @type old: string
+    @type new: string
+
+    @rtype: string
+    """
+    containers = []
+    update_ids = {}
+    for value in (old, new):
+        values = (value or '').split(',')
+        for i in range(0, len(values) - 1, 2):
+            if values[i] not in update_ids:
+                containers.append(values[i])
+            update_ids[values[i]] = values[i + 1]
+    return ','.join(['%s,%s' % (c, update_ids[c]) for c in containers])
+
+
+# Variables whose value only lists what has changed, with the function
+# merging a queued value with a later one. Other variables hold their
+# whole state, so a later value replaces a queued one.
+delta_variables = {'ContainerUpdateIDs': merge_container_update_ids}
+
+
+def merge_variables(pending, variables):
+    """ Merges variables into the pending variables of a queue.
+
+    @param pending: variables already queued
+    @param variables: variables being queued
+
+    @type pending: dict
+    @type variables: dict
+    """
+    for name, value in variables.items():
+        if name in pending and name in delta_variables:
+            pending[name] = delta_variables[name](pending[name], value)
+        else:
+            pending[name] = value
+
+
+class EventQueue(object):
+    """ Event queue of a subscriber.
+
+    Variable changes queued within the coalesce window are merged into a
+    single propertyset. At most one message per subscriber is in flight, so
+    messages leave in SEQ order, and they are sent over a keep-alive
+    connection to the delivery URL.
+    """
+
+    def __init__(self, subscriber, coalesce_window):
+        """ Constructor for the EventQueue class.
+
+        @param subscriber: subscriber that will receive the messages
+        @param coalesce_window: time in seconds changes are held for merging
+
+        @type subscriber: Subscriber
+        @type coalesce_window: float
+        """
+        self.subscriber = subscriber
+        self.coalesce_window = coalesce_window
+        url = parse_url(subscriber.delivery_url)
+        self._address = (url.hostname, url.port or 80)
+        self._path = url.path or '/'
+        if url.query:
+            self._path += '?' + url.query
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._first_queued = None
+        self._timer = None
+        self._sending = False
+        self._stopped = False
+        self._connection = None
+
+    def put(self, variables, delay=0):
+        """ Queues variables, merging them with pending values of the same
+        variables (see merge_variables).
+
+        @param variables: variables of the event
+        @param delay: minimum time to wait before sending
+
+        @type variables: dict
+        @type delay: float
         """
-        log.debug("response")
-        return True
+        self._lock.acquire()
+        try:
+            if self._stopped:
+                return
+            delivery_metrics.record_queued(bool(self._pending))
+            merge_variables(self._pending, variables)
+            if self._first_queued is None:
+                self._first_queued = time()
+            if self._timer is None and not self._sending:
+                self._schedule(max(delay, self.coalesce_window))
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """ Drops pending changes and closes the connection.
+        """
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            self._pending = {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        finally:
+            self._lock.release()
+        self._close()
+
+    def _schedule(self, delay):
+        # Must be called with the lock held
+        self._timer = threading.Timer(delay, self._flush)
+        self._timer.setDaemon(True)
+        self._timer.start()
+
+    def _flush(self):
+        self._lock.acquire()
+        try:
+            self._timer = None
+            if self._stopped or not self._pending:
+                return
+            variables, self._pending = self._pending, {}
+            queued_at, self._first_queued = self._first_queued, None
+            self._sending = True
+        finally:
+            self._lock.release()
+
+        try:
+            self._deliver(variables, queued_at)
+        finally:
+            self._lock.acquire()
+            try:
+                self._sending = False
+                if self._pending and not self._stopped and \
+                   self._timer is None:
+                    self._schedule(self.coalesce_window)
+            finally:
+                self._lock.release()
+
+    def _deliver(self, variables, queued_at):
+        message = EventMessage(self.subscriber, variables)
+        error = None
+        # A kept-alive connection may have been closed by the subscriber,
+        # so retry once on a new one
+        for attempt in range(2):
+            try:
+                con = self._get_connection()
+                con.request('NOTIFY', self._path, message.body,
+                            message.headers)
+                response = con.getresponse()
+                response.read()
+                if response.will_close:
+                    self._close()
+                delivery_metrics.record_sent(time() - queued_at)
+                log.debug('Event SEQ %s delivered to %s, status %s',
+                          message.headers['SEQ'],
+                          self.subscriber.delivery_url, response.status)
+                return
+            except (httplib.HTTPException, socket.error), error:
+                self._close()
+        delivery_metrics.record_failure()
+        log.debug('Event SEQ %s delivery to %s failed: %s',
+                  message.headers['SEQ'], self.subscriber.delivery_url,
+                  error)
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = httplib.HTTPConnection(*self._address)
+        return self._connection
+
+    def _close(self):
+        con, self._connection = self._connection, None
+        if con is not None:
+            con.close()
 
 
 class MulticastEventController:
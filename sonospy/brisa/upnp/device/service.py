@@ -221,6 +221,13 @@ class Service(BaseService):
         except:
             self._force_event_reload = False 
 
+        try:
+            self._event_coalesce_window = float(config.get_parameter('brisa', 'event_coalesce_window'))
+            if self._event_coalesce_window < 0:
+                self._event_coalesce_window = 0
+        except:
+            self._event_coalesce_window = 0.2
+
 
         if not scpd_xml_filepath:
             self._generate_xml()
@@ -282,7 +289,8 @@ class Service(BaseService):
             if  state_variable.send_events == True:
                 if self.eventSub_controller == None:
                     self.eventSub_controller = EventController(self, self._event_reload_time,
-                                                               self._force_event_reload)
+                                                               self._force_event_reload,
+                                                               self._event_coalesce_window)
 #                if not self.multicast_event_controller and state_variable.multicast:
                 if self.multicast_event_controller == None:
                     self.multicast_event_controller = MulticastEventController(self.parent_udn,
@@ -14,9 +14,12 @@ When used on a control point, it's used for keeping record of known devices
 (obtained through search or announcements).
 """
 
+import re
 import random
+from time import time
 
 from brisa.core import log
+from brisa.core.network import parse_http_headers
 from brisa.core.network_senders import UDPTransport
 from brisa.core.network_listeners import UDPListener
 
@@ -29,6 +32,25 @@ SSDP_PORT = UPnPDefaults.SSDP_PORT
 
 log = log.getLogger('upnp.ssdp')
 
+_max_age_re = re.compile(r'max-age\s*=\s*(\d+)', re.I)
+
+
+def parse_max_age(cache_control, default=1800):
+    """ Returns the max-age value of a CACHE-CONTROL header.
+
+    @param cache_control: CACHE-CONTROL header value
+    @param default: value returned if max-age is missing or invalid
+
+    @type cache_control: string
+    @type default: integer
+
+    @rtype: integer
+    """
+    m = _max_age_re.search(cache_control or '')
+    if m:
+        return int(m.group(1))
+    return default
+
 
 class SSDPServer(object):
     """ Implementation of a SSDP server.
@@ -41,18 +63,24 @@ class SSDPServer(object):
     msg_already_stopped = 'tried to stop() SSDPServer when already stopped'
 
     def __init__(self, server_name, xml_description_filename, max_age=1800,
-                receive_notify=True, udp_listener=''):
+                receive_notify=True, udp_listener='', host_rate_limit=100,
+                host_rate_interval=1.0):
         """ Constructor for the SSDPServer class.
 
         @param server_name: server name
         @param xml_description_filename: XML description filename
         @param max_age: max age parameter, default 1800.
         @param receive_notify: if False, ignores notify messages
+        @param host_rate_limit: max datagrams processed per source host in
+                                host_rate_interval, 0 disables the limit
+        @param host_rate_interval: rate limit window in seconds
 
         @type server_name: string
         @type xml_description_filename:
         @type max_age: integer
         @type receive_notify: boolean
+        @type host_rate_limit: integer
+        @type host_rate_interval: float
         """
         self.server_name = server_name
         self.xml_description_filename = xml_description_filename
@@ -62,6 +90,13 @@ class SSDPServer(object):
         self.running = False
         self.known_device = {}
         self.advertised = {}
+        self.host_rate_limit = host_rate_limit
+        self.host_rate_interval = host_rate_interval
+        self.counters = {'seen': 0, 'dropped': 0, 'processed': 0}
+        # usn -> (expiry time, location) of remote announcements
+        self._usn_cache = {}
+        # host -> [window start, datagrams processed in window]
+        self._host_rates = {}
         self._callbacks = {}
         self.udp_transport = UDPTransport()
         if udp_listener == '':
@@ -118,6 +153,7 @@ class SSDPServer(object):
         """ Clears the device list.
         """
         self.known_device.clear()
+        self._usn_cache.clear()
 
     def discovered_device_failed(self, dev):
         """ Device could not be fully built, so forget it.
@@ -125,6 +161,15 @@ class SSDPServer(object):
         usn = dev['USN']
         if usn in self.known_device:
             self.known_device.pop(usn)
+        self._usn_cache.pop(usn, None)
+
+    def get_counters(self):
+        """ Returns a copy of the datagram counters (seen, dropped and
+        processed).
+
+        @rtype: dictionary
+        """
+        return dict(self.counters)
 
     def is_known_device(self, usn):
         """ Returns if the device with the passed usn is already known.
@@ -192,19 +237,34 @@ class SSDPServer(object):
         @type port: integer
         """
         log.debug("SSDP._datagram_received host: %s, port: %s\ndata: %s", host, port, data)
-        try:
-            header, payload = data.split('\r\n\r\n')
-        except ValueError, err:
-            log.error('Error while receiving datagram packet: %s', str(err))
+        self.counters['seen'] += 1
+        header, sep, payload = data.partition('\r\n\r\n')
+        if not sep:
+            log.error('Error while receiving datagram packet: no header end')
+            self.counters['dropped'] += 1
+            return
+
+        first, sep, rest = header.partition('\r\n')
+        cmd = first.split(' ')
+        if len(cmd) < 2:
+            log.error('Error while receiving datagram packet: bad request '\
+                      'line %r', first)
+            self.counters['dropped'] += 1
+            return
+
+        headers = parse_http_headers(rest)
+
+        if cmd[0] == 'NOTIFY' and self._is_cached_notify(headers):
+            # Unchanged re-announcement of a known device
+            self.counters['dropped'] += 1
             return
 
-        lines = header.split('\r\n')
-        cmd = lines[0].split(' ')
-        lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
-        lines = filter(lambda x: len(x) > 0, lines)
+        if not self._check_host_rate(host):
+            log.debug('Rate limit reached for %s, datagram dropped', host)
+            self.counters['dropped'] += 1
+            return
 
-        headers = [x.split(':', 1) for x in lines]
-        headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+        self.counters['processed'] += 1
 
         if cmd[0] == 'M-SEARCH' and cmd[1] == '*':
 #        if cmd[0] == 'M-SEARCH' and cmd[1] == '*' \
@@ -226,6 +286,45 @@ class SSDPServer(object):
             log.warning('Received unknown SSDP command %s with headers %s '\
                         'from %s:%s', cmd, str(headers), host, port)
 
+    def _is_cached_notify(self, headers):
+        """ Returns True if the headers are an ssdp:alive for an USN that is
+        already known, has not expired and has not moved to another location.
+        Expired entries have their expiry time refreshed by _notify_received.
+
+        @param headers: notify headers
+        @type headers: dictionary
+
+        @rtype: boolean
+        """
+        if headers.get('nts') != 'ssdp:alive':
+            return False
+        entry = self._usn_cache.get(headers.get('usn'))
+        if entry is None:
+            return False
+        expires, location = entry
+        return expires > time() and location == headers.get('location')
+
+    def _check_host_rate(self, host):
+        """ Returns False if the host has exceeded the allowed number of
+        datagrams in the current rate limit window.
+
+        @param host: datagram source host
+        @type host: string
+
+        @rtype: boolean
+        """
+        if not self.host_rate_limit:
+            return True
+        now = time()
+        rate = self._host_rates.get(host)
+        if rate is None or now - rate[0] >= self.host_rate_interval:
+            self._host_rates[host] = [now, 1]
+            return True
+        if rate[1] >= self.host_rate_limit:
+            return False
+        rate[1] += 1
+        return True
+
     def _discovery_request(self, headers, (host, port)):
         """ Processes discovery requests and responds accordingly.
 
@@ -294,12 +393,21 @@ class SSDPServer(object):
         
             if 'cache-control' not in headers:
                 headers['cache-control'] = 'max-age=1800'
-            try:
-                self.known_device[headers['usn']]
-            except KeyError:
-                self._register(headers['usn'], headers['nt'],
+            usn = headers['usn']
+            known = self.known_device.get(usn)
+            if known is not None and \
+               known['LOCATION'] != headers['location']:
+                # Device came back on another address, rebuild it
+                log.debug('Location changed for %s', usn)
+                self._unregister(usn)
+                known = None
+            if known is None:
+                self._register(usn, headers['nt'],
                                headers['location'], headers['server'],
                                headers['cache-control'])
+            else:
+                self._cache_usn(usn, headers['location'],
+                                headers['cache-control'])
         elif headers['nts'] == 'ssdp:byebye':
             if self.is_known_device(headers['usn']):
                 self._unregister(headers['usn'])
@@ -335,6 +443,7 @@ class SSDPServer(object):
 
         if where == 'remote':
             d = self.known_device
+            self._cache_usn(usn, location, cache_control)
         elif where == 'local':
             d = self.advertised
 
@@ -351,6 +460,13 @@ class SSDPServer(object):
         
             self._callback("new_device_event", st, self.known_device[usn])
 
+    def _cache_usn(self, usn, location, cache_control):
+        """ Records a remote announcement so that repeats are dropped until
+        its max-age expires.
+        """
+        self._usn_cache[usn] = (time() + parse_max_age(cache_control),
+                                location)
+
     def _local_register(self, usn, st, location, server, cache_control):
         """ Registers locally a new service or device.
         """
@@ -402,6 +518,7 @@ class SSDPServer(object):
 
     def _unregister(self, usn):
         log.debug("Unregistering %s", usn)
+        self._usn_cache.pop(usn, None)
 
         try:
             self._callback("removed_device_event", self.known_device[usn])
@@ -462,3 +579,4 @@ class SSDPServer(object):
         """ Cleans the SSDPServer by removing known devices and internal cache.
         """
         self.clear_device_list()
+        self._host_rates.clear()
@@ -0,0 +1,326 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Browse results for the web UI.
+#
+# The results of each browse the web UI makes are kept as a number of sets,
+# one per window of data the UI asks for (keyed by ref:sequence). Once the
+# sets held add up to more than max_bytes the least recently used complete
+# ones are dropped, along with the records in them. The source of each
+# browse is kept, so that an evicted set (or an entry in one) can be
+# browsed again when it is next asked for.
+
+import threading
+
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+# allowance for the objects holding a record, added to its string lengths
+RECORD_OVERHEAD = 200
+# number of browse sources kept
+MAX_SOURCES = 1000
+
+class BrowseRecord(object):
+    '''
+    An entry returned by a browse. ref, entryclass, menu and title make up
+    the key the web UI passes back for it, id and type are what it was
+    browsed as.
+    '''
+
+    __slots__ = ('ref', 'entryclass', 'menu', 'title', 'id', 'type', 'parentid',
+                 'search', 'searchtitle', 'operators', 'extras', 'res', 'xml')
+
+    def __init__(self, ref, entryclass, menu, title, id, type, parentid=None,
+                 search=None, searchtitle=None, operators=None, extras=None, res=None, xml=None):
+        self.ref = ref
+        self.entryclass = entryclass
+        self.menu = menu
+        self.title = title
+        self.id = id
+        self.type = type
+        self.parentid = parentid
+        self.search = search
+        self.searchtitle = searchtitle
+        self.operators = operators
+        self.extras = extras
+        self.res = res
+        self.xml = xml
+
+    def key(self):
+        return self.ref + '::' + self.entryclass + '::' + self.menu + '::' + self.title
+
+    def size(self):
+        size = RECORD_OVERHEAD
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, basestring):
+                size += len(value)
+        return size
+
+class BrowseSet(object):
+    '''
+    The records for a window of a browse. complete is None while the
+    browse is filling the set, (returned, total) once it has and False if
+    it won't be.
+    '''
+
+    __slots__ = ('records', 'size', 'complete')
+
+    def __init__(self, complete=None):
+        self.records = []
+        self.size = 0
+        self.complete = complete
+
+class BrowseSource(object):
+    '''
+    What a browse was made for, so that it can be made again, and the
+    index of the last record it returned.
+    '''
+
+    __slots__ = ('type', 'id', 'searchstring', 'searchoperator', 'name', 'count', 'lastindex', 'evicted')
+
+    def __init__(self, type=None, id=None, searchstring='', searchoperator='', name='', count=-1):
+        self.type = type
+        self.id = id
+        self.searchstring = searchstring
+        self.searchoperator = searchoperator
+        self.name = name
+        self.count = count
+        self.lastindex = 0
+        self.evicted = set()
+
+class BrowseStore(object):
+    '''
+    The browse sets, the records in them (indexed by ref) and the browse
+    sources, holding no more than about max_bytes of records. Waiters for a
+    set to be filled use condition, which guards the store.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sets = OrderedDict()
+        self.sources = OrderedDict()
+        self.refs = {}
+        self.parents = {}
+        self.condition = threading.Condition(threading.RLock())
+
+    def start_browse(self, setparent, source):
+        '''
+        Records the source of a new browse of setparent, dropping the sets
+        of any previous one.
+        '''
+        self.condition.acquire()
+        try:
+            prefix = setparent + ':'
+            for setkey in self.sets.keys():
+                if setkey.startswith(prefix):
+                    self._drop(setkey)
+            self.sources.pop(setparent, None)
+            self.sources[setparent] = source
+            while len(self.sources) > MAX_SOURCES:
+                self.sources.popitem(last=False)
+        finally:
+            self.condition.release()
+
+    def get_source(self, setparent):
+        self.condition.acquire()
+        try:
+            return self.sources.get(setparent)
+        finally:
+            self.condition.release()
+
+    def next_ref(self, setparent):
+        '''
+        Returns the ref for the next record of the browse of setparent.
+        '''
+        self.condition.acquire()
+        try:
+            source = self.sources.get(setparent)
+            if source == None:
+                # not started by start_browse, so can't be browsed again
+                source = BrowseSource()
+                self.sources[setparent] = source
+            source.lastindex += 1
+            return setparent + '_' + str(source.lastindex)
+        finally:
+            self.condition.release()
+
+    def new_set(self, setkey):
+        '''
+        Starts filling the set setkey (replacing any previous one).
+        '''
+        self.condition.acquire()
+        try:
+            self._drop(setkey)
+            self.sets[setkey] = BrowseSet()
+            setparent, sequence = setkey.split(':')
+            source = self.sources.get(setparent)
+            if source != None:
+                source.evicted.discard(int(sequence))
+        finally:
+            self.condition.release()
+
+    def add_record(self, setkey, record):
+        '''
+        Adds record to the set setkey. If the set isn't being filled it is
+        created complete, so that it can be evicted.
+        '''
+        self.condition.acquire()
+        try:
+            browseset = self.sets.get(setkey)
+            if browseset == None:
+                browseset = BrowseSet(False)
+                self.sets[setkey] = browseset
+            size = record.size()
+            browseset.records.append(record)
+            browseset.size += size
+            self.size += size
+            self.refs[record.ref] = record
+            if record.parentid != None:
+                self.parents[record.id] = record
+            if browseset.complete != None:
+                self._touch(setkey)
+                self._evict()
+        finally:
+            self.condition.release()
+
+    def complete_set(self, setkey, complete):
+        '''
+        Marks the set setkey as filled with complete (or as not going to
+        be, if complete is False), then evicts sets if the store is full.
+        '''
+        self.condition.acquire()
+        try:
+            browseset = self.sets.get(setkey)
+            if browseset != None:
+                browseset.complete = complete
+                self._touch(setkey)
+            self._evict()
+        finally:
+            self.condition.release()
+
+    def abandon_sets(self, setparent):
+        '''
+        Marks the sets of setparent still being filled as not going to be.
+        '''
+        self.condition.acquire()
+        try:
+            prefix = setparent + ':'
+            for setkey, browseset in self.sets.items():
+                if setkey.startswith(prefix) and browseset.complete == None:
+                    browseset.complete = False
+            self._evict()
+        finally:
+            self.condition.release()
+
+    def get_set(self, setkey):
+        '''
+        Returns the set setkey, or None if it hasn't been started or has
+        been evicted.
+        '''
+        self.condition.acquire()
+        try:
+            browseset = self.sets.get(setkey)
+            if browseset != None:
+                self._touch(setkey)
+            return browseset
+        finally:
+            self.condition.release()
+
+    def was_evicted(self, setkey):
+        self.condition.acquire()
+        try:
+            setparent, sequence = setkey.split(':')
+            source = self.sources.get(setparent)
+            return source != None and int(sequence) in source.evicted
+        finally:
+            self.condition.release()
+
+    def find(self, key):
+        '''
+        Returns the record with key, or None if there isn't one.
+        '''
+        self.condition.acquire()
+        try:
+            record = self.refs.get(key.split('::')[0])
+            if record == None or record.key() != key:
+                return None
+            return record
+        finally:
+            self.condition.release()
+
+    def parent_id(self, id):
+        '''
+        Returns the id of the container the record with id was browsed
+        from, or None if not known.
+        '''
+        self.condition.acquire()
+        try:
+            record = self.parents.get(id)
+            if record == None:
+                return None
+            return record.parentid
+        finally:
+            self.condition.release()
+
+    def clear(self):
+        self.condition.acquire()
+        try:
+            self.sets.clear()
+            self.sources.clear()
+            self.refs.clear()
+            self.parents.clear()
+            self.size = 0
+        finally:
+            self.condition.release()
+
+    def _touch(self, setkey):
+        # called with condition held, make setkey most recently used
+        self.sets[setkey] = self.sets.pop(setkey)
+
+    def _drop(self, setkey):
+        # called with condition held
+        browseset = self.sets.pop(setkey, None)
+        if browseset == None:
+            return
+        self.size -= browseset.size
+        for record in browseset.records:
+            if self.refs.get(record.ref) is record:
+                del self.refs[record.ref]
+            if self.parents.get(record.id) is record:
+                del self.parents[record.id]
+
+    def _evict(self):
+        # called with condition held, drop the least recently used sets that
+        # aren't being filled until the store fits (keeping the most recently
+        # used one even if it doesn't)
+        if self.size <= self.max_bytes:
+            return
+        for setkey, browseset in self.sets.items()[:-1]:
+            if self.size <= self.max_bytes:
+                break
+            if browseset.complete == None:
+                continue
+            self._drop(setkey)
+            setparent, sequence = setkey.split(':')
+            source = self.sources.get(setparent)
+            if source != None:
+                source.evicted.add(int(sequence))
@@ -0,0 +1,216 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Title to container ID maps for proxied servers.
+#
+# In Cache translation mode the proxy remembers the IDs of the containers a
+# proxied server returns (artists, albums, genres...) so that later Sonos
+# searches by title can be translated into searches of those containers.
+# Each map keeps its most recently used entries and is saved in a small
+# SQLite database, so the maps survive a restart. The maps for a server are
+# cleared when its SystemUpdateID changes.
+
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+from brisa.core import log
+
+DEFAULT_MAX_ENTRIES = 10000
+
+class ContainerMap(object):
+    '''
+    A title -> container ID map holding the max_entries most recently used
+    titles. Changes are saved by ContainerCache.flush().
+    '''
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.entries = OrderedDict()
+
+    def __getitem__(self, title):
+        self.cache._lock.acquire()
+        try:
+            # a lookup only moves the title to the end in memory, the saved
+            # entries are changed when titles are added, updated or evicted
+            containerid = self.entries.pop(title)
+            self.entries[title] = containerid
+            return containerid
+        finally:
+            self.cache._lock.release()
+
+    def __setitem__(self, title, containerid):
+        self.cache._lock.acquire()
+        try:
+            oldid = self.entries.pop(title, None)
+            self.entries[title] = containerid
+            if containerid != oldid:
+                self.cache._changed(self.name, title, containerid)
+            while len(self.entries) > self.cache.max_entries:
+                oldtitle, oldid = self.entries.popitem(last=False)
+                self.cache._changed(self.name, oldtitle, None)
+        finally:
+            self.cache._lock.release()
+
+    def __contains__(self, title):
+        return title in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, title, default=None):
+        try:
+            return self[title]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self.cache._lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.cache._lock.release()
+
+class ContainerCache(object):
+    '''
+    The container maps for the server with UDN server, saved in the SQLite
+    database at path.
+    '''
+
+    def __init__(self, path, server, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.server = server
+        self.max_entries = max_entries
+        self.maps = {}
+        self.updateid = None
+        self._dirty = {}
+        self._seq = 0
+        self._lock = threading.RLock()
+        db = self._connect()
+        if db == None:
+            return
+        try:
+            row = db.execute("select updateid from servers where server=?", (self.server, )).fetchone()
+            if row != None:
+                self.updateid = row[0]
+            self._seq, = db.execute("select ifnull(max(used), 0) from containers where server=?", (self.server, )).fetchone()
+        except sqlite3.Error, e:
+            log.error("Error reading container cache: %s" % e.args[0])
+        db.close()
+
+    def _connect(self):
+        try:
+            db = sqlite3.connect(self.path)
+            db.execute("create table if not exists servers (server text primary key, updateid text)")
+            db.execute("create table if not exists containers (server text, map text, title text, containerid text, used integer, primary key (server, map, title))")
+            return db
+        except sqlite3.Error, e:
+            log.error("Error opening container cache %s: %s" % (self.path, e.args[0]))
+            return None
+
+    def get_map(self, name):
+        '''
+        Returns the map called name, loaded with its saved entries.
+        '''
+        self._lock.acquire()
+        try:
+            if name in self.maps:
+                return self.maps[name]
+            map = ContainerMap(self, name)
+            self.maps[name] = map
+        finally:
+            self._lock.release()
+        db = self._connect()
+        if db == None:
+            return map
+        try:
+            rows = db.execute("select title, containerid from containers where server=? and map=? order by used desc limit ?", (self.server, name, self.max_entries)).fetchall()
+            rows.reverse()
+            self._lock.acquire()
+            try:
+                for title, containerid in rows:
+                    map.entries[title] = containerid
+            finally:
+                self._lock.release()
+        except sqlite3.Error, e:
+            log.error("Error reading container cache: %s" % e.args[0])
+        db.close()
+        return map
+
+    def set_updateid(self, updateid):
+        '''
+        Records the server's SystemUpdateID. If it isn't the one the maps
+        were filled under they are cleared. Returns True if they were.
+        '''
+        updateid = str(updateid)
+        if updateid == self.updateid:
+            return False
+        self._lock.acquire()
+        try:
+            cleared = self.updateid != None
+            for map in self.maps.values():
+                map.entries.clear()
+            self._dirty.clear()
+            self.updateid = updateid
+        finally:
+            self._lock.release()
+        db = self._connect()
+        if db != None:
+            try:
+                db.execute("delete from containers where server=?", (self.server, ))
+                db.execute("insert or replace into servers values (?, ?)", (self.server, updateid))
+                db.commit()
+            except sqlite3.Error, e:
+                log.error("Error clearing container cache: %s" % e.args[0])
+            db.close()
+        return cleared
+
+    def flush(self):
+        '''
+        Saves the entries added, updated or evicted since the last flush.
+        '''
+        self._lock.acquire()
+        try:
+            dirty = self._dirty
+            self._dirty = {}
+        finally:
+            self._lock.release()
+        if not dirty:
+            return
+        db = self._connect()
+        if db == None:
+            return
+        try:
+            for (name, title), (containerid, used) in dirty.iteritems():
+                if containerid == None:
+                    db.execute("delete from containers where server=? and map=? and title=?", (self.server, name, title))
+                else:
+                    db.execute("insert or replace into containers values (?, ?, ?, ?, ?)", (self.server, name, title, containerid, used))
+            db.commit()
+        except sqlite3.Error, e:
+            log.error("Error saving container cache: %s" % e.args[0])
+        db.close()
+
+    def _changed(self, name, title, containerid):
+        # called with _lock held, containerid None for an evicted title
+        self._seq += 1
+        self._dirty[(name, title)] = (containerid, self._seq)
@@ -1,4 +1,7 @@
 import os
+import cgi
+import zlib
+import json
 from brisa.core import webserver
 from brisa.core import log
 from xml.sax.saxutils import unescape
@@ -166,6 +169,60 @@ class PollQueueController(webserver.CustomResource):
         response.status = 200
         return response.body
 
+class JSONDataController(webserver.CustomResource):
+    '''
+    Serves the dict getter returns for the query parameters as JSON,
+    gzipped if the client accepts it (or asks for it with gzip=1).
+    '''
+
+    def __init__(self, name, getter):
+        self.getter = getter
+        webserver.CustomResource.__init__(self, name)
+
+    def render(self, uri, request, response):
+#        print "request.query: " + str(request.query)
+        params = {}
+        for k, v in cgi.parse_qsl(request.query, keep_blank_values=True):
+            params[k] = v.decode('utf-8', 'replace')
+        data = self.getter(params)
+        compress = params.get('gzip') == '1' or 'gzip' in request.headers.get('Accept-Encoding', '')
+        response.headers['Content-type'] = 'application/json'
+        if compress:
+            response.headers['Content-encoding'] = 'gzip'
+        response.status = 200
+        response.body = json_chunks(data, compress)
+        return response.body
+
+# number of items serialised per chunk of a streamed response
+json_chunk_items = 500
+
+def json_chunks(data, compress=False):
+    # serialise data, streaming any items list in chunks so that large
+    # browse windows aren't built up as one string
+    if compress:
+        gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in json_chunks(data):
+            chunk = gz.compress(chunk)
+            if chunk:
+                yield chunk
+        yield gz.flush()
+        return
+    items = data.get('items')
+    if items == None:
+        yield json.dumps(data)
+        return
+    head = dict((k, v) for k, v in data.iteritems() if k != 'items')
+    prefix = json.dumps(head)[:-1]
+    if head:
+        prefix += ', '
+    yield prefix + '"items": ['
+    for i in range(0, len(items), json_chunk_items):
+        chunk = json.dumps(items[i:i+json_chunk_items])[1:-1]
+        if i > 0:
+            chunk = ', ' + chunk
+        yield chunk
+    yield ']}'
+
 def make_utf8(list):
     dt = []
     for e in list:
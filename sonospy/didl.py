@@ -0,0 +1,193 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# DIDL-Lite track items, shared by the proxy and movetags.
+#
+# movetags stores a pre-escaped item for each track in the TrackItems table
+# so the proxy doesn't have to rebuild it from the track fields on every
+# Browse/Search. The only values left to fill in are the ones that belong
+# to the running proxy:
+#     %(proxyaddress)s  - the address the proxy serves files from
+#     %(dbname)s        - the database the proxy was started with
+# Any other % in an item is escaped as %%.
+#
+# Items depend on the artist/art settings from the [INI] section of
+# pycpoint.ini, so each row carries the key of the settings it was built
+# with and the proxy only uses rows that match its own.
+
+import ConfigParser
+
+from xml.sax.saxutils import escape
+
+from transcode import checktranscode
+
+MULTI_SEPARATOR = '\n'
+
+# tracks columns needed to build an item, in make_track_item order
+TRACK_ITEM_COLUMNS = 'id, parentID, title, artist, album, tracknumber, albumartist, codec, length, filename, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, upnpclass, folderartid, trackartid'
+
+def get_item_options(config):
+    '''
+    Returns the pycpoint.ini [INI] settings that change the content of a
+    track item, defaulted and checked the same way the proxy does:
+    (now_playing_artist, now_playing_artist_combiner, mouseover_artist,
+     mouseover_artist_combiner, prefer_folderart)
+    '''
+    options = []
+    for name in ['now_playing_artist', 'mouseover_artist']:
+        entrytype = 'all'
+        try:
+            entrytype = config.get('INI', name).lower()
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        if not entrytype in ['all', 'first', 'last']: entrytype = 'all'
+        combiner = '/'
+        try:
+            combiner = config.get('INI', name + '_combiner')
+            if combiner.startswith("'") and combiner.endswith("'"):
+                combiner = combiner[1:-1]
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        options += [entrytype, combiner]
+    prefer_folderart = False
+    try:
+        if config.get('INI', 'prefer_folderart').lower() == 'y':
+            prefer_folderart = True
+    except ConfigParser.NoSectionError:
+        pass
+    except ConfigParser.NoOptionError:
+        pass
+    options.append(prefer_folderart)
+    return tuple(options)
+
+def item_options_key(options):
+    return '\t'.join([unicode(o) for o in options])
+
+def make_track_item(row, options):
+    '''
+    Builds the TrackItems values for a row of TRACK_ITEM_COLUMNS:
+    (id, options key, item, browseitem, filetype, transcodetype,
+     contenttype, cover, artid)
+
+    item uses the now playing artist setting for the performer, browseitem
+    the mouseover setting - browseitem is None when they are the same.
+    filetype is the extension the proxy serves the file as (the transcoded
+    type if it needs transcoding, in which case transcodetype is set).
+    '''
+    id, parentID, title, artist, album, tracknumber, albumartist, codec, length, filename, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, upnpclass, folderartid, trackartid = row
+    now_playing_artist, now_playing_artist_combiner, mouseover_artist, mouseover_artist_combiner, prefer_folderart = options
+
+    contenttype = fixMime(mime)
+    cover, artid = choosecover(folderart, trackart, folderartid, trackartid, prefer_folderart)
+    filetype = getFileType(filename)
+    transcode, newtype = checktranscode(filetype, bitrate, samplerate, bitspersample, channels, codec)
+    if transcode:
+        filetype = newtype
+    else:
+        newtype = None
+
+    res = '%(proxyaddress)s/WMPNSSv3/%(dbname)s.' + (id + '.' + filetype).replace('%', '%%')
+    duration = maketime(float(length))
+    protocol = getProtocol(contenttype)
+
+    if title == '': title = '[unknown title]'
+    if albumartist == '': albumartist = '[unknown albumartist]'
+    else: albumartist = get_artist(albumartist, now_playing_artist, now_playing_artist_combiner)
+    if album == '': album = '[unknown album]'
+    tracknumber = convert_tracknumber(tracknumber)
+
+    head = '<item id="%s" parentID="%s" restricted="true">' % (id, parentID)
+    head += '<dc:title>%s</dc:title>' % (escape(title))
+    head += '<upnp:artist role="AlbumArtist">%s</upnp:artist>' % (escape(albumartist))
+    tail = '<upnp:album>%s</upnp:album>' % (escape(album))
+    if tracknumber != 0:
+        tail += '<upnp:originalTrackNumber>%s</upnp:originalTrackNumber>' % (tracknumber)
+    tail += '<upnp:class>%s</upnp:class>' % (upnpclass)
+    head = head.replace('%', '%%')
+    tail = tail.replace('%', '%%')
+    tail += '<res duration="%s" protocolInfo="%s">%s</res>' % (duration, protocol.replace('%', '%%'), res)
+    tail += '</item>'
+
+    items = []
+    for entrytype, combiner in [(now_playing_artist, now_playing_artist_combiner), (mouseover_artist, mouseover_artist_combiner)]:
+        if artist == '': performer = '[unknown artist]'
+        else: performer = get_artist(artist, entrytype, combiner)
+        performer = '<upnp:artist role="Performer">%s</upnp:artist>' % (escape(performer))
+        items.append(head + performer.replace('%', '%%') + tail)
+    item, browseitem = items
+    if browseitem == item:
+        browseitem = None
+
+    return (id, item_options_key(options), item, browseitem, filetype, newtype, contenttype, cover, artid)
+
+def choosecover(folderart, trackart, folderartid, trackartid, prefer_folderart):
+    if trackart and trackart != '' and not (folderart and folderart != '' and prefer_folderart):
+        return trackart, trackartid
+    elif folderart and folderart != '':
+        return folderart, folderartid
+    else:
+        return '', ''
+
+def get_artist(artist, entrytype, combiner):
+    artistlist = artist.split(MULTI_SEPARATOR)
+    if entrytype == 'all':
+        return combiner.join(artistlist)
+    elif entrytype == 'first':
+        return artistlist[0]
+    elif entrytype == 'last':
+        return artistlist[-1]
+
+def convert_tracknumber(tracknumber):
+    if type(tracknumber) == unicode: tracknumber = 0
+    return tracknumber
+
+def maketime(seconds):
+    if int(seconds) == 0:
+        return "00:00:00.000"
+    h = int(seconds / 3600)
+    seconds -= h * 3600
+    m = int(seconds / 60)
+    seconds -= m * 60
+    s = seconds
+    return '%d:%02d:%02d.000' % (h,m,s)
+
+def fixMime(mime):
+    if mime == 'audio/x-flac':
+        mime = 'audio/flac'
+    elif mime == 'audio/vorbis':
+        mime = 'application/ogg'
+
+
+    elif mime == 'audio/mp3':
+        mime = 'audio/mpeg'
+
+
+    return mime
+
+def getProtocol(mime):
+#    return 'http-get:*:%s:*' % mime
+    return 'http-get:*:%s:%s' % (mime, 'DLNA.ORG_PN=MP3;DLNA.ORG_OP=01;DLNA.ORG_CI=0')
+
+def getFileType(filename):
+    return filename.split('.')[-1]
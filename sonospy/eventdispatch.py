@@ -0,0 +1,224 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Ordered processing of UPnP events, shared by pycpoint and playcounts.
+#
+# The thread that receives a NOTIFY just queues the event. Events are
+# processed by a small pool of worker threads, each subscription (SID)
+# always going to the same worker so its events are processed one at a
+# time. When a worker gets to a SID it takes all its queued events, puts
+# them in SEQ order, drops those superseded by a later queued event (one
+# changing the same variables) and those older than an event already
+# processed, then processes the rest. Events with SEQ -1 (dummy events
+# made up by pycpoint) are processed in the order they were queued.
+#
+# Only events whose variables all hold the whole of a state (LastChange and
+# STATE_VARIABLES) are ever dropped. Other variables, such as
+# ContainerUpdateIDs, only list what changed since the previous event, so
+# every event with them is processed.
+
+import threading
+import time
+
+from brisa.core import log
+
+from lastchange import parse_lastchange
+
+# processing events this many seconds after they were queued is logged
+DEFAULT_LAG_WARNING = 2.0
+
+# evented variables whose value is the whole of a state, so a later value
+# makes an earlier one redundant
+STATE_VARIABLES = set(['TransportState', 'Volume', 'Mute', 'ZoneGroupState',
+                       'ThirdPartyMediaServers'])
+
+def droppable(changed_vars):
+    '''
+    Returns True if changed_vars only has LastChange and state variables,
+    so the event can be dropped when a later one changes them all.
+    '''
+    for name in changed_vars.keys():
+        if name != 'LastChange' and not name in STATE_VARIABLES:
+            return False
+    return True
+
+def lastchange_variables(lastchange):
+    '''
+    Returns the set of variables (with their channel, if any) a LastChange
+    event changes.
+    '''
+    return set(parse_lastchange(lastchange, '', channels=True))
+
+def supersedes(new, old):
+    '''
+    Returns True if the changed variables new make those in old redundant,
+    i.e. old can be dropped and new changes all of them (and all the
+    variables in a LastChange).
+    '''
+    if not droppable(old):
+        return False
+    for name, value in old.iteritems():
+        if not name in new:
+            return False
+        if name == 'LastChange' and value != new[name]:
+            if value == None or new[name] == None:
+                return False
+            try:
+                if not lastchange_variables(value) <= lastchange_variables(new[name]):
+                    return False
+            except SyntaxError:
+                return False
+    return True
+
+class EventWorker(object):
+    '''
+    A thread processing the queued events of the SIDs assigned to it.
+    '''
+
+    def __init__(self, dispatcher, name):
+        self.dispatcher = dispatcher
+        self.condition = threading.Condition()
+        # SID -> [(seq, queued time, changed_vars)], and the SIDs in the
+        # order they have events waiting
+        self.pending = {}
+        self.ready = []
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, sid, seq, changed_vars):
+        self.condition.acquire()
+        try:
+            if not sid in self.pending:
+                self.pending[sid] = []
+                self.ready.append(sid)
+            self.pending[sid].append((seq, time.time(), changed_vars))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.ready:
+                    self.condition.wait()
+                sid = self.ready.pop(0)
+                events = self.pending.pop(sid)
+            finally:
+                self.condition.release()
+            for seq, queued, changed_vars in self.dispatcher.order(sid, events):
+                self.dispatcher.process(sid, seq, queued, changed_vars)
+
+class EventDispatcher(object):
+    '''
+    Queues events for handler(sid, seq, changed_vars), called on one of
+    workers threads.
+    '''
+
+    def __init__(self, handler, workers=1, lag_warning=DEFAULT_LAG_WARNING, name='events'):
+        self.handler = handler
+        self.lag_warning = lag_warning
+        # highest SEQ processed for each (SID, variable)
+        self.last_seq = {}
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.workers = [EventWorker(self, '%s-%d' % (name, i)) for i in range(max(workers, 1))]
+
+    def put(self, sid, seq, changed_vars):
+        '''
+        Queues an event, called on the thread that received it.
+        '''
+        worker = self.workers[hash(sid) % len(self.workers)]
+        worker.put(sid, int(seq), changed_vars)
+
+    def forget(self, sid=None):
+        '''
+        Forgets the SEQs processed for sid, or for all SIDs if sid is None
+        (e.g. when the subscriptions are replaced).
+        '''
+        self.lock.acquire()
+        try:
+            for key in self.last_seq.keys():
+                if sid == None or key[0] == sid:
+                    del self.last_seq[key]
+        finally:
+            self.lock.release()
+
+    def order(self, sid, events):
+        # put runs of events between dummy events in SEQ order, without those
+        # a later event in the run supersedes
+        ordered = []
+        run = []
+        for event in events + [None]:
+            if event != None and event[0] != -1:
+                run.append(event)
+                continue
+            run.sort(key=lambda e: e[0])
+            for i in range(len(run)):
+                if self.superseded(run[i], run[i+1:]):
+                    self.dropped += 1
+                else:
+                    ordered.append(run[i])
+            run = []
+            if event != None:
+                ordered.append(event)
+        return ordered
+
+    def superseded(self, event, later):
+        for e in later:
+            if supersedes(e[2], event[2]):
+                return True
+        return False
+
+    def process(self, sid, seq, queued, changed_vars):
+        if seq != -1 and droppable(changed_vars):
+            # don't process events that are older than ones already processed
+            self.lock.acquire()
+            try:
+                for k in changed_vars.keys():
+                    if self.last_seq.get((sid, k), -1) > seq:
+                        self.dropped += 1
+                        return
+                for k in changed_vars.keys():
+                    self.last_seq[(sid, k)] = seq
+            finally:
+                self.lock.release()
+        lag = time.time() - queued
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.processed += 1
+        if lag >= self.lag_warning:
+            log.info('Event seq %s for %s processed %.1fs after it arrived' % (seq, sid, lag))
+        try:
+            self.handler(sid, seq, changed_vars)
+        except Exception, e:
+            log.error('Error processing event seq %s for %s: %s' % (seq, sid, e))
+
+    def stats(self):
+        '''
+        Returns the events processed and dropped, and the lag (seconds from
+        queueing to processing) of the last one and the most seen.
+        '''
+        return {'processed': self.processed, 'dropped': self.dropped,
+                'last_lag': self.last_lag, 'max_lag': self.max_lag}
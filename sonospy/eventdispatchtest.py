@@ -0,0 +1,63 @@
+#
+# Checks of which queued events eventdispatch.py drops: delta valued
+# ContainerUpdateIDs events must all be processed, LastChange and state
+# events can be superseded by a later one.
+#
+# usage: python eventdispatchtest.py
+#
+
+import threading
+
+from eventdispatch import EventDispatcher, supersedes
+
+RCS_EVENT = '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/RCS/"><InstanceID val="0"><Volume channel="Master" val="%s"/></InstanceID></Event>'
+
+def dispatch(events):
+    '''
+    Queues events (seq, changed_vars) for one SID before the worker gets to
+    them, returns the (seq, changed_vars) processed.
+    '''
+    processed = []
+    done = threading.Event()
+    def handler(sid, seq, changed_vars):
+        if changed_vars == None:
+            done.set()
+        else:
+            processed.append((seq, changed_vars))
+    dispatcher = EventDispatcher(handler)
+    worker = dispatcher.workers[0]
+    # hold the worker until all the events are queued
+    worker.condition.acquire()
+    try:
+        for seq, changed_vars in events:
+            worker.put('uuid:1', seq, changed_vars)
+    finally:
+        worker.condition.release()
+    worker.put('uuid:1', -1, None)
+    done.wait(5)
+    return processed
+
+def test_container_updates():
+    queue = {'SystemUpdateID': '89', 'ContainerUpdateIDs': 'Q:0,72'}
+    shares = {'SystemUpdateID': '90', 'ContainerUpdateIDs': 'S:,5'}
+    assert not supersedes(shares, queue)
+    processed = dispatch([(1, queue), (2, shares)])
+    assert processed == [(1, queue), (2, shares)], processed
+
+def test_container_updates_out_of_order():
+    queue = {'SystemUpdateID': '89', 'ContainerUpdateIDs': 'Q:0,72'}
+    shares = {'SystemUpdateID': '90', 'ContainerUpdateIDs': 'S:,5'}
+    processed = dispatch([(2, shares), (1, queue)])
+    assert processed == [(1, queue), (2, shares)], processed
+
+def test_lastchange_superseded():
+    old = {'LastChange': RCS_EVENT % '20'}
+    new = {'LastChange': RCS_EVENT % '25'}
+    assert supersedes(new, old)
+    processed = dispatch([(1, old), (2, new)])
+    assert processed == [(2, new)], processed
+
+if __name__ == '__main__':
+    for test in [test_container_updates, test_container_updates_out_of_order, test_lastchange_superseded]:
+        test()
+        print '%s: ok' % test.__name__
@@ -0,0 +1,56 @@
+#
+# Checks of how the device side event queues (brisa/upnp/device/event.py)
+# coalesce variable changes: a later value of a state variable replaces a
+# queued one, ContainerUpdateIDs values are merged so no container's update
+# is lost.
+#
+# usage: python eventqueuetest.py
+#
+
+from brisa.core.reactors import SelectReactor
+reactor = SelectReactor()
+
+from brisa.upnp.device.event import EventQueue, merge_container_update_ids
+
+class Subscriber(object):
+    delivery_url = 'http://127.0.0.1:1400/notify'
+
+def coalesce(*events):
+    '''
+    Queues events on one subscriber's queue within its coalesce window,
+    returns the variables of the messages it sends.
+    '''
+    sent = []
+    queue = EventQueue(Subscriber(), 60.0)
+    queue._deliver = lambda variables, queued_at: sent.append(variables)
+    for variables in events:
+        queue.put(variables)
+    # send now rather than at the end of the window
+    timer = queue._timer
+    timer.cancel()
+    timer.join()
+    queue._timer = None
+    queue._flush()
+    queue.stop()
+    return sent
+
+def test_container_update_ids_merged():
+    sent = coalesce({'SystemUpdateID': '89', 'ContainerUpdateIDs': 'Q:0,72'},
+                    {'SystemUpdateID': '90', 'ContainerUpdateIDs': 'S:,5'})
+    assert sent == [{'SystemUpdateID': '90', 'ContainerUpdateIDs': 'Q:0,72,S:,5'}], sent
+
+def test_container_update_ids_latest_kept():
+    sent = coalesce({'ContainerUpdateIDs': '0,5,7,5'},
+                    {'ContainerUpdateIDs': '7,6'},
+                    {'ContainerUpdateIDs': 'RecentlyPlayed,7,0,7'})
+    assert sent == [{'ContainerUpdateIDs': '0,7,7,6,RecentlyPlayed,7'}], sent
+    assert merge_container_update_ids(None, '0,1') == '0,1'
+
+def test_state_variables_replaced():
+    sent = coalesce({'TransportState': 'PLAYING'}, {'TransportState': 'STOPPED'})
+    assert sent == [{'TransportState': 'STOPPED'}], sent
+
+if __name__ == '__main__':
+    for test in [test_container_update_ids_merged, test_container_update_ids_latest_kept, test_state_variables_replaced]:
+        test()
+        print '%s: ok' % test.__name__
@@ -0,0 +1,111 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Decoding of AVTransport/RenderingControl LastChange events, shared by
+# pycpoint and playcounts.
+
+import threading
+
+from StringIO import StringIO
+from xml.etree import cElementTree as ElementTree
+
+AVT_NS = "{urn:schemas-upnp-org:metadata-1-0/AVT/}"
+RCS_NS = "{urn:schemas-upnp-org:metadata-1-0/RCS/}"
+RCNW_NS = "{urn:schemas-rinconnetworks-com:metadata-1-0/}"
+
+def parse_lastchange(lastchange, ns, variables=None, channels=False):
+    '''
+    Returns a dict of the variables in a LastChange event, keyed on tag name
+    with the service namespace ns removed (tags in other namespaces keep
+    their {namespace} prefix, e.g. r:EnqueuedTransportURIMetaData). The
+    InstanceID val is returned as 'InstanceID'.
+
+    variables - if passed, only those names are returned
+    channels  - append '_' + channel to the name of tags with a channel
+                attribute (RenderingControl Volume, Mute etc)
+    '''
+    if isinstance(lastchange, unicode):
+        lastchange = lastchange.encode('utf-8')
+    nsl = len(ns)
+    instance_tag = ns + 'InstanceID'
+    values = {}
+    depth = 0
+    for event, elem in ElementTree.iterparse(StringIO(lastchange), events=('start', 'end')):
+        if event == 'end':
+            depth -= 1
+            continue
+        depth += 1
+        if depth == 2:
+            if elem.tag == instance_tag:
+                values['InstanceID'] = elem.get('val')
+        elif depth == 3:
+            tag = elem.tag
+            if tag.startswith(ns):
+                tag = tag[nsl:]
+            if channels:
+                channel = elem.get('channel')
+                if channel != None:
+                    tag += '_' + channel
+            if variables == None or tag in variables:
+                values[tag] = elem.get('val')
+    return values
+
+class MetadataCache(object):
+    '''
+    Memoizes the result of parsing track metadata by its raw string, as
+    Sonos resends identical metadata with most events. Cached values are
+    shared, so callers must not change them.
+    '''
+
+    def __init__(self, parse, maxsize=64):
+        self.parse = parse
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, raw, *args):
+        key = (raw,) + args
+        self._lock.acquire()
+        try:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+        finally:
+            self._lock.release()
+        value = self.parse(raw, *args)
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            if len(self._cache) >= self.maxsize:
+                # metadata changes track by track, so dropping the lot is fine
+                self._cache.clear()
+            self._cache[key] = value
+        finally:
+            self._lock.release()
+        return value
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
@@ -0,0 +1,77 @@
+#
+# Micro-benchmark for LastChange event decoding (lastchange.py) against the
+# previous parse_xml/remove_namespace/findall approach, using events captured
+# from a ZonePlayer.
+#
+# usage: python lastchangetest.py [iterations]
+#
+
+import sys
+import timeit
+
+from brisa.core.network import parse_xml
+
+from lastchange import parse_lastchange, MetadataCache, AVT_NS, RCS_NS
+
+AVT_EVENT = '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/" xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/"><InstanceID val="0"><TransportState val="STOPPED"/><CurrentPlayMode val="NORMAL"/><NumberOfTracks val="1"/><CurrentTrack val="1"/><CurrentSection val="0"/><CurrentTrackURI val="http://192.168.0.10:26125/content/c2/b16/f44100/[INTER-RADIO]24.wav"/><CurrentTrackDuration val="0:00:00"/><CurrentTrackMetaData val="&lt;DIDL-Lite xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot; xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot; xmlns:r=&quot;urn:schemas-rinconnetworks-com:metadata-1-0/&quot; xmlns=&quot;urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/&quot;&gt;&lt;item id=&quot;-1&quot; parentID=&quot;-1&quot; restricted=&quot;true&quot;&gt;&lt;res protocolInfo=&quot;http-get:*:application/octet-stream:*&quot;&gt;http://192.168.0.10:26125/content/c2/b16/f44100/[INTER-RADIO]24.wav&lt;/res&gt;&lt;r:streamContent&gt;&lt;/r:streamContent&gt;&lt;r:radioShowMd&gt;&lt;/r:radioShowMd&gt;&lt;dc:title&gt;[INTER-RADIO]24.wav&lt;/dc:title&gt;&lt;upnp:class&gt;object.item&lt;/upnp:class&gt;&lt;/item&gt;&lt;/DIDL-Lite&gt;"/><r:NextTrackURI val=""/><r:NextTrackMetaData val=""/><r:EnqueuedTransportURI val="http://192.168.0.10:26125/content/c2/b16/f44100/[INTER-RADIO]24.wav"/><r:EnqueuedTransportURIMetaData val="&lt;DIDL-Lite xmlns=&quot;urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/&quot; xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot; xmlns:r=&quot;urn:schemas-rinconnetworks-com:metadata-1-0/&quot; xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;&lt;item id=&quot;[INTER-RADIO]24-au87&quot; parentID=&quot;au87&quot; refID=&quot;&quot; restricted=&quot;true&quot; &gt;&lt;dc:title&gt; Rock FM 97.4 (Top 40-Pop)  [64kbps]&lt;/dc:title&gt;&lt;upnp:class&gt;object.item.audioItem.audioBroadcast&lt;/upnp:class&gt;&lt;upnp:writeStatus&gt;NOT_WRITABLE&lt;/upnp:writeStatus&gt;&lt;res bitsPerSample=&quot;16&quot; nrAudioChannels=&quot;2&quot; protocolInfo=&quot;http-get:*:audio/wav:DLNA.ORG_PN=WAV;DLNA.ORG_OP=01&quot; sampleFrequency=&quot;44100&quot;&gt;http://192.168.0.10:26125/content/c2/b16/f44100/[INTER-RADIO]24.wav&lt;/res&gt;&lt;upnp:albumArtURI&gt;http://radiotime-logos.s3.amazonaws.com/s6924q.png&lt;/upnp:albumArtURI&gt;&lt;/item&gt;&lt;/DIDL-Lite&gt;"/><PlaybackStorageMedium val="NETWORK"/><AVTransportURI val="http://192.168.0.10:26125/content/c2/b16/f44100/[INTER-RADIO]24.wav"/><AVTransportURIMetaData val="&lt;DIDL-Lite xmlns=&quot;urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/&quot; xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot; xmlns:r=&quot;urn:schemas-rinconnetworks-com:metadata-1-0/&quot; xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;&lt;item id=&quot;[INTER-RADIO]24-au87&quot; parentID=&quot;au87&quot; refID=&quot;&quot; restricted=&quot;true&quot; &gt;&lt;dc:title&gt; Rock FM 97.4 (Top 40-Pop)  [64kbps]&lt;/dc:title&gt;&lt;upnp:class&gt;object.item.audioItem.audioBroadcast&lt;/upnp:class&gt;&lt;upnp:writeStatus&gt;NOT_WRITABLE&lt;/upnp:writeStatus&gt;&lt;res bitsPerSample=&quot;16&quot; nrAudioChannels=&quot;2&quot; protocolInfo=&quot;http-get:*:audio/wav:DLNA.ORG_PN=WAV;DLNA.ORG_OP=01&quot; sampleFrequency=&quot;44100&quot;&gt;http://192.168.0.10:26125/content/c2/b16/f44100/[INTER-RADIO]24.wav&lt;/res&gt;&lt;upnp:albumArtURI&gt;http://radiotime-logos.s3.amazonaws.com/s6924q.png&lt;/upnp:albumArtURI&gt;&lt;/item&gt;&lt;/DIDL-Lite&gt;"/><CurrentTransportActions val="Play, Stop, Pause, Seek, Next, Previous"/></InstanceID></Event>'
+
+RC_EVENT = '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/RCS/"><InstanceID val="0"><Volume channel="Master" val="23"/><Volume channel="LF" val="100"/><Volume channel="RF" val="100"/><Mute channel="Master" val="0"/><Bass val="0"/><Treble val="0"/><Loudness channel="Master" val="1"/><OutputFixed val="0"/><PresetNameList val="FactoryDefaults"/></InstanceID></Event>'
+
+def remove_namespace(doc, ns):
+    nsl = len(ns)
+    for elem in doc.getiterator():
+        if elem.tag.startswith(ns):
+            elem.tag = elem.tag[nsl:]
+
+def old_decode(lastchange, ns, channels=False):
+    elt = parse_xml(lastchange).getroot()
+    remove_namespace(elt, ns)
+    values = {}
+    InstanceID = elt.find('InstanceID')
+    if InstanceID != None:
+        values['InstanceID'] = InstanceID.get('val')
+        for child in elt.findall('InstanceID/*'):
+            nodename = child.tag
+            if channels:
+                nodechannel = child.get('channel')
+                if nodechannel != None:
+                    nodename += '_' + nodechannel
+            values[nodename] = child.get('val')
+    return values
+
+def parse_metadata(metadata):
+    elt = parse_xml(metadata).getroot()
+    remove_namespace(elt, "{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}")
+    item = elt.find('item')
+    title = item.find('{http://purl.org/dc/elements/1.1/}title').text
+    return title
+
+def main(argv):
+    n = 2000
+    if len(argv) > 1:
+        n = int(argv[1])
+
+    # check both decoders agree
+    assert old_decode(AVT_EVENT, AVT_NS) == parse_lastchange(AVT_EVENT, AVT_NS)
+    assert old_decode(RC_EVENT, RCS_NS, True) == parse_lastchange(RC_EVENT, RCS_NS, channels=True)
+
+    avt = parse_lastchange(AVT_EVENT, AVT_NS)
+    metadata = avt['CurrentTrackMetaData']
+    cache = MetadataCache(parse_metadata)
+    wanted = set(['TransportState', 'CurrentTrackURI', 'CurrentTrackMetaData'])
+
+    tests = [
+        ('AVT old decode', lambda: old_decode(AVT_EVENT, AVT_NS)),
+        ('AVT parse_lastchange', lambda: parse_lastchange(AVT_EVENT, AVT_NS)),
+        ('AVT parse_lastchange (3 vars)', lambda: parse_lastchange(AVT_EVENT, AVT_NS, wanted)),
+        ('RC old decode', lambda: old_decode(RC_EVENT, RCS_NS, True)),
+        ('RC parse_lastchange', lambda: parse_lastchange(RC_EVENT, RCS_NS, channels=True)),
+        ('metadata parse', lambda: parse_metadata(metadata)),
+        ('metadata cached', lambda: cache.get(metadata)),
+        ]
+    for name, f in tests:
+        t = min(timeit.repeat(f, number=n, repeat=3))
+        print '%-32s %8.1f us' % (name, t * 1000000 / n)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,439 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Connections to the library database used by the proxy.
+#
+# The database can be read in one of three modes (library_db_mode in the
+# [INI] section of pycpoint.ini):
+#     disk   - a new connection to the file for each request (the default)
+#     mmap   - as disk, but SQLite maps the file into memory (library_db_mmap_size
+#              bytes of it) rather than reading it through its page cache
+#     memory - the whole database is copied into an in-memory database at
+#              startup, and recopied when a scan updates the file
+#
+# Each completed scan gives a new generation of the library, which is
+# prepared (copied, caches built) before it replaces the previous one.
+# Only in memory mode is a generation a snapshot: requests still using an
+# old generation read the old copy. In disk and mmap mode a generation's
+# connections are to the file itself, so they see a scan's writes as it
+# commits them, and a generation only identifies the scan its caches (e.g.
+# counts) were built for. A read transaction held for a generation would
+# stop movetags committing, as the database doesn't use WAL.
+# Plays written to the file between scans (by playcounts or playtags) are
+# copied into the in-memory database, so memory mode shows them without
+# waiting for the next scan.
+#
+# In memory mode all requests share the in-memory connection, so it must
+# only be used for reads. Its statements are run one at a time.
+
+import os
+import time
+import sqlite3
+import threading
+
+from brisa.core import log
+from brisa.core.threaded_call import run_async_function
+from brisa.utils.looping_call import LoopingCall
+
+MODES = ['disk', 'mmap', 'memory']
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+MAX_COUNTS = 10000
+
+def copy_database(path):
+    '''
+    Returns an in-memory copy of the database at path, with the time it
+    took and its size in bytes. The copy is read in a single transaction so
+    it is consistent even if movetags is writing to the file.
+    '''
+    start = time.time()
+    mem = sqlite3.connect(':memory:', check_same_thread=False)
+    mem.isolation_level = None
+    mem.execute("attach database ? as src", (path, ))
+    mem.execute("begin")
+    try:
+        entries = mem.execute("select type, name, sql from src.sqlite_master where sql is not null and name not like 'sqlite_%'").fetchall()
+        # virtual tables first (they create their own shadow tables), then
+        # the other tables and their rows, then indexes and views. rowids
+        # are kept as the full text index refers to tracks by rowid
+        for type, name, sql in entries:
+            if type == 'table' and sql.upper().startswith('CREATE VIRTUAL TABLE'):
+                mem.execute(sql)
+        for type, name, sql in entries:
+            if type == 'table' and not sql.upper().startswith('CREATE VIRTUAL TABLE'):
+                n, = mem.execute("select count(*) from main.sqlite_master where type='table' and name=?", (name, )).fetchone()
+                if n == 0:
+                    mem.execute(sql)
+                columns = ', '.join(['"%s"' % row[1] for row in mem.execute('pragma src.table_info("%s")' % name)])
+                mem.execute('insert into main."%s" (rowid, %s) select rowid, %s from src."%s"' % (name, columns, columns, name))
+        for type, name, sql in entries:
+            if type in ('index', 'view'):
+                mem.execute(sql)
+        mem.execute("commit")
+    except:
+        mem.execute("rollback")
+        mem.close()
+        raise
+    mem.execute("detach database src")
+    mem.isolation_level = ''
+    page_count, = mem.execute("pragma page_count").fetchone()
+    page_size, = mem.execute("pragma page_size").fetchone()
+    return mem, time.time() - start, page_count * page_size
+
+# the columns plays update (see playcountdb), and the tables copied whole
+# when they change
+PLAYED_COLUMNS = ('playcount', 'lastplayed')
+PLAYED_TABLES = ('SmartContainers', 'SmartContainerTracks')
+
+def get_plays(db):
+    '''
+    Returns a value that changes when plays are written to the database.
+    '''
+    plays, = db.execute("select total(playcount) from tracks").fetchone()
+    return plays
+
+def copy_plays(db, path):
+    '''
+    Copies the plays written to the database at path since it was copied
+    into db, an in-memory copy of it. Returns the number of rows changed.
+    The file is read in a single transaction, so a batch of plays is either
+    copied whole or not at all.
+    '''
+    src = sqlite3.connect(path)
+    src.isolation_level = None
+    src.execute("begin")
+    try:
+        copied = set([row[0] for row in db.execute("select name from sqlite_master where type='table'")])
+        changed = 0
+        tables = src.execute("select name, sql from sqlite_master where type='table' and name not like 'sqlite_%'").fetchall()
+        for name, sql in tables:
+            if not name in copied or sql.upper().startswith('CREATE VIRTUAL TABLE'):
+                continue
+            columns = [row[1] for row in src.execute('pragma table_info("%s")' % name)]
+            if name in PLAYED_TABLES:
+                rows = src.execute('select rowid, * from "%s"' % name).fetchall()
+                db.execute('delete from "%s"' % name)
+                db.executemany('insert into "%s" (rowid, %s) values (?, %s)' % (name, ', '.join(['"%s"' % c for c in columns]), ', '.join('?' * len(columns))), rows)
+                changed += len(rows)
+            elif set(PLAYED_COLUMNS) <= set(columns):
+                # rowids are the same in the copy, so only the rows whose
+                # plays differ are updated
+                statement = 'select rowid, %s from "%s"' % (', '.join(PLAYED_COLUMNS), name)
+                current = dict([(row[0], row[1:]) for row in db.execute(statement)])
+                rows = [row[1:] + row[:1] for row in src.execute(statement) if current.get(row[0]) != row[1:]]
+                db.executemany('update "%s" set %s where rowid=?' % (name, ', '.join(['%s=?' % c for c in PLAYED_COLUMNS])), rows)
+                changed += len(rows)
+        db.commit()
+        return changed
+    except:
+        db.rollback()
+        raise
+    finally:
+        src.execute("rollback")
+        src.close()
+
+class MemoryConnection(object):
+    '''
+    The in-memory database of a generation, as handed out to each request.
+    Statements and fetches on it are run one at a time under lock.
+    '''
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def cursor(self):
+        return MemoryCursor(self.db.cursor(), self.lock)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def close(self):
+        # shared by all requests
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+class MemoryCursor(object):
+
+    def __init__(self, cursor, lock):
+        self.c = cursor
+        self.lock = lock
+
+    def _locked(self, func, *args):
+        self.lock.acquire()
+        try:
+            return func(*args)
+        finally:
+            self.lock.release()
+
+    def execute(self, *args):
+        self._locked(self.c.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        self._locked(self.c.executemany, *args)
+        return self
+
+    def fetchone(self):
+        return self._locked(self.c.fetchone)
+
+    def fetchmany(self, *args):
+        return self._locked(self.c.fetchmany, *args)
+
+    def fetchall(self):
+        return self._locked(self.c.fetchall)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row == None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.c, name)
+
+class Generation(object):
+    '''
+    One version of the library, as left by a completed scan (scanid is
+    params.lastscanid). Holds the in-memory copy in memory mode and the
+    values the library's preparers built for it. In disk and mmap mode its
+    connections read the file as it is now.
+    '''
+
+    def __init__(self, library, scanid, memdb=None, plays=None):
+        self.library = library
+        self.scanid = scanid
+        self.plays = plays
+        self.memdb = memdb
+        self.lock = threading.RLock()
+        self.data = {}
+        self.counts = {}
+        self.count_hits = 0
+
+    def connect(self):
+        if self.memdb != None:
+            return MemoryConnection(self.memdb, self.lock)
+        db = sqlite3.connect(self.library.path)
+        if self.library.mode == 'mmap':
+            db.execute("pragma mmap_size=%d" % self.library.mmap_size)
+        self.library.add_functions(db)
+        return db
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def get_count(self, c, statement, params=()):
+        '''
+        Returns the value of a count statement run with cursor c, which
+        must be on a connection from this generation. Counts are only
+        changed by a scan so each one is only run once per generation.
+        '''
+        key = (statement, tuple(params))
+        count = self.counts.get(key)
+        if count != None:
+            self.count_hits += 1
+            return count
+        c.execute(statement, params)
+        count, = c.fetchone()
+        if len(self.counts) >= MAX_COUNTS:
+            self.counts.clear()
+        self.counts[key] = count
+        return count
+
+class LibraryDatabase(object):
+    '''
+    Hands out connections to the current generation of the library
+    database at path. watch() polls the file and, when a scan completes,
+    prepares the next generation in the background and swaps it in.
+    Requests that already have a connection from the old generation
+    finish with it (and, in memory mode only, with its data).
+    '''
+
+    def __init__(self, path, mode='disk', mmap_size=DEFAULT_MMAP_SIZE):
+        self.path = path
+        self.mode = mode
+        self.mmap_size = mmap_size
+        self.preparers = []
+        self.functions = []
+        self.generation = Generation(self, None)
+        self._callback = None
+        self._watch_loop = None
+        self._stat = None
+        self._loading = False
+        self._lock = threading.Lock()
+        if self.mode == 'mmap' and sqlite3.sqlite_version_info < (3, 7, 17):
+            print "library_db_mode mmap needs SQLite 3.7.17 or later (have %s), using disk" % sqlite3.sqlite_version
+            self.mode = 'disk'
+
+    def add_preparer(self, name, func):
+        '''
+        Registers func(connection) to be run for each new generation before
+        it is swapped in. Its result is available as generation.get(name).
+        '''
+        self.preparers.append((name, func))
+
+    def add_function(self, name, nargs, func):
+        '''
+        Registers func as SQL function name on every connection handed out.
+        '''
+        self.functions.append((name, nargs, func))
+
+    def add_functions(self, db):
+        for name, nargs, func in self.functions:
+            db.create_function(name, nargs, func)
+
+    def current(self):
+        return self.generation
+
+    def connect(self):
+        '''
+        Returns a connection to the current generation, for a request.
+        '''
+        return self.generation.connect()
+
+    def connect_file(self):
+        '''
+        Returns a connection to the database file, whatever the mode.
+        '''
+        return sqlite3.connect(self.path)
+
+    def get_scanid(self):
+        return self.get_version()[0]
+
+    def get_version(self):
+        '''
+        Returns the lastscanid of the database file, and the value that
+        changes when plays are written to it.
+        '''
+        db = self.connect_file()
+        try:
+            scanid, = db.execute("select lastscanid from params where key = '1'").fetchone()
+            plays = get_plays(db)
+        finally:
+            db.close()
+        return scanid, plays
+
+    def load(self):
+        '''
+        Prepares a generation from the file as it is now and swaps it in
+        for the current one. Returns the new generation, or None if it
+        could not be loaded.
+        '''
+        start = time.time()
+        try:
+            if self.mode == 'memory':
+                memdb, elapsed, size = copy_database(self.path)
+                scanid, = memdb.execute("select lastscanid from params where key = '1'").fetchone()
+                plays = get_plays(memdb)
+                self.add_functions(memdb)
+                print "Library database %s loaded into memory: %.2fs, %.1fMB" % (self.path, elapsed, size / 1048576.0)
+            else:
+                memdb = None
+                scanid, plays = self.get_version()
+            generation = Generation(self, scanid, memdb, plays)
+            db = generation.connect()
+            for name, func in self.preparers:
+                generation.data[name] = func(db)
+        except sqlite3.Error, e:
+            print "Error loading library database:", e.args[0]
+            return None
+        self.generation = generation
+        log.debug("library generation %s ready: %.3fs" % (scanid, time.time() - start))
+        return generation
+
+    def watch(self, interval, callback=None):
+        '''
+        Polls the database file every interval seconds. When a scan has
+        changed lastscanid, the next generation is loaded in the background
+        and callback(generation) is called once it has been swapped in. If
+        only plays have been written, they are copied into the current
+        generation (in memory mode) and callback is called with it.
+        '''
+        self._callback = callback
+        self._watch_loop = LoopingCall(self._poll)
+        self._watch_loop.start(interval, now=False)
+
+    def stop(self):
+        if self._watch_loop != None and self._watch_loop.is_running():
+            self._watch_loop.stop()
+
+    def _poll(self):
+        # only read the database if the file (or its WAL) has changed
+        stat = []
+        for path in [self.path, self.path + '-wal']:
+            try:
+                st = os.stat(path)
+                stat.append((st.st_mtime, st.st_size))
+            except OSError:
+                stat.append(None)
+        if stat == self._stat:
+            return
+        try:
+            scanid, plays = self.get_version()
+        except sqlite3.Error, e:
+            # locked by movetags, try again next time
+            log.debug("library poll: %s" % e.args[0])
+            return
+        if scanid == self.generation.scanid and plays == self.generation.plays:
+            self._stat = stat
+            return
+        self._lock.acquire()
+        try:
+            if self._loading:
+                return
+            self._loading = True
+        finally:
+            self._lock.release()
+        if scanid == self.generation.scanid:
+            run_async_function(self._refresh_plays, (stat, plays))
+        else:
+            run_async_function(self._reload, (stat, ))
+
+    def _reload(self, stat):
+        try:
+            generation = self.load()
+            if generation != None:
+                self._stat = stat
+                if self._callback != None:
+                    self._callback(generation)
+        finally:
+            self._loading = False
+
+    def _refresh_plays(self, stat, plays):
+        generation = self.generation
+        try:
+            if generation.memdb != None:
+                start = time.time()
+                generation.lock.acquire()
+                try:
+                    changed = copy_plays(generation.memdb, self.path)
+                finally:
+                    generation.lock.release()
+                log.debug("library plays copied into memory: %d rows, %.3fs" % (changed, time.time() - start))
+            generation.plays = plays
+            self._stat = stat
+            if self._callback != None:
+                self._callback(generation)
+        except sqlite3.Error, e:
+            print "Error copying plays into library database:", e.args[0]
+        finally:
+            self._loading = False
@@ -0,0 +1,144 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Playback position of a zone, shared by pycpoint and playcounts.
+#
+# The position isn't evented, but it only moves (at one second a second)
+# while the zone is PLAYING. Rather than sending GetPositionInfo each time
+# the position is wanted, a PlaybackClock keeps the position from the last
+# GetPositionInfo, the time it was read and the transport state from the
+# events, and works the position out from them. It asks to be synced again
+# when the state or track changes, or once its sync is resync_interval
+# seconds old.
+
+import time
+
+DEFAULT_RESYNC_INTERVAL = 30
+
+def makeseconds(t):
+    '''
+    Returns the seconds in an H:MM:SS time, 0 if it isn't one.
+    '''
+    if not ':' in t:
+        return 0
+    h, m, s = t.split(':')
+    return (int(h)*60*60 + int(m)*60 +int(float(s)))
+
+def maketime(seconds):
+    '''
+    Returns seconds as an H:MM:SS time.
+    '''
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+class PlaybackClock(object):
+    '''
+    The playback position of a zone, interpolated from its last
+    GetPositionInfo response.
+    '''
+
+    def __init__(self, resync_interval=DEFAULT_RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets the position (e.g. when the zone changes).
+        '''
+        self.state = ''
+        self.position_info = {}
+        self.position = None
+        self.duration = None
+        self.synced = None
+        self.stale = True
+
+    def sync(self, position_info, now=None):
+        '''
+        Sets the position from a GetPositionInfo response.
+        '''
+        if now == None:
+            now = time.time()
+        self.position_info = position_info
+        self.position = None
+        reltime = position_info.get('RelTime', 'NOT_IMPLEMENTED')
+        if ':' in reltime:
+            self.position = makeseconds(reltime)
+        self.duration = None
+        trackduration = position_info.get('TrackDuration', 'NOT_IMPLEMENTED')
+        if makeseconds(trackduration) > 0:
+            self.duration = makeseconds(trackduration)
+        self.synced = now
+        self.stale = False
+
+    def set_state(self, state, now=None):
+        '''
+        Sets the transport state from an event. A change of state means the
+        clock needs syncing, until it is the position is held where the
+        state changed.
+        '''
+        if state == self.state:
+            return
+        if now == None:
+            now = time.time()
+        if self.synced != None:
+            self.position = self.get_position(now)
+            self.synced = now
+        self.state = state
+        self.stale = True
+
+    def track_changed(self):
+        '''
+        Notes that an event changed the track, so the clock needs syncing.
+        '''
+        self.stale = True
+
+    def needs_sync(self, now=None):
+        if self.stale or self.synced == None or self.state == '':
+            # changed, never synced or no state from events to go on
+            return True
+        if now == None:
+            now = time.time()
+        return now - self.synced >= self.resync_interval
+
+    def get_position(self, now=None):
+        '''
+        Returns the position in seconds, None if it isn't known.
+        '''
+        if self.position == None:
+            return None
+        if self.state != 'PLAYING' or self.stale:
+            return self.position
+        if now == None:
+            now = time.time()
+        position = self.position + max(now - self.synced, 0)
+        if self.duration != None:
+            position = min(position, self.duration)
+        return position
+
+    def get_position_info(self, now=None):
+        '''
+        Returns the last GetPositionInfo response, with RelTime moved on to
+        the current position.
+        '''
+        position_info = dict(self.position_info)
+        position = self.get_position(now)
+        if position != None:
+            position_info['RelTime'] = maketime(position)
+        return position_info
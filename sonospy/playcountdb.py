@@ -0,0 +1,233 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Play counts written by playcounts straight into the library database.
+#
+# Each play playcounts records is queued, and every few seconds the queued
+# plays are written in one short transaction per database. A play of a track
+# served by the proxy is matched on the database and id in its URI, other
+# plays are matched on title, album and artist (and length if that isn't
+# enough) in the default database. The playcount and lastplayed of the
+# track are updated, along with those of the albums, artists, composers and
+# genres it belongs to (and the smart containers), so the library needs no
+# separate playtags run.
+#
+# update_played is also used by playtags to write imported plays.
+
+import os
+import sqlite3
+import threading
+
+from playclock import makeseconds
+from smartcontainers import update_smart_containers
+
+DEFAULT_INTERVAL = 5
+
+# set clause adding plays (count, last time played) to a row, treating the
+# '' movetags initialises the columns to as no plays. sqlite sorts text above
+# numbers, so lastplayed (text in some databases) is compared as a number
+PLAYED = "playcount=ifnull(nullif(playcount, ''), 0)+?, lastplayed=max(cast(ifnull(nullif(lastplayed, ''), 0) as real), cast(? as real))"
+
+# album lookup tables, with their track lookup tables and the columns
+# (other than album, duplicate and albumtype) joining the two
+ALBUM_LOOKUPS = [('ArtistAlbum', 'ArtistAlbumTrack', ('artist', )),
+                 ('AlbumartistAlbum', 'AlbumartistAlbumTrack', ('albumartist', )),
+                 ('ComposerAlbum', 'ComposerAlbumTrack', ('composer', )),
+                 ('GenreArtistAlbum', 'GenreArtistAlbumTrack', ('genre', 'artist')),
+                 ('GenreAlbumartistAlbum', 'GenreAlbumartistAlbumTrack', ('genre', 'albumartist'))]
+
+def album_lookup_rows(lookup, tracklookup, columns, select='a.rowid'):
+    '''
+    Returns a query for select from the rows of lookup for the track
+    with id passed as its parameter.
+    '''
+    join = ' and '.join(['a.%s=t.%s' % (c, c) for c in ('album', 'duplicate', 'albumtype') + columns])
+    return "select %s from %s a, %s t where t.track_id=? and %s" % (select, lookup, tracklookup, join)
+
+def rollup_statements():
+    '''
+    Returns (tables used, update statement, number of track id parameters)
+    for each aggregate of a track's plays. Each statement takes the plays
+    first, then the track id that many times.
+    '''
+    statements = []
+    for lookup, tracklookup, columns in ALBUM_LOOKUPS:
+        statements.append(([lookup, tracklookup],
+                           "update %s set %s where rowid in (%s)" % (lookup, PLAYED, album_lookup_rows(lookup, tracklookup, columns)),
+                           1))
+    albums = ' union '.join([album_lookup_rows(lookup, tracklookup, columns, 'a.album_id') for lookup, tracklookup, columns in ALBUM_LOOKUPS[:3]])
+    statements.append(([t for l in ALBUM_LOOKUPS[:3] for t in l[:2]] + ['albums'],
+                       "update albums set %s where id in (%s)" % (PLAYED, albums),
+                       3))
+    artists = "select a.id from artists a, tracks t where t.id=? and a.artist=t.artist and a.albumartist=t.albumartist"
+    statements.append((['artists'],
+                       "update artists set %s where id in (%s)" % (PLAYED, artists),
+                       1))
+    genres = "select genre from GenreArtistAlbumTrack where track_id=?"
+    statements.append((['artists', 'GenreArtist', 'GenreArtistAlbumTrack'],
+                       "update GenreArtist set %s where artist_id in (%s) and genre in (%s)" % (PLAYED, artists, genres),
+                       2))
+    statements.append((['artists', 'GenreAlbumartist', 'GenreArtistAlbumTrack'],
+                       "update GenreAlbumartist set %s where albumartist_id in (%s) and genre in (%s)" % (PLAYED, artists, genres),
+                       2))
+    statements.append((['composers'],
+                       "update composers set %s where composer=(select composer from tracks where id=?)" % PLAYED,
+                       1))
+    statements.append((['genres'],
+                       "update genres set %s where genre=(select genre from tracks where id=?)" % PLAYED,
+                       1))
+    return statements
+
+ROLLUP_STATEMENTS = rollup_statements()
+
+def update_played(c, played):
+    '''
+    Adds played, a list of (track id, count, last time played), to the
+    tracks, their aggregates and the smart containers, with one
+    executemany per table.
+    '''
+    c.execute("select name from sqlite_master where type='table'")
+    tables = set([row[0] for row in c.fetchall()])
+    c.executemany("update tracks set %s where id=?" % PLAYED,
+                  [(count, lastplayed, track_id) for track_id, count, lastplayed in played])
+    for used, statement, ids in ROLLUP_STATEMENTS:
+        if tables.issuperset(used):
+            c.executemany(statement,
+                          [(count, lastplayed) + (track_id, ) * ids for track_id, count, lastplayed in played])
+    if 'SmartContainers' in tables:
+        update_smart_containers(c, [track_id for track_id, count, lastplayed in played])
+
+class PlayCountWriter(object):
+    '''
+    Queues plays and writes them to the library databases every interval
+    seconds. Plays that aren't of a track from a proxy's database are
+    matched in default_database, if there is one.
+    '''
+
+    def __init__(self, default_database=None, interval=DEFAULT_INTERVAL):
+        self.default_database = default_database
+        self.interval = interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='playcounts-writer')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add_play(self, playtime, title, artist, album, duration, database='', filename=''):
+        '''
+        Queues a play. database and filename are from the URI of a track
+        served by a proxy, duration is H:MM:SS.
+        '''
+        self.lock.acquire()
+        try:
+            self.pending.append((float(playtime), title, artist, album, makeseconds(duration or ''), database, filename))
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            if self.pending:
+                self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def flush(self):
+        '''
+        Writes the queued plays.
+        '''
+        self.flush_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                plays = self.pending
+                self.pending = []
+            finally:
+                self.lock.release()
+            # group the plays by the database they are matched in
+            databases = {}
+            for play in plays:
+                playtime, title, artist, album, length, database, filename = play
+                path = None
+                if database and filename.startswith(database):
+                    path = os.path.join(os.getcwd(), database)
+                    if not os.path.exists(path):
+                        path = None
+                if path == None:
+                    if not self.default_database:
+                        continue
+                    path = self.default_database
+                    play = play[:5] + ('', '')
+                databases.setdefault(path, []).append(play)
+            for path, plays in databases.iteritems():
+                self.write_plays(path, plays)
+        finally:
+            self.flush_lock.release()
+
+    def write_plays(self, path, plays):
+        try:
+            db = sqlite3.connect(path, timeout=30)
+        except sqlite3.Error, e:
+            print "Error opening library database %s:" % path, e.args[0]
+            return
+        try:
+            c = db.cursor()
+            # find the tracks before starting to write, adding up the plays
+            # of each
+            tracks = {}
+            for play in plays:
+                track_id = self.find_track(c, play)
+                if track_id == None:
+                    print "Couldn't find track: %s" % str(play)
+                    continue
+                count, lastplayed = tracks.get(track_id, (0, 0))
+                tracks[track_id] = (count + 1, max(lastplayed, play[0]))
+            if not tracks:
+                return
+            update_played(c, [(track_id, count, lastplayed) for track_id, (count, lastplayed) in tracks.iteritems()])
+            db.commit()
+        except sqlite3.Error, e:
+            print "Error updating playcounts:", e.args[0]
+            db.rollback()
+        finally:
+            db.close()
+
+    def find_track(self, c, play):
+        '''
+        Returns the id of the track play is of, None if it isn't found (or
+        matches more than one).
+        '''
+        playtime, title, artist, album, length, database, filename = play
+        if database:
+            id = filename[len(database)+1:].split('.')[0]
+            row = c.execute("select id from tracks where id=?", (id, )).fetchone()
+            if row != None:
+                return row[0]
+        # uses index inxTrackPlay
+        rows = c.execute("select id, length from tracks where title=? and album=? and artist=? limit 100", (title, album, artist)).fetchall()
+        if len(rows) > 1 and length > 0:
+            rows = [row for row in rows if row[1] == length]
+        if len(rows) == 1:
+            return rows[0][0]
+        return None
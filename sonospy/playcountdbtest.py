@@ -0,0 +1,43 @@
+#
+# Checks of the playcount updates playcountdb.py makes: each play adds to
+# playcount and moves lastplayed forward, whether lastplayed is stored as a
+# number, as text or as the '' movetags initialises it to.
+#
+# usage: python playcountdbtest.py
+#
+
+import sqlite3
+
+from playcountdb import update_played
+
+def played(lastplayed_type, initial):
+    db = sqlite3.connect(':memory:')
+    c = db.cursor()
+    c.execute('create table tracks (id text, duplicate integer, lastplayed %s, playcount integer)' % lastplayed_type)
+    c.execute("insert into tracks values ('1', 0, ?, '')", (initial, ))
+    values = []
+    for playtime in [1287482910.12, 1287483500.5, 1287490000.0]:
+        update_played(c, [('1', 1, playtime)])
+        c.execute("select cast(lastplayed as real), playcount from tracks where id='1'")
+        values.append(c.fetchone())
+    return values
+
+def test_lastplayed_moves_forward():
+    for lastplayed_type in ['real', 'text']:
+        for initial in ['', None, '1000.0']:
+            values = played(lastplayed_type, initial)
+            assert values == [(1287482910.12, 1), (1287483500.5, 2), (1287490000.0, 3)], (lastplayed_type, initial, values)
+
+def test_lastplayed_kept_for_earlier_play():
+    db = sqlite3.connect(':memory:')
+    c = db.cursor()
+    c.execute('create table tracks (id text, duplicate integer, lastplayed text, playcount integer)')
+    c.execute("insert into tracks values ('1', 0, '1287490000.0', 2)")
+    update_played(c, [('1', 1, 1287482910.12)])
+    c.execute("select cast(lastplayed as real), playcount from tracks where id='1'")
+    assert c.fetchone() == (1287490000.0, 3)
+
+if __name__ == '__main__':
+    for test in [test_lastplayed_moves_forward, test_lastplayed_kept_for_earlier_play]:
+        test()
+        print '%s: ok' % test.__name__
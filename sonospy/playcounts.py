@@ -40,7 +40,7 @@ from brisa.core.log import modcheck
 
 import brisa
 
-##import threading
+import threading
 ##from threading import Timer
 
 
@@ -83,6 +83,11 @@ from brisa.core.threaded_call import run_async_function ##, run_async_call
 ##from sonos_service import radiotimeMediaCollection, radiotimeMediaMetadata
 from sonos_service import AvailableServices
 
+from lastchange import parse_lastchange, MetadataCache, AVT_NS, RCNW_NS
+from playclock import PlaybackClock
+from eventdispatch import EventDispatcher
+from playcountdb import PlayCountWriter
+
 ##from brisa.upnp.soap import HTTPTransport, HTTPError, parse_soap_call, parse_soap_fault
 
 from optparse import OptionParser
@@ -101,7 +106,8 @@ class ControlPointScrob(object):
     # class vars
     ###########################################################################
 
-    current_renderer_events_avt = {}
+    # AVTransport LastChange values of each zone
+    zone_events_avt = {}
 
     now_playing = ''
     now_extras = ''
@@ -137,6 +143,7 @@ class ControlPointScrob(object):
     current_track_scrobbled = {}
     current_play_state = {}
     current_position_info = {}
+    position_clocks = {}
     current_track_duration = {}
     current_track_relative_time_position = {}
     current_track_absolute_time_position = {}
@@ -203,6 +210,27 @@ class ControlPointScrob(object):
     except ConfigParser.NoOptionError:
         pass
 
+    # get whether plays are also logged to playcounts_file
+    pc_log = True
+    try:        
+        pc_log = config.get('INI', 'playcounts_csv').lower() == 'y'
+    except ConfigParser.NoOptionError:
+        pass
+
+    # get library database plays not from a proxy are recorded in
+    pc_database = None
+    try:        
+        pc_database = config.get('INI', 'playcounts_database')
+    except ConfigParser.NoOptionError:
+        pass
+
+    # get seconds between writes of plays to the library database
+    pc_interval = 5
+    try:        
+        pc_interval = int(config.get('INI', 'playcounts_update_interval'))
+    except ConfigParser.NoOptionError:
+        pass
+
     # get log file
     log_file = 'playcountslog.log'
     try:        
@@ -217,16 +245,60 @@ class ControlPointScrob(object):
     except ConfigParser.NoOptionError:
         pass
 
+    # get seconds after which a zone's position is read again
+    position_resync_interval = 30
+    try:        
+        position_resync_interval = int(config.get('INI', 'position_resync_interval'))
+    except ConfigParser.NoOptionError:
+        pass
+
+    # get number of threads processing events (each zone's events are
+    # processed in order by one of them)
+    event_workers = 4
+    try:        
+        event_workers = int(config.get('INI', 'playcounts_event_workers'))
+    except ConfigParser.NoOptionError:
+        pass
+
+    # get seconds after which a late event is logged
+    event_lag_warning = 2.0
+    try:        
+        event_lag_warning = float(config.get('INI', 'event_lag_warning'))
+    except ConfigParser.NoOptionError:
+        pass
+
     ###########################################################################
     # __init__
     ###########################################################################
 
+    # AVTransport variables used from LastChange events
+    avt_variables = set(['TransportState', 'CurrentTrack', 'CurrentTrackURI', 'TransportErrorDescription',
+                         RCNW_NS + 'EnqueuedTransportURIMetaData'])
+
     def __init__(self):
 
+        # track/transport metadata details keyed on the raw DIDL-Lite
+        self.metadata_cache = MetadataCache(self.parse_metadata)
+        self.transport_metadata_cache = MetadataCache(self.parse_transport_metadata)
+
+        # plays are written to the library database in batches
+        self.playcount_writer = PlayCountWriter(self.pc_database, self.pc_interval)
+
+        # audit log of plays, kept open between plays and written to by the
+        # event workers
+        self.pc_log_file = None
+        self.pc_log_lock = threading.Lock()
+        if self.pc_log:
+            self.pc_log_file = open(self.pc_file, 'a')
+
+        # events are processed in order for each zone, off the thread that
+        # receives them
+        self.event_dispatcher = EventDispatcher(self.on_device_event_seq, self.event_workers, self.event_lag_warning, 'playcounts-events')
+
         self.control_point = ControlPointSonos(self.ws_port)
         self.control_point.subscribe("new_device_event", self.on_new_device)
         self.control_point.subscribe("removed_device_event", self.on_del_device)
-        self.control_point.subscribe('device_event_seq', self.on_device_event_seq)
+        self.control_point.subscribe('device_event_seq', self.event_dispatcher.put)
         self.control_point.start()
 
         # start MSEARCH
@@ -294,7 +366,7 @@ class ControlPointScrob(object):
         self.process_event_queue(subscription_id)
 
     def _event_renewal_callback(self, cargo, subscription_id, timeout):
-# TODO: add error processing for if renewal fails - basically resubscribe. NEW - check if this is catered for in 0.10.0
+# failed renewals are resubscribed by the subscription manager, the new sid arrives on _event_subscribe_callback
         log.debug('Event renew done cargo=%s sid=%s timeout=%s', cargo, subscription_id, timeout)
 
     def _event_unsubscribe_callback(self, cargo, subscription_id):
@@ -461,8 +533,12 @@ class ControlPointScrob(object):
             ZP = self.zoneattributes[self.at_subscription_ids[sid]]['CurrentZoneName']
             out = "%s play_state: %s\n" % (ZP, self.current_play_state[sid])
             self.write_log(out)
-        # get latest position info
-        self.current_position_info[sid] = self.get_position_info(sid)
+        # get latest position info (worked out from the last one read,
+        # unless the state or track has changed since or it is too old)
+        clock = self.position_clocks[sid]
+        if clock.needs_sync():
+            clock.sync(self.get_position_info(sid))
+        self.current_position_info[sid] = clock.get_position_info()
         if self.options.logging:
             out = "%s current_position_info: %s\n" % (ZP, self.current_position_info[sid])
             self.write_log(out)
@@ -543,6 +619,7 @@ class ControlPointScrob(object):
         ZP = self.zoneattributes[self.at_subscription_ids[sid]]['CurrentZoneName']
         trackURI = self.current_track_URI[sid]
         database = ''
+        filename = ''
         extras = ''
         if '?sid=' in trackURI and '&flags=' in trackURI:
             musicservices = self.musicservices[self.at_subscription_ids[sid]]
@@ -566,17 +643,24 @@ class ControlPointScrob(object):
         else:
             service = "UNKNOWN"
 
-        trackdata = self.unwrap_metadata(self.current_track_metadata[sid])
+        title, artist, album = self.unwrap_metadata(self.current_track_metadata[sid])
+        trackdata = '"%s","%s","%s"' % (title, artist, album)
 #        currenttime = time.time()
 
+        self.playcount_writer.add_play(self.current_track_start[sid], title, artist, album, self.current_track_duration[sid], database, filename)
+
         scrob_log ='"%s","%s","%s",%s,"%s","%s"%s\n' % (self.current_track_start[sid], ZP, service, trackdata, self.current_track_duration[sid], trackURI, extras)
         scrob_log = scrob_log.encode(enc, 'replace')
         print scrob_log
         self.write_log(scrob_log)
         
-        f = open(self.pc_file, 'a')
-        f.write(scrob_log)
-        f.close()
+        if self.pc_log_file != None:
+            self.pc_log_lock.acquire()
+            try:
+                self.pc_log_file.write(scrob_log)
+                self.pc_log_file.flush()
+            finally:
+                self.pc_log_lock.release()
         self.current_track_scrobbled[sid] = True
         self.previous_track_URI[sid] = self.current_track_URI[sid]
 
@@ -591,6 +675,9 @@ class ControlPointScrob(object):
         f.close()
 
     def unwrap_metadata(self, metadata):
+        return self.metadata_cache.get(metadata)
+
+    def parse_metadata(self, metadata):
         title = artist = album = ''
         elt = self.from_string(metadata)
         ns = "{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}"
@@ -606,10 +693,12 @@ class ControlPointScrob(object):
             ialbum = item.find('{urn:schemas-upnp-org:metadata-1-0/upnp/}album')
             if ialbum != None:
                 album = ialbum.text
-        details = '"%s","%s","%s"' % (title, artist, album)
-        return details
+        return (title, artist, album)
 
     def unwrap_transport_metadata(self, metadata):
+        return self.transport_metadata_cache.get(metadata)
+
+    def parse_transport_metadata(self, metadata):
         title = ''
         elt = self.from_string(metadata)
         ns = "{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}"
@@ -646,7 +735,7 @@ class ControlPointScrob(object):
             if self.options.verbose:
                 out = "notification dequeued: seq=%s, sid=%s\nchanged_vars=%s\n\n" % (seq, sid, changed_vars)
                 self.write_log(out)
-            self.on_device_event_seq(sid, seq, changed_vars)
+            self.event_dispatcher.put(sid, seq, changed_vars)
             return None
         return event
 
@@ -679,28 +768,26 @@ class ControlPointScrob(object):
 
                 ZP = self.zoneattributes[self.at_subscription_ids[sid]]['CurrentZoneName']
                 
-                # event from AVTransport
-                # TODO: check if we need to remove the ns, and if it is actually removed anyway
-                ns = "{urn:schemas-upnp-org:metadata-1-0/AVT/}"
-                elt = self.from_string(changed_vars['LastChange'])
-                self.remove_namespace(elt, ns)
-                # check if it is initial event message
-                if self.current_renderer_events_avt == {}:
-                    # save all tags
-                    self.process_event_tags_avt(elt, self.current_renderer_events_avt)
-                else:
-                    # not initial message, update vars
-                    tag_list = {}
-                    self.process_event_tags_avt(elt, tag_list)
-                    # save changed tags                    
-                    for key, value in tag_list.iteritems():
-                        self.current_renderer_events_avt[key] = value
-
-                self.current_play_state[sid] = self.current_renderer_events_avt['TransportState']
-                self.avt_track_URI[sid] = self.current_renderer_events_avt['CurrentTrackURI']
+                # event from AVTransport - save the tags we use
+                # (all of them on the initial event message, changed ones after)
+                tag_list = parse_lastchange(changed_vars['LastChange'], AVT_NS, self.avt_variables)
+                if not sid in self.zone_events_avt:
+                    self.zone_events_avt[sid] = {}
+                events_avt = self.zone_events_avt[sid]
+                previous_track = (events_avt.get('CurrentTrack'), events_avt.get('CurrentTrackURI'))
+                events_avt.update(tag_list)
+
+                self.current_play_state[sid] = events_avt['TransportState']
+                self.avt_track_URI[sid] = events_avt['CurrentTrackURI']
+                if not sid in self.position_clocks:
+                    self.position_clocks[sid] = PlaybackClock(self.position_resync_interval)
+                clock = self.position_clocks[sid]
+                clock.set_state(self.current_play_state[sid])
+                if previous_track != (events_avt.get('CurrentTrack'), events_avt['CurrentTrackURI']):
+                    clock.track_changed()
                 if self.current_play_state[sid] != 'STOPPED':
-                    self.current_transport_metadata[sid] = self.current_renderer_events_avt['{urn:schemas-rinconnetworks-com:metadata-1-0/}EnqueuedTransportURIMetaData']
-                if 'TransportErrorDescription' in self.current_renderer_events_avt:
+                    self.current_transport_metadata[sid] = events_avt[RCNW_NS + 'EnqueuedTransportURIMetaData']
+                if 'TransportErrorDescription' in events_avt:
                     self.transport_error[sid] = True
                 else:
                     self.transport_error[sid] = False
@@ -713,16 +800,6 @@ class ControlPointScrob(object):
                 uuid = sid.split('_sub')[0]
                 self.mediaservers[uuid], self.databases[uuid] = self.process_thirdpartymediaservers(changed_vars['ThirdPartyMediaServers'])
  
-    def process_event_tags_avt(self, elt, event_list):
-        # save values
-        InstanceID = elt.find('InstanceID')
-        if InstanceID != None:
-            event_list['InstanceID'] = InstanceID.get('val')    # not checking this at present, assuming zero
-            for child in elt.findall('InstanceID/*'):
-                nodename = child.tag
-                val = child.get('val')
-                event_list[nodename] = val
-
     def process_thirdpartymediaservers(self, thirdpartymediaservers):
         elt = self.from_string(thirdpartymediaservers)
         mediaservers = {}
@@ -815,6 +892,9 @@ class ControlPointScrob(object):
         print "cancelling subscriptions, please wait..."
         self.cancel_subscriptions()
         print "subscriptions cancelled."
+        self.playcount_writer.stop()
+        if self.pc_log_file != None:
+            self.pc_log_file.close()
         reactor.main_quit()
 
 def ustr(string):
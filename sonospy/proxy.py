@@ -23,10 +23,18 @@ import sys
 import os
 import re
 import time
+import bisect
 import ConfigParser
 import sqlite3
+import threading
+import Queue
 
 from transcode import checktranscode
+from searchcriteria import PlanCache, SearchCriteriaError, has_search_index, search_rank
+from didl import item_options_key, maketime, fixMime, getProtocol, getFileType
+from librarydb import LibraryDatabase, MODES as LIBRARY_DB_MODES, DEFAULT_MMAP_SIZE
+from smartcontainers import SMART_CONTAINER_IDS, PLAYED_CONTAINER_IDS, get_smart_containers, get_smart_container_tracks
+from containercache import ContainerCache, DEFAULT_MAX_ENTRIES
 
 from xml.etree.ElementTree import _ElementInterface
 from xml.etree import cElementTree as ElementTree
@@ -34,6 +42,8 @@ from xml.etree import cElementTree as ElementTree
 from xml.sax.saxutils import escape, unescape
 
 from brisa.core import log
+from brisa.core.threaded_call import run_async_function
+from brisa.utils.looping_call import LoopingCall
 
 from brisa.core import webserver, network
 
@@ -42,12 +52,52 @@ from brisa.upnp.device.service import Service
 from brisa.upnp.device.service import StateVariable
 from brisa.upnp.soap import HTTPProxy, HTTPRedirect
 from brisa.core.network import parse_url, get_ip_address, parse_xml
-from brisa.utils.looping_call import LoopingCall
 
 enc = sys.getfilesystemencoding()
 
 MULTI_SEPARATOR = '\n'
 
+# containers evented in ContainerUpdateIDs when the library changes
+ROOT_CONTAINER_IDS = ['0', '6', '100', '7', '108', '5', '99', 'F']
+
+# seconds between checks of the library database for a completed scan
+LIBRARY_POLL_INTERVAL = 10.0
+
+# database the proxied server container maps are saved in, and the
+# seconds between checks of the server's SystemUpdateID
+CONTAINER_CACHE_DB = 'proxycache.sqlite'
+CONTAINER_CACHE_CHECK_INTERVAL = 600.0
+CONTAINER_CACHE_PAGE = 500
+
+# proxied server containers searched at once for items, the seconds a
+# search of them can take, and the number of their results kept
+DEFAULT_SEARCH_THREADS = 4
+DEFAULT_SEARCH_TIMEOUT = 10.0
+MAX_CHILD_RESULTS = 1000
+
+# Search result windows kept for controllers' next page requests, and the
+# prefetches of them waiting for the prefetch thread (older ones are dropped)
+MAX_SEARCH_WINDOWS = 64
+MAX_SEARCH_PREFETCHES = 4
+
+# sort types the proxy gets orders for, compiled when the library loads
+SORT_TYPES = ['ARTIST', 'ALBUMARTIST', 'GENRE_ARTIST', 'GENRE_ALBUMARTIST', 'ALBUM',
+              'COMPOSER_ALBUM', 'ARTIST_ALBUM', 'ALBUMARTIST_ALBUM', 'CONTRIBUTINGARTIST_ALBUM',
+              'COMPOSER', 'GENRE']
+
+# field combinations of the track searches that have their own queries,
+# other track searches are run from their compiled criteria
+TRACK_SEARCH_FIELDS = [(),
+                       ('microsoft:authorComposer',),
+                       ('microsoft:artistAlbumArtist',),
+                       ('microsoft:artistPerformer',),
+                       ('upnp:genre',),
+                       ('microsoft:authorComposer', 'upnp:album'),
+                       ('microsoft:artistAlbumArtist', 'upnp:album'),
+                       ('microsoft:artistPerformer', 'upnp:album'),
+                       ('microsoft:artistAlbumArtist', 'upnp:genre'),
+                       ('microsoft:artistAlbumArtist', 'upnp:album', 'upnp:genre')]
+
 class Proxy(object):
 
     def __init__(self, proxyname, proxytype, proxytrans, udn, config, port, 
@@ -124,7 +174,8 @@ class Proxy(object):
                                   serial_number=self.dbname,
                                   udp_listener=udp_listener,
                                   create_webserver=self.createwebserver,
-                                  force_listen_url=listen_url)
+                                  force_listen_url=listen_url,
+                                  webserver_adapter=webserver.ReactorAdapter)
         self.root_device.webserver.get_render = self.get_render
 
 
@@ -147,7 +198,8 @@ class Proxy(object):
 
     def _create_webserver(self, wmpurl):
         p = network.parse_url(wmpurl)
-        self.wmpwebserver = webserver.WebServer(host=p.hostname, port=p.port)
+        self.wmpwebserver = webserver.WebServer(host=p.hostname, port=p.port,
+                                                adapter=webserver.ReactorAdapter)
         self.wmplocation = self.wmpwebserver.get_listen_url()
         self.wmpcontroller = ProxyServerController(self, 'WMPNSSv3')
         self.wmpwebserver.add_resource(self.wmpcontroller)
@@ -219,7 +271,10 @@ class Proxy(object):
         dbname = dbfacets[0]
         log.debug("proxy.get_Track objectID: %s" % objectID)
         log.debug("proxy.get_Track dbname: %s" % dbname)
-        db = sqlite3.connect(os.path.join(os.getcwd(), dbname))
+        if dbname == self.cdservice.dbname:
+            db = self.cdservice.library.connect()
+        else:
+            db = sqlite3.connect(os.path.join(os.getcwd(), dbname))
         c = db.cursor()
 
         statement = "select * from tracks where id = '%s'" % (objectID)
@@ -291,41 +346,6 @@ class ContentDirectory(Service):
     service_type = 'urn:schemas-upnp-org:service:ContentDirectory:1'
     scpd_xml_path = os.path.join(os.getcwd(), 'content-directory-scpd.xml')
 
-    searchArtists = {}
-    searchContributing = {}
-    searchAlbums = {}
-    searchComposers = {}
-    searchGenres = {}
-    searchTracks = {}
-    searchPlaylists = {}
-
-    dictmapping = {'Artist'                 : searchArtists,
-                   'Contributing Artists'   : searchContributing,
-                   'Album'                  : searchAlbums,
-                   'Composer'               : searchComposers,
-                   'Genre'                  : searchGenres,
-                   'Tracks'                 : searchTracks,
-                   'Playlists'              : searchPlaylists }
-
-    decaches = {'microsoft:artistAlbumArtist'   : searchArtists,
-# should not be needed as replace is performed later                'upnp:artist'     : searchArtists,  # TODO: create this automatically from mapping
-                'microsoft:artistPerformer'     : searchContributing,
-                'upnp:album'                    : searchAlbums,
-                'microsoft:authorComposer'      : searchComposers,
-# should not be needed as replace is performed later                'upnp:author'      : searchComposers,  # TODO: create this automatically from mapping
-                'upnp:genre'                    : searchGenres,
-                'NOT_NEEDED'                    : searchTracks,
-                'ug'                            : searchPlaylists }
-
-    # TODO: fix playlists
-
-    defaultcaches = {'107' + ' - ' + 'upnp:class = "object.container.person.musicArtist"' : searchArtists,
-                     '100' + ' - ' + 'upnp:class = "object.container.person.musicArtist"' : searchContributing,
-                     '0'   + ' - ' + 'upnp:class = "object.container.album.musicAlbum"'   : searchAlbums,
-                     '108' + ' - ' + 'upnp:class = "object.container.person.musicArtist"' : searchComposers,
-                     '0'   + ' - ' + 'upnp:class = "object.container.genre.musicGenre"'   : searchGenres,
-                     '0'   + ' - ' + 'upnp:class derivedfrom "object.item.audioItem"'     : searchTracks,
-                     '0'   + ' - ' + 'upnp:class = "object.container.playlistContainer"'  : searchPlaylists }
     defaultop = '='
 
     def __init__(self, controlpoint, mediaserver, proxyaddress, proxy):
@@ -338,6 +358,54 @@ class ContentDirectory(Service):
         self.proxy = proxy
         self.translate = 0
         self.subtranslate = ''
+        # title -> container ID maps for the proxied server's containers,
+        # see containercache.py
+        max_entries = DEFAULT_MAX_ENTRIES
+        try:
+            max_entries = int(self.proxy.config.get('INI', 'proxy_cache_size'))
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        except ValueError:
+            pass
+        self.container_cache = ContainerCache(os.path.join(os.getcwd(), CONTAINER_CACHE_DB), mediaserver.udn, max_entries)
+        self.searchArtists = self.container_cache.get_map('Artist')
+        self.searchContributing = self.container_cache.get_map('Contributing Artists')
+        self.searchAlbums = self.container_cache.get_map('Album')
+        self.searchComposers = self.container_cache.get_map('Composer')
+        self.searchGenres = self.container_cache.get_map('Genre')
+        self.searchTracks = self.container_cache.get_map('Tracks')
+        self.searchPlaylists = self.container_cache.get_map('Playlists')
+
+        self.dictmapping = {'Artist'                 : self.searchArtists,
+                            'Contributing Artists'   : self.searchContributing,
+                            'Album'                  : self.searchAlbums,
+                            'Composer'               : self.searchComposers,
+                            'Genre'                  : self.searchGenres,
+                            'Tracks'                 : self.searchTracks,
+                            'Playlists'              : self.searchPlaylists }
+
+        self.decaches = {'microsoft:artistAlbumArtist'   : self.searchArtists,
+# should not be needed as replace is performed later                'upnp:artist'     : self.searchArtists,  # TODO: create this automatically from mapping
+                         'microsoft:artistPerformer'     : self.searchContributing,
+                         'upnp:album'                    : self.searchAlbums,
+                         'microsoft:authorComposer'      : self.searchComposers,
+# should not be needed as replace is performed later                'upnp:author'      : self.searchComposers,  # TODO: create this automatically from mapping
+                         'upnp:genre'                    : self.searchGenres,
+                         'NOT_NEEDED'                    : self.searchTracks,
+                         'ug'                            : self.searchPlaylists }
+
+        # TODO: fix playlists
+
+        self.defaultcaches = {'107' + ' - ' + 'upnp:class = "object.container.person.musicArtist"' : self.searchArtists,
+                              '100' + ' - ' + 'upnp:class = "object.container.person.musicArtist"' : self.searchContributing,
+                              '0'   + ' - ' + 'upnp:class = "object.container.album.musicAlbum"'   : self.searchAlbums,
+                              '108' + ' - ' + 'upnp:class = "object.container.person.musicArtist"' : self.searchComposers,
+                              '0'   + ' - ' + 'upnp:class = "object.container.genre.musicGenre"'   : self.searchGenres,
+                              '0'   + ' - ' + 'upnp:class derivedfrom "object.item.audioItem"'     : self.searchTracks,
+                              '0'   + ' - ' + 'upnp:class = "object.container.playlistContainer"'  : self.searchPlaylists }
+
         self.caches = {}
         self.sonos_containers = {}
         self.sonos_decache = {}
@@ -347,6 +415,37 @@ class ContentDirectory(Service):
         self.attribute_mappings = {}
         self.operators = [self.defaultop]
 
+        # child containers searched for items, see search_children, with
+        # the proxied server's SystemUpdateID they were searched under
+        self.child_results = {}
+        self.child_updateid = None
+        self.child_lock = threading.Lock()
+        self.search_queue = Queue.Queue()
+        self.search_threads = DEFAULT_SEARCH_THREADS
+        try:
+            self.search_threads = max(1, int(self.proxy.config.get('INI', 'proxy_search_threads')))
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        except ValueError:
+            pass
+        self.search_timeout = DEFAULT_SEARCH_TIMEOUT
+        try:
+            self.search_timeout = float(self.proxy.config.get('INI', 'proxy_search_timeout'))
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        except ValueError:
+            pass
+        # the threads child containers are searched on, shared by all
+        # requests
+        for n in range(self.search_threads):
+            search_thread = threading.Thread(target=self.search_worker, name='proxy-search-%d' % n)
+            search_thread.setDaemon(True)
+            search_thread.start()
+
         Service.__init__(self, self.service_name, self.service_type, url_base='', scpd_xml_filepath=self.scpd_xml_path)
 
         # TODO: add error processing for ini file entries
@@ -440,6 +539,99 @@ class ContentDirectory(Service):
 #            print self.attribute_mappings
 #            print "##############################"
 
+        # check the saved container maps are still valid for the server and
+        # fill any that are empty, then keep checking in case it changes
+        self.cache_check = None
+        if self.translate == 'Cache':
+            self.cache_check = LoopingCall(run_async_function, self.refresh_cache)
+            self.cache_check.start(CONTAINER_CACHE_CHECK_INTERVAL, now=True)
+
+    def refresh_cache(self):
+        '''
+        Clears the container maps if the server's SystemUpdateID has changed
+        since they were filled, then walks the server's top level containers
+        for the maps that are empty.
+        '''
+        try:
+            result = self.controlpoint.proxyGetSystemUpdateID(self.mediaserver)
+        except Exception, e:
+            print "Error getting SystemUpdateID from proxied server:", e
+            return
+        if not 'Id' in result:
+            return
+        if self.container_cache.set_updateid(result['Id']):
+            log.debug("proxied server SystemUpdateID changed to %s, container maps cleared" % result['Id'])
+        for searchkey, searchtype in self.sonos_decache.iteritems():
+            cachestring = self.cache_string(searchkey)
+            cache = self.caches.get(cachestring)
+            if searchtype == 'Tracks' or cache == None or len(cache) > 0:
+                continue
+            self.fill_cache(searchkey, searchtype, cache)
+
+    def cache_string(self, searchkey):
+        # returns the key of self.caches for a key of self.sonos_decache
+        valuestring = searchkey.split(',')
+        return valuestring[0] + ' - ' + 'upnp:class ' + (len(valuestring) > 2 and valuestring[2] or self.defaultop) + ' "' + valuestring[1] + '"'
+
+    def fill_cache(self, searchkey, searchtype, cache):
+        '''
+        Fills a top level container map by searching its container as Sonos
+        does when it opens it.
+        '''
+        containerID = searchkey.split(',')[0]
+        searchCriteria = self.cache_string(searchkey).split(' - ', 1)[1] + ' and @refID exists false'
+        startingIndex = 0
+        while True:
+            try:
+                result = self.soap_Search(ContainerID=containerID, SearchCriteria=searchCriteria, Filter='*', StartingIndex=str(startingIndex), RequestedCount=str(CONTAINER_CACHE_PAGE), SortCriteria='')
+                returned = int(result['NumberReturned'])
+                total = int(result['TotalMatches'])
+            except Exception, e:
+                log.error("Error filling %s container map: %s" % (searchtype, e))
+                break
+            startingIndex += returned
+            if returned == 0 or startingIndex >= total:
+                break
+        log.debug("%s container map: %d entries" % (searchtype, len(cache)))
+
+    def find_container(self, cache, titles):
+        '''
+        Returns the container ID in cache for the container with titles (the
+        titles of it and the containers above it, as saved by update_cache),
+        or None if the server doesn't have it. If the title isn't in the map
+        (it has been evicted, or the maps cleared since Sonos last searched)
+        the container it came from is searched again.
+        '''
+        dctitle = ' - '.join(titles)
+        containerID = cache.get(dctitle)
+        if containerID != None:
+            return containerID
+        if len(titles) == 1:
+            # top level map
+            for searchkey, searchtype in self.sonos_decache.iteritems():
+                if self.caches.get(self.cache_string(searchkey)) is cache:
+                    self.fill_cache(searchkey, searchtype, cache)
+        else:
+            parentID = self.find_container(cache, titles[:-1])
+            if parentID == None:
+                return None
+            prefix = ' - '.join(titles[:-1])
+            startingIndex = 0
+            while True:
+                try:
+                    result = self.controlpoint.proxyBrowse(parentID, 'BrowseDirectChildren', '*', str(startingIndex), str(CONTAINER_CACHE_PAGE), '', self.mediaserver)
+                    returned = int(result['NumberReturned'])
+                    total = int(result['TotalMatches'])
+                except Exception, e:
+                    log.error("Error browsing container %s: %s" % (parentID, e))
+                    break
+                if 'Result' in result:
+                    self.update_cache(result['Result'], cache, prefix)
+                startingIndex += returned
+                if returned == 0 or startingIndex >= total:
+                    break
+        self.container_cache.flush()
+        return cache.get(dctitle)
 
     def soap_Browse(self, *args, **kwargs):
 #        for key in kwargs:
@@ -615,6 +807,7 @@ class ContentDirectory(Service):
                         cache = self.caches[mscontainerID + ' - ' + searchelements[0]]
                         # save results in cache
                         self.update_cache(result['Result'], cache)
+                        self.container_cache.flush()
 
             elif len(searchelements) >= 3:
                 # not first time through, use cache to get container id
@@ -628,7 +821,7 @@ class ContentDirectory(Service):
                 # get cache
                 classstring = searchelements[2].split(' = ')
                 upnpclass = classstring[0]
-                dctitle = classstring[1][1:-1]
+                titles = [classstring[1][1:-1]]
                 cache = self.decaches[upnpclass]
 
                 # add on any subelements to cache item name
@@ -638,9 +831,14 @@ class ContentDirectory(Service):
                         substring = searchelements[i].split(' = ')
                         subtype = substring[0]
                         subtitle = substring[1][1:-1]
-                        dctitle += ' - ' + subtitle  
-                
-                containerID = cache[dctitle]
+                        titles.append(subtitle)
+                dctitle = ' - '.join(titles)
+
+                containerID = self.find_container(cache, titles)
+                if containerID == None:
+                    log.warning("proxy_search - container %s not found on proxied server" % dctitle)
+                    result = {'NumberReturned': '0', 'UpdateID': '1', 'Result': '', 'TotalMatches': '0'}
+                    return result
 
 #                print "containerID: " + str(containerID)
 
@@ -675,31 +873,17 @@ class ContentDirectory(Service):
 
                     # save in cache with prefix of search class
                     container_found, item_found, container_list = self.update_cache(result['Result'], cache, dctitle)
+                    self.container_cache.flush()
 
                     if check_for_containers == True and container_found == True and self.subtranslate == 'Discrete':
                         # In this search Sonos is expecting items rather than containers, but we found containers
                         # We need to search the containers too
 #                        print container_list
                         new_result = {}
-                        numberReturned = totalMatches = 0
-                        items = ''
                         if 'UpdateID' in result:
                             new_result['UpdateID'] = result['UpdateID']
-                        
-                        for childID in container_list:
-                            child_result = self.controlpoint.proxySearch(childID, searchCriteria, kwargs['Filter'], kwargs['StartingIndex'], kwargs['RequestedCount'], kwargs['SortCriteria'], self.mediaserver)
-                            if 'Result' in child_result:
-                                numberReturned += int(child_result['NumberReturned'])
-                                totalMatches += int(child_result['TotalMatches'])
-
-                                # split out items and containers                                
-                                item, containers = self.process_result(child_result['Result'])
-                                # for containers, append to list we are processing
-                                if containers != []:
-                                    container_list += containers
-                                # for items, add to found items
-                                if item != '':
-                                    items += item
+
+                        numberReturned, totalMatches, items = self.search_children(container_list, searchCriteria, kwargs)
                         result_xml  = '<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:dlna="urn:schemas-dlna-org:metadata-1-0/">'
                         result_xml += items
                         result_xml += '</DIDL-Lite>'
@@ -839,7 +1023,7 @@ class ContentDirectory(Service):
 
     def process_result(self, result):
         container_list = []
-        items = ''
+        items = []
         elt = parse_xml(result)
         elt = elt.getroot()
         for item in elt.getchildren():
@@ -847,8 +1031,141 @@ class ContentDirectory(Service):
                 containerid = item.attrib.get('id')
                 container_list.append(containerid)
             elif item.tag == '{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}item':
-                items += ElementTree.tostring(item)
-        return items, container_list
+                items.append(ElementTree.tostring(item))
+        return ''.join(items), container_list
+
+    def search_children(self, container_list, searchCriteria, kwargs):
+        '''
+        Searches the containers in container_list, and the containers they
+        contain, for items. Returns (numberReturned, totalMatches, items).
+
+        Each level of the tree is searched on the search_threads threads
+        shared by all requests and the results are combined in the same
+        order as if the containers were searched one by one. Containers not
+        searched within search_timeout seconds are left out.
+        '''
+        deadline = time.time() + self.search_timeout
+        updateid = self.child_results_updateid()
+        numberReturned = totalMatches = 0
+        items = []
+        level = container_list
+        while level != []:
+            results = self.search_level(level, searchCriteria, kwargs, updateid, deadline)
+            level = []
+            for child in results:
+                if child == None:
+                    continue
+                childReturned, childMatches, item, containers = child
+                numberReturned += childReturned
+                totalMatches += childMatches
+                # for containers, search them at the next level
+                level += containers
+                # for items, add to found items
+                if item != '':
+                    items.append(item)
+        return numberReturned, totalMatches, ''.join(items)
+
+    def child_results_updateid(self):
+        # returns the proxied server's SystemUpdateID, clearing child_results
+        # and the container maps if it has changed since they were filled, or
+        # None if it can't be read (and the children mustn't be cached)
+        try:
+            result = self.controlpoint.proxyGetSystemUpdateID(self.mediaserver)
+        except Exception, e:
+            log.error("proxy_search - error getting SystemUpdateID: %s" % e)
+            return None
+        updateid = result.get('Id')
+        if updateid == None:
+            return None
+        if self.container_cache.set_updateid(updateid):
+            log.debug("proxied server SystemUpdateID changed to %s, container maps cleared" % updateid)
+        self.child_lock.acquire()
+        try:
+            if updateid != self.child_updateid:
+                self.child_results.clear()
+                self.child_updateid = updateid
+        finally:
+            self.child_lock.release()
+        return updateid
+
+    def search_worker(self):
+        while True:
+            func, args = self.search_queue.get()
+            try:
+                func(*args)
+            except Exception, e:
+                log.error("proxy_search - error in search thread: %s" % e)
+
+    def search_level(self, level, searchCriteria, kwargs, updateid, deadline):
+        # returns the search_child results for the containers in level, in
+        # order, None for the ones that failed or didn't finish in time
+        results = [None] * len(level)
+        pending = [len(level)]
+        done = threading.Condition()
+
+        def search(i, childID):
+            child = None
+            try:
+                if time.time() < deadline:
+                    child = self.search_child(childID, searchCriteria, kwargs, updateid)
+            finally:
+                done.acquire()
+                try:
+                    results[i] = child
+                    pending[0] -= 1
+                    done.notify()
+                finally:
+                    done.release()
+
+        for entry in enumerate(level):
+            self.search_queue.put((search, entry))
+        done.acquire()
+        try:
+            while pending[0] > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    log.warning("proxy_search - timed out searching %d containers" % pending[0])
+                    break
+                done.wait(remaining)
+            return list(results)
+        finally:
+            done.release()
+
+    def search_child(self, childID, searchCriteria, kwargs, updateid):
+        # returns (numberReturned, totalMatches, items, containers) for a
+        # child container, from child_results if the server's SystemUpdateID
+        # hasn't changed since it was last searched
+        key = (self.mediaserver.udn, childID, searchCriteria, kwargs['Filter'], kwargs['StartingIndex'], kwargs['RequestedCount'], kwargs['SortCriteria'], updateid)
+        if updateid != None:
+            self.child_lock.acquire()
+            try:
+                child = self.child_results.get(key)
+            finally:
+                self.child_lock.release()
+            if child != None:
+                return child
+        try:
+            child_result = self.controlpoint.proxySearch(childID, searchCriteria, kwargs['Filter'], kwargs['StartingIndex'], kwargs['RequestedCount'], kwargs['SortCriteria'], self.mediaserver)
+        except Exception, e:
+            log.error("proxy_search - error searching container %s: %s" % (childID, e))
+            return None
+        if not 'Result' in child_result:
+            return None
+        # split out items and containers
+        item, containers = self.process_result(child_result['Result'])
+        child = (int(child_result['NumberReturned']), int(child_result['TotalMatches']), item, containers)
+        if updateid != None:
+            self.child_lock.acquire()
+            try:
+                if updateid != self.child_updateid:
+                    # searched under an older SystemUpdateID
+                    return child
+                if len(self.child_results) >= MAX_CHILD_RESULTS:
+                    self.child_results.clear()
+                self.child_results[key] = child
+            finally:
+                self.child_lock.release()
+        return child
 
     def soap_GetSearchCapabilities(self, *args, **kwargs):
         result = self.controlpoint.proxyGetSearchCapabilities(self.mediaserver)
@@ -890,6 +1207,65 @@ class ConnectionManager(Service):
 
 
 
+def splitkeys(keys, lower=True):
+    # splits a comma separated sorts column into its entries
+    if not keys:
+        return []
+    if lower:
+        keys = keys.lower()
+    keys = [k.strip() for k in keys.split(',')]
+    return [k for k in keys if k != '']
+
+class SortConfig(object):
+    '''
+    The sorts table compiled for one proxy. Rows are compiled for a sort
+    type on first use, and the orders for each controller/sort type pair
+    are kept, so get_orderby is a dict lookup once warm. A new SortConfig
+    is built for each library generation.
+    '''
+
+    # sort types that are read from the sorts rows of another type
+    sort_type_rows = {'ALBUMARTIST_ALBUM': 'ARTIST_ALBUM',
+                      'ALBUMARTIST': 'ARTIST',
+                      'GENRE_ALBUMARTIST': 'GENRE_ARTIST'}
+
+    def __init__(self, proxyname, rows, compile_sort):
+        self.proxyname = proxyname
+        self.compile_sort = compile_sort
+        # rows that apply to this proxy, in sort_seq order
+        self.rows = []
+        for proxynames, controllers, sort_type, so, sp, ss, albumtypestring, hn in rows:
+            proxykeys = splitkeys(proxynames)
+            if proxyname.lower() in proxykeys or 'all' in proxykeys:
+                self.rows.append((splitkeys(controllers), sort_type, (so, sp, ss, albumtypestring, hn)))
+        self._compiled = {}
+        self._orderby = {}
+
+    def compile(self, sorttype):
+        # returns [(controllerkeys, order entry)] for sorttype
+        compiled = self._compiled.get(sorttype)
+        if compiled == None:
+            rowtype = self.sort_type_rows.get(sorttype, sorttype)
+            compiled = [(controllerkeys, self.compile_sort(sorttype, row)) for controllerkeys, sort_type, row in self.rows if sort_type == rowtype]
+            self._compiled[sorttype] = compiled
+        return compiled
+
+    def get_orderby(self, sorttype, controller):
+        key = (self.proxyname, controller, sorttype)
+        order_out = self._orderby.get(key)
+        if order_out == None:
+            controllerkey = controller.lower()
+            order_out = [entry for controllerkeys, entry in self.compile(sorttype) if controllerkey in controllerkeys or 'all' in controllerkeys]
+            self._orderby[key] = order_out
+        return order_out
+
+    def get_sorts(self):
+        '''
+        Returns the orders looked up so far, keyed on (proxy, controller,
+        sort type), for debugging.
+        '''
+        return dict(self._orderby)
+
 class DummyContentDirectory(Service):
 
     service_name = 'ContentDirectory'
@@ -925,8 +1301,20 @@ class DummyContentDirectory(Service):
         if self.dbname == '':
             self.dbname = 'sonospy.sqlite'
 
-#        self.prime_cache()
-        
+        # compiled SearchCriteria, keyed on criteria shape
+        self.search_plans = PlanCache()
+
+        # Search results prefetched in the background by one thread, keyed
+        # on search_window_key
+        self.search_windows = {}
+        self.search_prefetching = set()
+        self.search_prefetches = []
+        self.search_lock = threading.Lock()
+        self.search_prefetch_ready = threading.Condition(self.search_lock)
+        prefetch_thread = threading.Thread(target=self.prefetch_worker, name='search-prefetch')
+        prefetch_thread.setDaemon(True)
+        prefetch_thread.start()
+
         # get path replacement strings
         try:        
             self.pathreplace = self.proxy.config.get('INI', 'network_path_translation')
@@ -1145,11 +1533,48 @@ class DummyContentDirectory(Service):
         except ConfigParser.NoOptionError:
             pass
 
+        # get library database mode
+        library_db_mode = 'disk'    # default
+        try:        
+            library_db_mode = self.proxy.config.get('INI', 'library_db_mode').lower()
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        if not library_db_mode in LIBRARY_DB_MODES: library_db_mode = 'disk'
+
+        library_db_mmap_size = DEFAULT_MMAP_SIZE
+        try:        
+            library_db_mmap_size = int(self.proxy.config.get('INI', 'library_db_mmap_size'))
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+        except ValueError:
+            pass
+
+        self.library = LibraryDatabase(os.path.join(os.getcwd(), self.dbname), library_db_mode, library_db_mmap_size)
+
+        # precomputed track items (see didl.py) are used if movetags built
+        # them with the same settings as ours
+        self.track_items = True
+        self.track_item_options = item_options_key((self.now_playing_artist, self.now_playing_artist_combiner, self.mouseover_artist, self.mouseover_artist_combiner, self.prefer_folderart))
+        self.track_item_slots = {'proxyaddress': self.proxyaddress, 'dbname': self.dbname}
+
         Service.__init__(self, self.service_name, self.service_type, url_base='', scpd_xml_filepath=self.scpd_xml_path)
 
+        # load the library and watch for scans (and plays) that change it
         self.updateid = ''
-        self.update_loop = LoopingCall(self.get_updateid)
-        self.update_loop.start(60.0, now=True)
+        self.library_version = None
+        self.library.add_preparer('sorts', self.load_sorts)
+        self.library.add_preparer('search_index', has_search_index)
+        self.library.add_function('search_rank', 1, search_rank)
+        if self.library.mode != 'memory':
+            self.library.add_preparer('primed', self.prime_cache)
+        generation = self.library.load()
+        if generation != None:
+            self.library_changed(generation)
+        self.library.watch(LIBRARY_POLL_INTERVAL, self.library_changed)
 
     def get_delim(self, delimname, default, special, when=None):
         delim = default
@@ -1204,7 +1629,7 @@ class DummyContentDirectory(Service):
         browseFlag = kwargs['BrowseFlag']
         log.debug("objectID: %s" % objectID)
 
-        db = sqlite3.connect(os.path.join(os.getcwd(), self.dbname))
+        db = self.library.connect()
         c = db.cursor()
 
         startingIndex = int(kwargs['StartingIndex'])
@@ -1221,8 +1646,11 @@ class DummyContentDirectory(Service):
             objectIDval = -1
             
         browsetype = ''
+        total = -1
         
-        if objectIDval == 0:
+        if objectID in SMART_CONTAINER_IDS:
+            browsetype = 'Smart'
+        elif objectIDval == 0:
             browsetype = 'Root'
         elif objectIDval >= self.album_parentid and objectIDval <= (self.album_parentid + self.id_range):
             browsetype = 'Album'
@@ -1283,12 +1711,18 @@ class DummyContentDirectory(Service):
                 statement = "select * from tracks where %s order by tracknumber, title" % (where)
                 log.debug("statement: %s", statement)
                 c.execute(statement)
-            for row in c:
+            rows = c.fetchall()
+            trackitems = self.get_track_items(c, [row[0] for row in rows])
+            for row in rows:
                 log.debug("row: %s", row)
                 if album_type != 10:
                     id, id2, parentID, duplicate, title, artist, album, genre, tracknumber, year, albumartist, composer, codec, length, size, created, path, filename, discnumber, comment, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, lastmodified, upnpclass, folderartid, trackartid, inserted, lastplayed, playcount, lastscanned, d1, d2, d3, d4, d5, d6, d7, d8, d9, d10 = row
                 else:
                     id, id2, parentID, duplicate, title, artist, album, genre, tracknumber, year, albumartist, composer, codec, length, size, created, path, filename, discnumber, comment, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, lastmodified, upnpclass, folderartid, trackartid, inserted, lastplayed, playcount, lastscanned = row
+                if id in trackitems:
+                    count += 1
+                    ret += self.add_track_item(trackitems[id], id, path, filename, browse=True)
+                    continue
                 mime = fixMime(mime)
                 cover, artid = self.choosecover(folderart, trackart, folderartid, trackartid)
 
@@ -1368,79 +1802,17 @@ class DummyContentDirectory(Service):
             statement = "select * from tracks where id = '%s'" % (objectID)
             log.debug("statement: %s", statement)
             c.execute(statement)
-            for row in c:   # will only be one row
+            rows = c.fetchall()
+            trackitems = self.get_track_items(c, [row[0] for row in rows])
+            for row in rows:   # will only be one row
 #                log.debug("row: %s", row)
                 id, id2, parentID, duplicate, title, artist, album, genre, tracknumber, year, albumartist, composer, codec, length, size, created, path, filename, discnumber, comment, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, lastmodified, upnpclass, folderartid, trackartid, inserted, lastplayed, playcount, lastscanned = row
-                mime = fixMime(mime)
-                cover, artid = self.choosecover(folderart, trackart, folderartid, trackartid)
-
-                # TODO: automate mount
-                wsfile = filename
-                wspath = os.path.join(path, filename)
-                path = self.convert_path(path)
-                filepath = path + filename
-                filepath = encode_path(filepath)
-                filepath = escape(filepath, escape_entities)
-                protocol = getProtocol(mime)
-                contenttype = mime
-                filetype = getFileType(filename)
-                
-                transcode, newtype = checktranscode(filetype, bitrate, samplerate, bitspersample, channels, codec)
-                if transcode:
-                    dummyfile = self.dbname + '.' + id + '.' + newtype
-                else:
-                    dummyfile = self.dbname + '.' + id + '.' + filetype
-                res = self.proxyaddress + '/WMPNSSv3/' + dummyfile
-                if transcode:
-                    log.debug('\ndummyfile: %s\nwsfile: %s\nwspath: %s\ncontenttype: %s\ntranscodetype: %s' % (dummyfile, wsfile, wspath, contenttype, newtype))
-                    dummystaticfile = webserver.TranscodedFileSonos(dummyfile, wsfile, wspath, newtype, contenttype, cover=cover)
-                    self.proxy.wmpcontroller.add_transcoded_file(dummystaticfile)
-                else:
-                    log.debug('\ndummyfile: %s\nwsfile: %s\nwspath: %s\ncontenttype: %s' % (dummyfile, wsfile, wspath, contenttype))
-                    dummystaticfile = webserver.StaticFileSonos(dummyfile, wsfile, wspath, contenttype, cover=cover)
-                    self.proxy.wmpcontroller.add_static_file(dummystaticfile)
-                
-                if cover != '' and not cover.startswith('EMBEDDED_'):
-                    cvfile = getFile(cover)
-                    cvpath = cover
-                    coverfiletype = getFileType(cvfile)
-                    dummycoverfile = self.dbname + '.' + str(artid) + '.' + coverfiletype
-                    coverres = self.proxyaddress + '/WMPNSSv3/' + dummycoverfile
-                    dummycoverstaticfile = webserver.StaticFileSonos(dummycoverfile, cvfile, cvpath)    # TODO: pass contenttype
-                    self.proxy.wmpcontroller2.add_static_file(dummycoverstaticfile)
-                
-                duration = maketime(float(length))
-
-                if title == '': title = '[unknown title]'
-                if artist == '': artist = '[unknown artist]'
-                else: artist = self.get_artist(artist, self.now_playing_artist, self.now_playing_artist_combiner)
-                if albumartist == '': albumartist = '[unknown albumartist]'
-                else: albumartist = self.get_artist(albumartist, self.now_playing_artist, self.now_playing_artist_combiner)
-                if album == '': album = '[unknown album]'
-#                title = escape(title, escape_entities_quotepos)
-#                artist = escape(artist, escape_entities_quotepos)
-#                albumartist = escape(albumartist, escape_entities_quotepos)
-#                album = escape(album, escape_entities_quotepos)
-                title = escape(title)
-                artist = escape(artist)
-                albumartist = escape(albumartist)
-                album = escape(album)
-                tracknumber = self.convert_tracknumber(tracknumber)
-
+                if id in trackitems:
+                    count += 1
+                    ret += self.add_track_item(trackitems[id], id, path, filename)
+                    continue
                 count += 1
-                ret += '<item id="%s" parentID="%s" restricted="true">' % (id, parentID)
-                ret += '<dc:title>%s</dc:title>' % (title)
-                ret += '<upnp:artist role="AlbumArtist">%s</upnp:artist>' % (albumartist)
-                ret += '<upnp:artist role="Performer">%s</upnp:artist>' % (artist)
-                ret += '<upnp:album>%s</upnp:album>' % (album)
-                if tracknumber != 0:
-                    ret += '<upnp:originalTrackNumber>%s</upnp:originalTrackNumber>' % (tracknumber)
-                ret += '<upnp:class>%s</upnp:class>' % (upnpclass)
-                ret += '<res duration="%s" protocolInfo="%s">%s</res>' % (duration, protocol, res)
-#####                ret += '<desc id="cdudn" nameSpace="urn:schemas-rinconnetworks-com:metadata-1-0/">%s</desc>' % (self.wmpudn)
-#                if cover != '' and not cover.startswith('EMBEDDED_'):
-#                    ret += '<upnp:albumArtURI>%s</upnp:albumArtURI>' % (coverres)
-                ret += '</item>'
+                ret += self.build_track_item(row)
             ret += '</DIDL-Lite>'
 
         elif browsetype == 'Root':
@@ -1454,6 +1826,7 @@ class DummyContentDirectory(Service):
                          ('5', 'Genres'),
                          ('99', 'Tracks'),
                          ('F', 'Playlists')]
+            rootitems += get_smart_containers(c)
 
             for (id, title) in rootitems:
 
@@ -1463,7 +1836,42 @@ class DummyContentDirectory(Service):
                 ret += '</container>'
 
             ret += '</DIDL-Lite>'
-            count = 7
+            count = len(rootitems)
+
+        elif browsetype == 'Smart':
+
+            ret  = '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+            count = 0
+
+            if browseFlag == 'BrowseMetadata':
+                title = dict(get_smart_containers(c)).get(objectID, '')
+                ret += '<container id="%s" parentID="0" restricted="true">' % (objectID)
+                ret += '<dc:title>%s</dc:title>' % (title)
+                ret += '<upnp:class>object.container</upnp:class>'
+                ret += '</container>'
+                count = 1
+            else:
+                # the tracks are held in order by movetags and the playcount
+                # updates, so any window of them is a read of that many rows
+                ids, total = get_smart_container_tracks(c, objectID, startingIndex, requestedCount)
+                rows = {}
+                if ids:
+                    statement = "select * from tracks where id in (%s)" % ','.join('?' * len(ids))
+                    log.debug("statement: %s", statement)
+                    c.execute(statement, ids)
+                    for row in c.fetchall():
+                        rows[row[0]] = row
+                trackitems = self.get_track_items(c, ids)
+                for id in ids:
+                    if not id in rows:
+                        continue
+                    row = rows[id]
+                    count += 1
+                    if id in trackitems:
+                        ret += self.add_track_item(trackitems[id], id, row[16], row[17], browse=True)
+                    else:
+                        ret += self.build_track_item(row)
+            ret += '</DIDL-Lite>'
 
         elif browsetype == '':
 
@@ -1477,13 +1885,99 @@ class DummyContentDirectory(Service):
         ret = ret.replace(self.webserverurl, self.wmpurl)
 
         log.debug("BROWSE ret: %s", ret)
-        result = {'NumberReturned': str(count), 'UpdateID': self.updateid, 'Result': ret, 'TotalMatches': count}
+        if total == -1:
+            total = count
+        result = {'NumberReturned': str(count), 'UpdateID': self.updateid, 'Result': ret, 'TotalMatches': total}
 
         return result
 
 
     def soap_Search(self, *args, **kwargs):
 
+        # serve the window from the ones prefetched for the previous request
+        # if we can, then prefetch the window after it
+        generation = self.library.current()
+        key = self.search_window_key(generation, kwargs)
+        self.search_lock.acquire()
+        try:
+            result = self.search_windows.pop(key, None)
+        finally:
+            self.search_lock.release()
+        if result == None:
+            result = self.search(generation, **kwargs)
+        else:
+            log.debug("search window cache hit: %s" % str(key))
+        self.prefetch_search(generation, kwargs, result)
+        return result
+
+    def search_window_key(self, generation, kwargs):
+        # plays change the smart containers and play counts between scans
+        return (generation.scanid, generation.plays, kwargs.get('Controller', ''), kwargs['ContainerID'], kwargs['SearchCriteria'], int(kwargs['StartingIndex']), int(kwargs['RequestedCount']))
+
+    def prefetch_search(self, generation, kwargs, result):
+        '''
+        Queues a background search for the window after the one in result,
+        so the controller's request for its next page is answered from
+        search_windows. The window comes from the same library generation,
+        so its TotalMatches is the same.
+        '''
+        returned = int(result['NumberReturned'])
+        nextindex = int(kwargs['StartingIndex']) + returned
+        if returned == 0 or nextindex >= int(result['TotalMatches']):
+            return
+        nextkwargs = dict(kwargs)
+        nextkwargs['StartingIndex'] = str(nextindex)
+        key = self.search_window_key(generation, nextkwargs)
+        self.search_lock.acquire()
+        try:
+            if key in self.search_windows or key in self.search_prefetching:
+                return
+            self.search_prefetching.add(key)
+            self.search_prefetches.append((generation, nextkwargs, key))
+            # a controller paging quickly has moved past the oldest ones
+            while len(self.search_prefetches) > MAX_SEARCH_PREFETCHES:
+                dropped = self.search_prefetches.pop(0)
+                self.search_prefetching.discard(dropped[2])
+            self.search_prefetch_ready.notify()
+        finally:
+            self.search_lock.release()
+
+    def prefetch_worker(self):
+        while True:
+            self.search_prefetch_ready.acquire()
+            try:
+                while not self.search_prefetches:
+                    self.search_prefetch_ready.wait()
+                generation, kwargs, key = self.search_prefetches.pop(0)
+            finally:
+                self.search_prefetch_ready.release()
+            try:
+                self.prefetch_search_window(generation, kwargs, key)
+            except Exception, e:
+                log.error("Error prefetching search window: %s" % e)
+
+    def prefetch_search_window(self, generation, kwargs, key):
+        try:
+            # don't prefetch from a library that has changed since
+            if self.search_window_key(self.library.current(), kwargs) != key:
+                return
+            result = self.search(generation, **kwargs)
+            self.search_lock.acquire()
+            try:
+                if len(self.search_windows) >= MAX_SEARCH_WINDOWS:
+                    self.search_windows.clear()
+                self.search_windows[key] = result
+            finally:
+                self.search_lock.release()
+        finally:
+            self.search_lock.acquire()
+            try:
+                self.search_prefetching.discard(key)
+            finally:
+                self.search_lock.release()
+
+    def search(self, generation, **kwargs):
+
         # TODO
         # TODO: fix compilations
         # TODO
@@ -1498,27 +1992,33 @@ class DummyContentDirectory(Service):
 
         containerID = kwargs['ContainerID']
         searchCriteria = kwargs['SearchCriteria']
-        
-        searchCriteria = self.fixcriteria(searchCriteria)
 
         log.debug('containerID: %s' % str(containerID))
         log.debug('searchCriteria: %s' % searchCriteria.encode(enc, 'replace'))
         log.debug("PROXY_SEARCH: %s", kwargs)
 
-        db = sqlite3.connect(os.path.join(os.getcwd(), self.dbname))
+        try:
+            search = self.search_plans.get(searchCriteria)
+        except SearchCriteriaError, e:
+            log.error("proxy_search - unable to parse search criteria: %s" % e)
+            return {'NumberReturned': '0', 'UpdateID': self.updateid, 'Result': '', 'TotalMatches': 0}
+        plan = search.plan
+        values = search.fields
+
+        db = generation.connect()
         c = db.cursor()
 
         startingIndex = int(kwargs['StartingIndex'])
         requestedCount = int(kwargs['RequestedCount'])
 
-        if (containerID == '107' or containerID == '100') and searchCriteria.startswith('upnp:class = "object.container.person.musicArtist" and @refID exists false'):
+        if (containerID == '107' or containerID == '100') and plan.is_search('object.container.person.musicArtist'):
 
             # Artist/Contributing Artist containers
 
             genres = []
             state_pre_suf = []
 
-            if searchCriteria == 'upnp:class = "object.container.person.musicArtist" and @refID exists false':
+            if plan.has_fields():
                 # Artists
                 log.debug('artists')
                 genres.append('dummy')
@@ -1546,12 +2046,11 @@ class DummyContentDirectory(Service):
                         state_pre_suf.append((orderby, prefix, suffix, albumtype, table, header))
                     id_pre = 'ARTIST__'
             else:
-                criteria = searchCriteria.split('=')
-                if criteria[1].endswith('upnp:genre '):
+                if plan.has_fields('upnp:genre'):
                     # Artists for genre
                     log.debug('artists for genre')
                     searchtype = 'GENRE_ARTIST'
-                    genre = criteria[2][1:]
+                    genre = values['upnp:genre']
                     genre_options = self.removepresuf(genre, 'GENRE', controllername)
                     for genre in genre_options:
                         if genre == '[unknown genre]': genre = ''
@@ -1599,12 +2098,9 @@ class DummyContentDirectory(Service):
                     log.debug(table)
                     if not table in matches:
                         if searchtype == 'ARTIST':
-                            c.execute(countstatement)
+                            tableMatches = generation.get_count(c, countstatement)
                         elif searchtype == 'GENRE_ARTIST':
-                            log.debug('before')
-                            c.execute(countstatement, (genre, ))
-                            log.debug('after')
-                        tableMatches, = c.fetchone()
+                            tableMatches = generation.get_count(c, countstatement, (genre, ))
                         tableMatches = int(tableMatches)
                         matches[table] = tableMatches
                         totalMatches += tableMatches
@@ -1658,9 +2154,6 @@ class DummyContentDirectory(Service):
                     for row in c:
     #                    log.debug("row: %s", row)
 
-    #                    if startingIndex == 0 and count > 100:
-    #                        # hack to get initial display back quicker
-    #                        break
                         artist, lastplayed, playcount = row
                         playcount = str(playcount)
                         if artist == '': artist = '[unknown %s]' % artisttype
@@ -1681,7 +2174,7 @@ class DummyContentDirectory(Service):
 
             res += '</DIDL-Lite>'
 
-        elif containerID == '0' and searchCriteria.startswith('upnp:class = "object.container.album.musicAlbum" and @refID exists false'):
+        elif containerID == '0' and plan.is_search('object.container.album.musicAlbum'):
 
             # Albums class
 
@@ -1697,7 +2190,7 @@ class DummyContentDirectory(Service):
             fields = []
             state_pre_suf = []
         
-            if searchCriteria == 'upnp:class = "object.container.album.musicAlbum" and @refID exists false':
+            if plan.has_fields():
                 # Albums
                 log.debug('albums')
                 searchtype = 'ALBUM'
@@ -1768,16 +2261,14 @@ order by albumartist limit ?, ?
                         state_pre_suf.append((orderby, prefix, suffix, albumtype, table, header))
                 id_pre = 'ALBUM__'
             else:
-                criteria = searchCriteria.split('=')
-                numcrit = len(criteria)
-                if numcrit == 3:
+                if len(values) == 1:
                     # searchCriteria: upnp:class = "object.container.album.musicAlbum" and @refID exists false and microsoft:authorComposer = "7 Aurelius"                
                     searchtype = 'FIELD_ALBUM'
                     genres.append('dummy')     # dummy for composer/artist/contributingartist
-                    if criteria[1].endswith('microsoft:authorComposer '):
+                    if plan.has_fields('microsoft:authorComposer'):
                         # Albums for Composer
                         log.debug('albums for composer')
-                        composer = criteria[2][1:]
+                        composer = values['microsoft:authorComposer']
                         composer_options = self.removepresuf(composer, 'COMPOSER', controllername)
                         for composer in composer_options:
                             if composer == '[unknown composer]': composer = ''
@@ -1793,10 +2284,10 @@ order by albumartist limit ?, ?
                                 state_pre_suf.append((orderby, prefix, suffix, albumtype, table, header))
                             id_pre = 'COMPOSER_ALBUM__'
 
-                    elif criteria[1].endswith('microsoft:artistAlbumArtist '):
+                    elif plan.has_fields('microsoft:artistAlbumArtist'):
                         # Albums for albumartist
                         log.debug('albums for artist (microsoft:artistAlbumArtist)')
-                        artist = criteria[2][1:]
+                        artist = values['microsoft:artistAlbumArtist']
                         if self.use_albumartist:
                             artist_options = self.removepresuf(artist, 'ALBUMARTIST', controllername)
                         else:
@@ -1829,11 +2320,11 @@ order by albumartist limit ?, ?
                                     state_pre_suf.append((orderby, prefix, suffix, albumtype, table, header))
                                 id_pre = 'ARTIST_ALBUM__'
 
-                    elif criteria[1].endswith('microsoft:artistPerformer '):
+                    elif plan.has_fields('microsoft:artistPerformer'):
                         # searchCriteria: upnp:class = "object.container.album.musicAlbum" and @refID exists false and microsoft:artistPerformer = "1 Giant Leap"
                         # Albums for contributing artist
                         log.debug('albums for artist (microsoft:artistPerformer)')
-                        artist = criteria[2][1:]
+                        artist = values['microsoft:artistPerformer']
                         artist_options = self.removepresuf(artist, 'CONTRIBUTINGARTIST', controllername)
                         for artist in artist_options:
                             if artist == '[unknown artist]': artist = ''
@@ -1851,19 +2342,18 @@ order by albumartist limit ?, ?
                     else:
                         print "proxy_search - unknown search criteria, not supported in code"
                 else:
-                    # numcrit = 4
-                    if criteria[1].endswith('upnp:genre ') and criteria[2].endswith('microsoft:artistAlbumArtist '):
+                    if plan.has_fields('upnp:genre', 'microsoft:artistAlbumArtist'):
                         searchtype = 'GENRE_FIELD_ALBUM'
                         # Albums for genre and artist
                         log.debug('albums for genre and artist')
-                        genre = criteria[2][1:-33]
+                        genre = values['upnp:genre']
                         genre_options = self.removepresuf(genre, 'GENRE', controllername)
                         for genre in genre_options:
                             if genre == '[unknown genre]': genre = ''
                             log.debug('    genre: %s', genre)
                             genres.append(genre)
 
-                            artist = criteria[3][1:]
+                            artist = values['microsoft:artistAlbumArtist']
                             if self.use_albumartist:
                                 artist_options = self.removepresuf(artist, 'GENRE_ALBUMARTIST', controllername)
                             else:
@@ -1922,16 +2412,15 @@ order by albumartist limit ?, ?
                         log.debug(searchtype)
                         if not table in matches:
                             if searchtype == 'ALBUM':
-                                c.execute(countstatement)
+                                tableMatches = generation.get_count(c, countstatement)
                             elif searchtype == 'FIELD_ALBUM':
                                 log.debug(countstatement)
                                 log.debug(field)
                                 log.debug(albumtype)
 
-                                c.execute(countstatement, (field, albumtype))
+                                tableMatches = generation.get_count(c, countstatement, (field, albumtype))
                             elif searchtype == 'GENRE_FIELD_ALBUM':
-                                c.execute(countstatement, (genre, field, albumtype))
-                            tableMatches, = c.fetchone()
+                                tableMatches = generation.get_count(c, countstatement, (genre, field, albumtype))
                             tableMatches = int(tableMatches)
                             matches[table] = tableMatches
                             totalMatches += tableMatches
@@ -1994,9 +2483,6 @@ order by albumartist limit ?, ?
                     for row in c:
 #                        log.debug("row: %s", row)
 
-    #                    if startingIndex == 0 and count > 100:
-    #                        # hack to get initial display back quicker
-    #                        break
 
                         id, parentID, album, artist, year, albumartist, duplicate, cover, artid, inserted, composer, tracknumbers, created, lastmodified, albumtype, lastplayed, playcount, upnpclass = row
                         id = str(id)
@@ -2060,7 +2546,7 @@ order by albumartist limit ?, ?
                     
             res += '</DIDL-Lite>'
 
-        elif containerID == '108' and searchCriteria == 'upnp:class = "object.container.person.musicArtist" and @refID exists false':
+        elif containerID == '108' and plan.is_search('object.container.person.musicArtist') and plan.has_fields():
 
             # Composer container
 
@@ -2084,8 +2570,7 @@ order by albumartist limit ?, ?
             count = 0
             parentid = '108'
 
-            c.execute(countstatement)
-            totalMatches, = c.fetchone()
+            totalMatches = generation.get_count(c, countstatement)
             totalMatches = int(totalMatches)
             if totalMatches != 0:
 
@@ -2122,9 +2607,6 @@ order by albumartist limit ?, ?
                     c.execute(orderstatement, (start, length))
                     for row in c:
     #                    log.debug("row: %s", row)
-    #                    if startingIndex == 0 and count > 100:
-    #                        # hack to get initial display back quicker
-    #                        break
                         composer, lastplayed, playcount = row
                         if composer == '': composer = '[unknown composer]'
                         composer = escape(composer)
@@ -2145,7 +2627,7 @@ order by albumartist limit ?, ?
 
             res += '</DIDL-Lite>'
 
-        elif containerID == '0' and searchCriteria == 'upnp:class = "object.container.genre.musicGenre" and @refID exists false':
+        elif containerID == '0' and plan.is_search('object.container.genre.musicGenre') and plan.has_fields():
 
             # Genre class
             
@@ -2169,8 +2651,7 @@ order by albumartist limit ?, ?
             log.debug("count statement: %s", countstatement)
             log.debug("statements: %s", state_pre_suf)
 
-            c.execute(countstatement)
-            totalMatches, = c.fetchone()
+            totalMatches = generation.get_count(c, countstatement)
             totalMatches = int(totalMatches)
             if totalMatches != 0:
 
@@ -2207,9 +2688,6 @@ order by albumartist limit ?, ?
                     c.execute(orderstatement, (start, length))
                     for row in c:
     #                    log.debug("row: %s", row)
-                        if startingIndex == 0 and count > 100:
-                            # hack to get initial display back quicker
-                            break
                         genre, lastplayed, playcount = row
                         playcount = str(playcount)
 
@@ -2231,7 +2709,7 @@ order by albumartist limit ?, ?
 
             res += '</DIDL-Lite>'
 
-        elif containerID == '0' and searchCriteria.startswith('upnp:class derivedfrom "object.item.audioItem" and @refID exists false'):
+        elif containerID == '0' and plan.is_track_search():
 
             # Track class
 
@@ -2240,7 +2718,31 @@ order by albumartist limit ?, ?
             fields = []
             tracks_type = None
             
-            if searchCriteria == 'upnp:class derivedfrom "object.item.audioItem" and @refID exists false':
+            if not plan.is_search('object.item.audioItem', 'derivedfrom') or plan.field_key() not in TRACK_SEARCH_FIELDS:
+                # Other searches for tracks, run from the compiled criteria
+                tracks_type = 'QUERY'
+                match = None
+                if generation.get('search_index') and search.can_use_index():
+                    # keyword search from the full text index
+                    where = plan.index_where
+                    match, params = search.index_params()
+                else:
+                    where = plan.where
+                    params = search.params()
+                if not self.show_duplicates:
+                    where = "%s and duplicate = 0" % where
+                if match != None:
+                    # best matches first
+                    params = (match, ) + params
+                    countstatement = "select count(*) from tracks, (select docid from TrackSearch where TrackSearch match ?) as m where tracks.rowid = m.docid and %s" % where
+                    statement = "select tracks.* from tracks, (select docid, search_rank(matchinfo(TrackSearch)) as rank from TrackSearch where TrackSearch match ?) as m where tracks.rowid = m.docid and %s order by m.rank desc, album, tracknumber, title limit ?, ?" % where
+                else:
+                    countstatement = "select count(*) from tracks where %s" % where
+                    statement = "select * from tracks where %s order by album, tracknumber, title limit ?, ?" % where
+
+                totalMatches = generation.get_count(c, countstatement, params)
+
+            elif plan.has_fields():
                 # Tracks
                 tracks_type = 'TRACKS'
                 if self.show_duplicates:
@@ -2248,10 +2750,9 @@ order by albumartist limit ?, ?
                 else:
                     where = "where duplicate = 0"
                 countstatement = "select count(*) from tracks %s" % where
-                statement = "select * from tracks %s order by title limit %d, %d" % (where, startingIndex, requestedCount)
+                statement = "select * from tracks %s order by title limit ?, ?" % where
 
-                c.execute(countstatement)
-                totalMatches, = c.fetchone()
+                totalMatches = generation.get_count(c, countstatement)
 
             else:
             
@@ -2268,20 +2769,19 @@ order by albumartist limit ?, ?
 
                     # Tracks for class/album or class
                     duplicate_number = '0'
-                    criteria = searchCriteria.split('=')
                     
-                    if len(criteria) == 2:
+                    if len(values) == 1:
 
                         tracks_type = 'FIELD'
                         genres.append('dummy')
                         artists.append('dummy')
 
-                        if criteria[0].endswith('microsoft:authorComposer '):
+                        if plan.has_fields('microsoft:authorComposer'):
 
                             # tracks for composer
                             # searchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:authorComposer = "A New Found Glory"
                             log.debug('tracks for composer')
-                            composer = criteria[1][1:]
+                            composer = values['microsoft:authorComposer']
                             composer_options = self.removepresuf(composer, 'COMPOSER', controllername)
                             for composer in composer_options:
                                 if composer == '[unknown composer]': composer = ''
@@ -2291,14 +2791,14 @@ order by albumartist limit ?, ?
                                     break
                                 log.debug('    composer: %s', composer)
                                 countstatement = "select count(*) from ComposerAlbumTrack where composer=? %s" % (self.album_and_duplicate)
-                                statement = "select * from tracks where id in (select track_id from ComposerAlbumTrack where composer=? %s) order by album, tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                statement = "select * from tracks where id in (select track_id from ComposerAlbumTrack where composer=? %s) order by album, tracknumber, title limit ?, ?" % (self.album_and_duplicate)
 
-                        elif criteria[0].endswith('microsoft:artistAlbumArtist '):
+                        elif plan.has_fields('microsoft:artistAlbumArtist'):
 
                             # tracks for artist
                             # SearchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:artistAlbumArtist = "30 Seconds to Mars"
                             log.debug('tracks for artist')
-                            artist = criteria[1][1:]
+                            artist = values['microsoft:artistAlbumArtist']
                             if self.use_albumartist:
                                 artist_options = self.removepresuf(artist, 'ALBUMARTIST', controllername)
                             else:
@@ -2313,17 +2813,17 @@ order by albumartist limit ?, ?
                                 log.debug('    artist: %s', artist)
                                 if self.use_albumartist:
                                     countstatement = "select count(*) from AlbumartistAlbumTrack where albumartist=? %s" % (self.album_and_duplicate)
-                                    statement = "select * from tracks where id in (select track_id from AlbumartistAlbumTrack where albumartist=? %s) order by album, tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                    statement = "select * from tracks where id in (select track_id from AlbumartistAlbumTrack where albumartist=? %s) order by album, tracknumber, title limit ?, ?" % (self.album_and_duplicate)
                                 else:                
                                     countstatement = "select count(*) from ArtistAlbumTrack where artist=? %s" % (self.album_and_duplicate)
-                                    statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? %s) order by album, tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                    statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? %s) order by album, tracknumber, title limit ?, ?" % (self.album_and_duplicate)
 
-                        elif criteria[0].endswith('microsoft:artistPerformer '):
+                        elif plan.has_fields('microsoft:artistPerformer'):
 
                             # tracks for contributing artist
                             # searchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:artistPerformer = "1 Giant Leap"
                             log.debug('tracks for contributing artist')
-                            artist = criteria[1][1:]
+                            artist = values['microsoft:artistPerformer']
                             artist_options = self.removepresuf(artist, 'CONTRIBUTINGARTIST', controllername)
                             for artist in artist_options:
                                 if artist == '[unknown artist]': artist = ''
@@ -2333,14 +2833,14 @@ order by albumartist limit ?, ?
                                     break
                                 log.debug('    artist: %s', artist)
                                 countstatement = "select count(*) from ArtistAlbumTrack where artist=? %s" % (self.album_and_duplicate)
-                                statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? %s) order by album, tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? %s) order by album, tracknumber, title limit ?, ?" % (self.album_and_duplicate)
 
-                        elif criteria[0].endswith('upnp:genre '):
+                        elif plan.has_fields('upnp:genre'):
 
                             # tracks for genre
                             # searchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and upnp:genre = "Alt. Pop"
                             log.debug('tracks for genre')
-                            genre = criteria[1][1:]
+                            genre = values['upnp:genre']
                             genre_options = self.removepresuf(genre, 'GENRE', controllername)
                             for genre in genre_options:
                                 if genre == '[unknown genre]': genre = ''
@@ -2351,28 +2851,28 @@ order by albumartist limit ?, ?
                                 log.debug('    genre: %s', genre)
                                 if self.use_albumartist:
                                     countstatement = "select count(*) from GenreAlbumartistAlbumTrack where genre=? %s" % (self.album_and_duplicate)
-                                    statement = "select * from tracks where id in (select track_id from GenreAlbumartistAlbumTrack where genre=? %s) order by albumartist, album, tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                    statement = "select * from tracks where id in (select track_id from GenreAlbumartistAlbumTrack where genre=? %s) order by albumartist, album, tracknumber, title limit ?, ?" % (self.album_and_duplicate)
                                 else:                
                                     countstatement = "select count(*) from GenreArtistAlbumTrack where genre=? %s" % (self.album_and_duplicate)
-                                    statement = "select * from tracks where id in (select track_id from GenreArtistAlbumTrack where genre=? %s) order by artist, album, tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                    statement = "select * from tracks where id in (select track_id from GenreArtistAlbumTrack where genre=? %s) order by artist, album, tracknumber, title limit ?, ?" % (self.album_and_duplicate)
                     
-                    elif len(criteria) == 3:
+                    elif len(values) == 2:
 
                         tracks_type = 'ARTIST'
                         genres.append('dummy')
                         not_album = False
 
-                        if criteria[0].endswith('microsoft:authorComposer '):
+                        if plan.has_fields('microsoft:authorComposer', 'upnp:album'):
                             # tracks for composer/album
                             # SearchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:authorComposer = "A Lee" and upnp:album = "Fallen"
                             log.debug('tracks for composer/album')
-                            composer = criteria[1][1:-16]
+                            composer = values['microsoft:authorComposer']
                             composer_options = self.removepresuf(composer, 'COMPOSER', controllername)
                             for composer in composer_options:
                                 if composer == '[unknown composer]': composer = ''
                                 artists.append(composer)
                                 log.debug('    composer: %s', composer)
-                                album = criteria[2][1:]
+                                album = values['upnp:album']
                                 
                                 album_options = self.removepresuf(album, 'COMPOSER_ALBUM', controllername)
                                 for album in album_options:
@@ -2390,18 +2890,18 @@ order by albumartist limit ?, ?
                                     
                             countstatement = "select count(*) from ComposerAlbumTrack where composer=? and album=? and duplicate=%s" % (duplicate_number)
                             countstatement2 = "select count(*) from ComposerAlbumTrack where composer=? and album=? and duplicate=%s and albumtype=?" % (duplicate_number)
-                            statement = "select * from tracks where id in (select track_id from ComposerAlbumTrack where composer=? and album=? and duplicate=%s) order by tracknumber, title limit %d, %d" % (duplicate_number, startingIndex, requestedCount)
+                            statement = "select * from tracks where id in (select track_id from ComposerAlbumTrack where composer=? and album=? and duplicate=%s) order by tracknumber, title limit ?, ?" % (duplicate_number)
                             statement2 = "select distinct(albumtype) from ComposerAlbumTrack where composer=? and album=? and duplicate=%s order by albumtype" % (duplicate_number)
                             statement3 = '''select * from tracks t, tracknumbers n where id in 
                                            (select track_id from ComposerAlbumTrack where composer=? and album=? and duplicate=%s)
                                            and t.id = n.track_id and t.genre=n.genre and t.artist=n.artist and t.albumartist=n.albumartist and t.album=n.album and t.composer=n.composer and t.duplicate=n.duplicate and n.albumtype=?
-                                           order by n.tracknumber, t.title limit %d, %d''' % (duplicate_number, startingIndex, requestedCount)
+                                           order by n.tracknumber, t.title limit ?, ?''' % (duplicate_number)
 
-                        elif criteria[0].endswith('microsoft:artistAlbumArtist '):
+                        elif plan.has_fields('microsoft:artistAlbumArtist', 'upnp:album'):
                             # tracks for artist/album
                             # searchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:artistAlbumArtist = "1 Giant Leap" and upnp:album = "1 Giant Leap"
                             log.debug('tracks for artist/album')
-                            artist = criteria[1][1:-16]
+                            artist = values['microsoft:artistAlbumArtist']
                             if self.use_albumartist:
                                 artist_options = self.removepresuf(artist, 'ALBUMARTIST', controllername)
                             else:
@@ -2410,7 +2910,7 @@ order by albumartist limit ?, ?
                                 log.debug(artist)
                                 if artist == '[unknown artist]': artist = ''
                                 artists.append(artist)
-                                album = criteria[2][1:]
+                                album = values['upnp:album']
                                 log.debug(album)
                                 
                                 if self.use_albumartist:
@@ -2435,35 +2935,35 @@ order by albumartist limit ?, ?
                                     
                                 countstatement = "select count(*) from AlbumartistAlbumTrack where albumartist=? and album=? and duplicate=%s" % (duplicate_number)
                                 countstatement2 = "select count(*) from AlbumartistAlbumTrack where albumartist=? and album=? and duplicate=%s and albumtype=?" % (duplicate_number)
-                                statement = "select * from tracks where id in (select track_id from AlbumartistAlbumTrack where albumartist=? and album=? and duplicate=%s) order by tracknumber, title limit %d, %d" % (duplicate_number, startingIndex, requestedCount)
+                                statement = "select * from tracks where id in (select track_id from AlbumartistAlbumTrack where albumartist=? and album=? and duplicate=%s) order by tracknumber, title limit ?, ?" % (duplicate_number)
                                 statement2 = "select distinct(albumtype) from AlbumartistAlbumTrack where albumartist=? and album=? and duplicate=%s order by albumtype" % (duplicate_number)
                                 statement3 = '''select * from tracks t, tracknumbers n where id in 
                                                (select track_id from AlbumartistAlbumTrack where albumartist=? and album=? and duplicate=%s)
                                                and t.id = n.track_id and t.genre=n.genre and t.artist=n.artist and t.albumartist=n.albumartist and t.album=n.album and t.composer=n.composer and t.duplicate=n.duplicate and n.albumtype=?
-                                               order by n.tracknumber, t.title limit %d, %d''' % (duplicate_number, startingIndex, requestedCount)
+                                               order by n.tracknumber, t.title limit ?, ?''' % (duplicate_number)
                             else:                
                             
                                 possible_albumtypes = self.get_possible_albumtypes('ARTIST_ALBUM')
                                     
                                 countstatement = "select count(*) from ArtistAlbumTrack where artist=? and album=? and duplicate=%s" % (duplicate_number)
                                 countstatement2 = "select count(*) from ArtistAlbumTrack where artist=? and album=? and duplicate=%s and albumtype=?" % (duplicate_number)
-                                statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? and album=? and duplicate=%s) order by tracknumber, title limit %d, %d" % (duplicate_number, startingIndex, requestedCount)
+                                statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? and album=? and duplicate=%s) order by tracknumber, title limit ?, ?" % (duplicate_number)
                                 statement2 = "select distinct(albumtype) from ArtistAlbumTrack where albumartist=? and album=? and duplicate=%s order by albumtype" % (duplicate_number)
                                 statement3 = '''select * from tracks t, tracknumbers n where id in 
                                                (select track_id from ArtistAlbumTrack where albumartist=? and album=? and duplicate=%s)
                                                and t.id = n.track_id and t.genre=n.genre and t.artist=n.artist and t.albumartist=n.albumartist and t.album=n.album and t.composer=n.composer and t.duplicate=n.duplicate and n.albumtype=?
-                                               order by n.tracknumber, t.title limit %d, %d''' % (duplicate_number, startingIndex, requestedCount)
+                                               order by n.tracknumber, t.title limit ?, ?''' % (duplicate_number)
 
-                        elif criteria[0].endswith('microsoft:artistPerformer '):
+                        elif plan.has_fields('microsoft:artistPerformer', 'upnp:album'):
                             # tracks for contributing artist/album
                             # searchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:artistPerformer = "1 Giant Leap" and upnp:album = "1 Giant Leap"
                             log.debug('tracks for contributing artist/album')
-                            artist = criteria[1][1:-16]
+                            artist = values['microsoft:artistPerformer']
                             artist_options = self.removepresuf(artist, 'CONTRIBUTINGARTIST', controllername)
                             for artist in artist_options:
                                 if artist == '[unknown artist]': artist = ''
                                 artists.append(artist)
-                                album = criteria[2][1:]
+                                album = values['upnp:album']
                                 album_options = self.removepresuf(album, 'CONTRIBUTINGARTIST_ALBUM', controllername)
                                 for album in album_options:
                                     if album == '[unknown album]': album = ''
@@ -2481,24 +2981,24 @@ order by albumartist limit ?, ?
                                     
                             countstatement = "select count(*) from ArtistAlbumTrack where artist=? and album=? and duplicate=%s" % (duplicate_number)
                             countstatement2 = "select count(*) from ArtistAlbumTrack where artist=? and album=? and duplicate=%s and albumtype=?" % (duplicate_number)
-                            statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? and album=? and duplicate=%s) order by tracknumber, title limit %d, %d" % (duplicate_number, startingIndex, requestedCount)
+                            statement = "select * from tracks where id in (select track_id from ArtistAlbumTrack where artist=? and album=? and duplicate=%s) order by tracknumber, title limit ?, ?" % (duplicate_number)
                             statement2 = "select distinct(albumtype) from ArtistAlbumTrack where artist=? and album=? and duplicate=%s order by albumtype" % (duplicate_number)
                             statement3 = '''select * from tracks t, tracknumbers n where id in 
                                            (select track_id from ArtistAlbumTrack where artist=? and album=? and duplicate=%s)
                                            and t.id = n.track_id and t.genre=n.genre and t.artist=n.artist and t.albumartist=n.albumartist and t.album=n.album and t.composer=n.composer and t.duplicate=n.duplicate and n.albumtype=?
-                                           order by n.tracknumber, t.title limit %d, %d''' % (duplicate_number, startingIndex, requestedCount)
+                                           order by n.tracknumber, t.title limit ?, ?''' % (duplicate_number)
 
-                        elif criteria[0].endswith('upnp:genre '):
+                        elif plan.has_fields('upnp:genre', 'microsoft:artistAlbumArtist'):
                             # tracks for genre/artist
                             # searchCriteria: upnp:class derivedfrom "object.item.audioItem" and @refID exists false and upnp:genre = "Alt. Rock" and microsoft:artistAlbumArtist = "Elvis Costello"
                             not_album = True
                             log.debug('tracks for genre/artist')
-                            genre = criteria[1][1:-33]
+                            genre = values['upnp:genre']
                             genre_options = self.removepresuf(genre, 'GENRE', controllername)
                             for genre in genre_options:
                                 if genre == '[unknown genre]': genre = ''
                                 artists.append(genre)
-                                artist = criteria[2][1:]
+                                artist = values['microsoft:artistAlbumArtist']
                                 if self.use_albumartist:
                                     artist_options = self.removepresuf(artist, 'ALBUMARTIST', controllername)
                                 else:
@@ -2514,21 +3014,20 @@ order by albumartist limit ?, ?
                                     
                             if self.use_albumartist:
                                 countstatement = "select count(*) from GenreAlbumartistAlbumTrack where genre=? and albumartist=? %s" % (self.album_and_duplicate)
-                                statement = "select * from tracks where id in (select track_id from GenreAlbumartistAlbumTrack where genre=? and albumartist=? %s) order by tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                statement = "select * from tracks where id in (select track_id from GenreAlbumartistAlbumTrack where genre=? and albumartist=? %s) order by tracknumber, title limit ?, ?" % (self.album_and_duplicate)
                             else:                
                                 countstatement = "select count(*) from GenreArtistAlbumTrack where genre=? and artist=? %s" % (self.album_and_duplicate)
-                                statement = "select * from tracks where id in (select track_id from GenreArtistAlbumTrack where genre=? and artist=? %s) order by tracknumber, title limit %d, %d" % (self.album_and_duplicate, startingIndex, requestedCount)
+                                statement = "select * from tracks where id in (select track_id from GenreArtistAlbumTrack where genre=? and artist=? %s) order by tracknumber, title limit ?, ?" % (self.album_and_duplicate)
                     else:
-                        # len = 4
                         # tracks for genre/artist/album
                         log.debug('tracks for genre/artist/album')
                         tracks_type = 'GENRE'
-                        genre = criteria[1][1:-33]
+                        genre = values['upnp:genre']
                         genre_options = self.removepresuf(genre, 'GENRE', controllername)
                         for genre in genre_options:
                             if genre == '[unknown genre]': genre = ''
                             genres.append(genre)
-                            artist = criteria[2][1:-16]
+                            artist = values['microsoft:artistAlbumArtist']
                             if self.use_albumartist:
                                 artist_options = self.removepresuf(artist, 'GENRE_ALBUMARTIST', controllername)
                             else:
@@ -2539,7 +3038,7 @@ order by albumartist limit ?, ?
                             
                                 if artist == '[unknown artist]': artist = ''
                                 artists.append(artist)
-                                album = criteria[3][1:]
+                                album = values['upnp:album']
                                 if self.use_albumartist:
                                     album_options = self.removepresuf(album, 'ALBUMARTIST_ALBUM', controllername)
                                 else:
@@ -2566,24 +3065,24 @@ order by albumartist limit ?, ?
                         
                             countstatement = "select count(*) from GenreAlbumartistAlbumTrack where genre=? and albumartist=? and album=? and duplicate = %s" % (duplicate_number)
                             countstatement2 = "select count(*) from GenreAlbumartistAlbumTrack where genre=? and albumartist=? and album=? and duplicate = %s and albumtype=?" % (duplicate_number)
-                            statement = "select * from tracks where id in (select track_id from GenreAlbumartistAlbumTrack where genre=? and albumartist=? and album=? and duplicate = %s) order by tracknumber, title limit %d, %d" % (duplicate_number, startingIndex, requestedCount)
+                            statement = "select * from tracks where id in (select track_id from GenreAlbumartistAlbumTrack where genre=? and albumartist=? and album=? and duplicate = %s) order by tracknumber, title limit ?, ?" % (duplicate_number)
                             statement2 = "select distinct(albumtype) from GenreAlbumartistAlbumTrack where genre=? and albumartist=? and album=? and duplicate=%s order by albumtype" % (duplicate_number)
                             statement3 = '''select * from tracks t, tracknumbers n where id in 
                                            (select track_id from GenreAlbumartistAlbumTrack where genre=? and albumartist=? and album=? and duplicate=%s)
                                            and t.id = n.track_id and t.genre=n.genre and t.artist=n.artist and t.albumartist=n.albumartist and t.album=n.album and t.composer=n.composer and t.duplicate=n.duplicate and n.albumtype=?
-                                           order by n.tracknumber, t.title limit %d, %d''' % (duplicate_number, startingIndex, requestedCount)
+                                           order by n.tracknumber, t.title limit ?, ?''' % (duplicate_number)
                         else:                
 
                             possible_albumtypes = self.get_possible_albumtypes('ARTIST_ALBUM')
                         
                             countstatement = "select count(*) from GenreArtistAlbumTrack where genre=? and artist=? and album=? and duplicate = %s" % (duplicate_number)
                             countstatement2 = "select count(*) from GenreArtistAlbumTrack where genre=? and artist=? and album=? and duplicate = %s and albumtype=?" % (duplicate_number)
-                            statement = "select * from tracks where id in (select track_id from GenreArtistAlbumTrack where genre=? and artist=? and album=? and duplicate = %s) order by tracknumber, title limit %d, %d" % (duplicate_number, startingIndex, requestedCount)
+                            statement = "select * from tracks where id in (select track_id from GenreArtistAlbumTrack where genre=? and artist=? and album=? and duplicate = %s) order by tracknumber, title limit ?, ?" % (duplicate_number)
                             statement2 = "select distinct(albumtype) from GenreArtistAlbumTrack where genre=? and albumartist=? and album=? and duplicate=%s order by albumtype" % (duplicate_number)
                             statement3 = '''select * from tracks t, tracknumbers n where id in 
                                            (select track_id from GenreArtistAlbumTrack where genre=? and albumartist=? and album=? and duplicate=%s)
                                            and t.id = n.track_id and t.genre=n.genre and t.artist=n.artist and t.albumartist=n.albumartist and t.album=n.album and t.composer=n.composer and t.duplicate=n.duplicate and n.albumtype=?
-                                           order by n.tracknumber, t.title limit %d, %d''' % (duplicate_number, startingIndex, requestedCount)
+                                           order by n.tracknumber, t.title limit ?, ?''' % (duplicate_number)
 
                     log.debug("count statement: %s", countstatement)
                     log.debug("statement: %s", statement)
@@ -2644,14 +3143,17 @@ order by albumartist limit ?, ?
             count = 0
 
             albumtype = 10
-            if tracks_type == 'TRACKS':
-                c.execute(statement)
+            limit = (startingIndex, requestedCount)
+            if tracks_type == 'QUERY':
+                c.execute(statement, params + limit)
+            elif tracks_type == 'TRACKS':
+                c.execute(statement, limit)
             elif tracks_type == 'FIELD':
-                c.execute(statement, (field, ))
+                c.execute(statement, (field, ) + limit)
             elif tracks_type == 'ARTIST':
                 if not_album:
                     # genre/artist
-                    c.execute(statement, (artist, field))
+                    c.execute(statement, (artist, field) + limit)
                 else:
                 
                     log.debug(statement2)
@@ -2662,26 +3164,29 @@ order by albumartist limit ?, ?
                     c.execute(statement2, (artist, field))
                     albumtype, = c.fetchone()
                     if albumtype != 10:
-                        c.execute(statement3, (artist, field, albumtype))
+                        c.execute(statement3, (artist, field, albumtype) + limit)
                     else:            
-                        c.execute(statement, (artist, field))
+                        c.execute(statement, (artist, field) + limit)
             elif tracks_type == 'GENRE':
                 c.execute(statement2, (genre, artist, field))
                 albumtype, = c.fetchone()
                 if albumtype != 10:
-                    c.execute(statement3, (genre, artist, field, albumtype))
+                    c.execute(statement3, (genre, artist, field, albumtype) + limit)
                 else:            
-                    c.execute(statement, (genre, artist, field))
+                    c.execute(statement, (genre, artist, field) + limit)
 
-            for row in c:
+            rows = c.fetchall()
+            trackitems = self.get_track_items(c, [row[0] for row in rows])
+            for row in rows:
                 log.debug("row: %s", row)
-                if startingIndex == 0 and count > 100:
-                    # hack to get initial display back quicker
-                    break
                 if albumtype != 10:
                     id, id2, parentID, duplicate, title, artist, album, genre, tracknumber, year, albumartist, composer, codec, length, size, created, path, filename, discnumber, comment, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, lastmodified, upnpclass, folderartid, trackartid, inserted, lastplayed, playcount, lastscanned, d1, d2, d3, d4, d5, d6, d7, d8, d9, d10 = row
                 else:
                     id, id2, parentID, duplicate, title, artist, album, genre, tracknumber, year, albumartist, composer, codec, length, size, created, path, filename, discnumber, comment, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, lastmodified, upnpclass, folderartid, trackartid, inserted, lastplayed, playcount, lastscanned = row
+                if id in trackitems:
+                    count += 1
+                    ret += self.add_track_item(trackitems[id], id, path, filename)
+                    continue
                 mime = fixMime(mime)
                 cover, artid = self.choosecover(folderart, trackart, folderartid, trackartid)
 
@@ -2753,23 +3258,19 @@ order by albumartist limit ?, ?
 
             res = ret
             
-        elif containerID == '0' and searchCriteria == 'upnp:class = "object.container.playlistContainer" and @refID exists false':
+        elif containerID == '0' and plan.is_search('object.container.playlistContainer') and plan.has_fields():
             # Playlist class
 
             res  = '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
             count = 0
             parentid = '0'
 
-            c.execute("select count(*) from playlists")
-            totalMatches, = c.fetchone()
+            totalMatches = generation.get_count(c, "select count(*) from playlists")
             
-            statement = "select * from playlists order by playlist limit %d, %d" % (startingIndex, requestedCount)
-            c.execute(statement)
+            statement = "select * from playlists order by playlist limit ?, ?"
+            c.execute(statement, (startingIndex, requestedCount))
             for row in c:
 #                log.debug("row: %s", row)
-                if startingIndex == 0 and count > 100:
-                    # hack to get initial display back quicker
-                    break
                 id, parentID, playlist, path, upnpclass = row
                 id = str(id)
                 if playlist == '': playlist = '[unknown playlist]'
@@ -2811,47 +3312,39 @@ order by albumartist limit ?, ?
         # count_chunk is a list of record count / chunk count pairs
         # e.g. (15, 1)
         #      (77, 3)
-        totalgroups = 0
-        newtotal = 0
         matches = []
         for cc in count_chunk:
             match, chunks = cc
             if show_separator:
                 match += 1
-            for i in range(chunks):
-                totalgroups += 1
-                matches.append(match)
-                newtotal += match
+            matches.extend([match] * chunks)
+        totalgroups = len(matches)
 
         log.debug(matches)
 
+        # prefix sums of the group sizes - groupstarts[i] is the index of the
+        # first entry in group i, groupstarts[totalgroups] the total
+        groupstarts = [0]
+        for match in matches:
+            groupstarts.append(groupstarts[-1] + match)
+        newtotal = groupstarts[-1]
+
         start = startingIndex
         end = start + requestedCount - 1                # this is inclusive, zero based - so 0 means get the first entry
 
-        grouplimits = []
-        startgroup = 0
-        endgroup = None
-        groupstart = 0
-        for i in range(totalgroups):
-            groupend = groupstart + matches[i] - 1
-            grouplimits.append(groupstart)
-            grouplimits.append(groupend)
-            if start >= groupstart:
-                startgroup = i
-            if end <= groupend and endgroup == None:
-                endgroup = i
-            groupstart += matches[i]
-        if endgroup == None:
+        # last group starting at or before start, first group ending at or after end
+        startgroup = max(bisect.bisect_right(groupstarts, start, 0, totalgroups) - 1, 0)
+        endgroup = bisect.bisect_right(groupstarts, end, 1) - 1
+        if endgroup >= totalgroups:
             endgroup = totalgroups - 1
 
-        log.debug(grouplimits)
+        log.debug(groupstarts)
 
         groupdata = []
 
         displayseparator = False
-        groupset = startgroup * 2
-        thisgroupstart = grouplimits[groupset]
-        thisgroupend = grouplimits[groupset+1]
+        thisgroupstart = groupstarts[startgroup]
+        thisgroupend = groupstarts[startgroup+1] - 1
         if start == thisgroupstart:
             thisgroupstartoffset = 0
             if show_separator:
@@ -2871,9 +3364,8 @@ order by albumartist limit ?, ?
         groupdata.append((startgroup, thisgroupstartoffset, thisgroupendoffset, displayseparator))
 
         for j in range(startgroup+1,endgroup-1+1):
-            groupset = j * 2
-            thisgroupstart = grouplimits[groupset]
-            thisgroupend = grouplimits[groupset+1]
+            thisgroupstart = groupstarts[j]
+            thisgroupend = groupstarts[j+1] - 1
             thisgroupstartoffset = 0
             if show_separator:
                 displayseparator = True
@@ -2883,9 +3375,8 @@ order by albumartist limit ?, ?
             groupdata.append((j, thisgroupstartoffset, thisgroupendoffset, displayseparator))
 
         if endgroup != startgroup:
-            groupset = endgroup * 2
-            thisgroupstart = grouplimits[groupset]
-            thisgroupend = grouplimits[groupset+1]
+            thisgroupstart = groupstarts[endgroup]
+            thisgroupend = groupstarts[endgroup+1] - 1
             thisgroupstartoffset = 0
             if show_separator:
                 displayseparator = True
@@ -2976,8 +3467,7 @@ order by albumartist limit ?, ?
 
     def removepresuf(self, title, sourcetable, controllername):
         possibleentries = []
-        # strip quotes    
-        fullentry = title[1:-1]
+        fullentry = title
         
         
         
@@ -3074,85 +3564,78 @@ order by albumartist limit ?, ?
         elif entrytype == 'last':
             return artistlist[-1]        
 
-    def prime_cache(self):
-        db = sqlite3.connect(os.path.join(os.getcwd(), self.dbname))
+    def prime_cache(self, db):
+        # read the albums through so their pages are cached before they're browsed
         c = db.cursor()
         try:
             c.execute("""select * from albums""")
+            for row in c:
+                pass
         except sqlite3.Error, e:
             print "Error priming cache:", e.args[0]
         c.close()
-
-    def checkkeys(self, proxy, proxykey, controller, controllerkey):
-
-        proxykeys = proxy.lower().split(',')
-        proxykeys = [k.strip() for k in proxykeys]
-        proxykeys = [k for k in proxykeys if k != '']
-        proxyfound = proxykey.lower() in proxykeys or 'all' in proxykeys
-
-        controllerkeys = controller.lower().split(',')
-        controllerkeys = [k.strip() for k in controllerkeys]
-        controllerkeys = [k for k in controllerkeys if k != '']
-        controllerfound = controllerkey.lower() in controllerkeys or 'all' in controllerkeys
-
-        return proxyfound and controllerfound
+        return True
+
+    def load_sorts(self, db):
+        # reads the sorts for this proxy, for each library generation
+        rows = []
+        if self.use_sorts:
+            c = db.cursor()
+            try:
+                c.execute("""select proxyname, controller, sort_type, sort_order, sort_prefix, sort_suffix, album_type, header_name from sorts where active is not null and active!="" order by sort_seq""")
+                rows = c.fetchall()
+            except sqlite3.Error, e:
+                print "Error getting sort info:", e.args[0]
+            c.close()
+        sorts = SortConfig(self.proxy.proxyname, rows, self.compile_sort)
+        for sorttype in SORT_TYPES:
+            try:
+                sorts.compile(sorttype)
+            except Exception, e:
+                # leave it to fail when it's used, as it did before
+                print "Error compiling sorts for %s: %s" % (sorttype, e)
+        log.debug("sorts: %d rows for proxy %s" % (len(sorts.rows), self.proxy.proxyname))
+        return sorts
+
+    def compile_sort(self, sorttype, row):
+        # converts a sorts row to the order entry for sorttype
+        so, sp, ss, albumtypestring, hn = row
+        if self.use_albumartist:
+            if so: so = re.sub('(?<!album)artist', 'albumartist', so)
+            if sp: sp = re.sub('(?<!album)artist', 'albumartist', sp)
+            if ss: ss = re.sub('(?<!album)artist', 'albumartist', ss)
+        else:
+            if so: so = so.replace('albumartist', 'artist')
+            if sp: sp = sp.replace('albumartist', 'artist')
+            if ss: ss = ss.replace('albumartist', 'artist')
+        # special case for album
+        if sorttype == 'ALBUM':
+            if not albumtypestring:
+                albumtypestrings = ['album']
+            else:
+                if self.use_albumartist:
+                    albumtypestring = re.sub('(?<!album)artist_virtual', 'albumartist_virtual', albumtypestring)
+                else:
+                    albumtypestring = albumtypestring.replace('albumartist_virtual', 'artist_virtual')
+                albumtypestrings = splitkeys(albumtypestring, lower=False)
+                if not 'album' in albumtypestrings:
+                    albumtypestrings.insert(0, 'album')
+            ats = []
+            for at in albumtypestrings:
+                albumtypenum, table = self.translate_albumtype(at, sorttype)
+                ats.append(albumtypenum)
+            albumtypenum = ats
+        else:
+            albumtypenum, table = self.translate_albumtype(albumtypestring, sorttype)
+        return (so, sp, ss, albumtypenum, table, hn)
 
     def get_orderby(self, sorttype, controller):
-        # TODO: only load this on start and updateid change
         if not self.use_sorts:
             return [(None, None, None, 10, 'dummy', None)]
-        order_out = []
-        db = sqlite3.connect(os.path.join(os.getcwd(), self.dbname))
-        db.create_function("checkkeys", 4, self.checkkeys)
-        c = db.cursor()
-        try:
-            dummysorttype = sorttype
-            if sorttype == 'ALBUMARTIST_ALBUM':
-                dummysorttype = 'ARTIST_ALBUM'
-            elif sorttype == 'ALBUMARTIST':
-                dummysorttype = 'ARTIST'
-            elif sorttype == 'GENRE_ALBUMARTIST':
-                dummysorttype = 'GENRE_ARTIST'
-            statement = """select sort_order, sort_prefix, sort_suffix, album_type, header_name from sorts where checkkeys(proxyname, "%s", controller, "%s") and sort_type="%s" and active is not null and active!="" order by sort_seq""" % (self.proxy.proxyname, controller, dummysorttype)
-            log.debug(statement)
-            c.execute(statement)
-            for row in c:
-                log.debug(row)
-                so, sp, ss, albumtypestring, hn = row
-                if self.use_albumartist:
-                    if so: so = re.sub('(?<!album)artist', 'albumartist', so)
-                    if sp: sp = re.sub('(?<!album)artist', 'albumartist', sp)
-                    if ss: ss = re.sub('(?<!album)artist', 'albumartist', ss)
-                else:
-                    if so: so = so.replace('albumartist', 'artist')
-                    if sp: sp = sp.replace('albumartist', 'artist')
-                    if ss: ss = ss.replace('albumartist', 'artist')
-                # special case for album
-                if sorttype == 'ALBUM':
-                    if not albumtypestring:
-                        albumtypestrings = ['album']
-                    else:
-                        if self.use_albumartist:
-                            albumtypestring = re.sub('(?<!album)artist_virtual', 'albumartist_virtual', albumtypestring)
-                        else:
-                            albumtypestring = albumtypestring.replace('albumartist_virtual', 'artist_virtual')
-                        albumtypestrings = albumtypestring.split(',')
-                        albumtypestrings = [k.strip() for k in albumtypestrings]
-                        albumtypestrings = [k for k in albumtypestrings if k != '']
-                        if not 'album' in albumtypestrings:
-                            albumtypestrings.insert(0, 'album')
-                        log.debug(albumtypestrings)
-                    ats = []
-                    for at in albumtypestrings:
-                        albumtypenum, table = self.translate_albumtype(at, sorttype)
-                        ats.append(albumtypenum)
-                    albumtypenum = ats
-                else:
-                    albumtypenum, table = self.translate_albumtype(albumtypestring, sorttype)
-                order_out.append((so, sp, ss, albumtypenum, table, hn))
-        except sqlite3.Error, e:
-            print "Error getting sort info:", e.args[0]
-        c.close()
+        sorts = self.library.current().get('sorts')
+        if sorts == None:
+            return [(None, None, None, 10, 'dummy', None)]
+        order_out = sorts.get_orderby(sorttype, controller)
         if order_out == []:
             return [(None, None, None, 10, 'dummy', None)]
         log.debug(order_out)
@@ -3213,22 +3696,39 @@ order by albumartist limit ?, ?
         elif table == 'CONTRIBUTINGARTIST_ALBUM':
             return [28, 34]
 
-    def get_updateid(self):
-        db = sqlite3.connect(os.path.join(os.getcwd(), self.dbname))
-        c = db.cursor()
-        statement = "select lastscanid from params where key = '1'"
-        log.debug("statement: %s", statement)
-        c.execute(statement)
-        new_updateid, = c.fetchone()
-        if new_updateid != self.updateid:
-            self.updateid = new_updateid
-            self._state_variables['SystemUpdateID'].update(self.updateid)
-            log.debug("SystemUpdateID value: %s" % self._state_variables['SystemUpdateID'].get_value())
-
-    def fixcriteria(self, criteria):
-        criteria = criteria.replace('\\"', '"')
-        criteria = criteria.replace('\\\\', '\\')
-        return criteria
+    def library_changed(self, generation):
+        # called once a new generation of the library is in use, or plays
+        # have been written to the current one
+        self.search_lock.acquire()
+        try:
+            self.search_windows.clear()
+        finally:
+            self.search_lock.release()
+        version = (generation.scanid, generation.plays)
+        if version == self.library_version:
+            return
+        scanned = self.library_version == None or generation.scanid != self.library_version[0]
+        self.library_version = version
+        # the SystemUpdateID is the scan id, moved on by one for each set of
+        # plays, and never goes back
+        try:
+            updateid = int(self.updateid) + 1
+        except ValueError:
+            updateid = 0
+        if scanned:
+            try:
+                updateid = max(updateid, int(generation.scanid))
+            except (TypeError, ValueError):
+                pass
+            containers = ROOT_CONTAINER_IDS + SMART_CONTAINER_IDS
+        else:
+            # plays only change the smart containers
+            containers = PLAYED_CONTAINER_IDS
+        self.updateid = updateid
+        self._state_variables['SystemUpdateID'].update(self.updateid)
+        log.debug("SystemUpdateID value: %s" % self._state_variables['SystemUpdateID'].get_value())
+        containerupdateids = ','.join(['%s,%s' % (id, self.updateid) for id in containers])
+        self._state_variables['ContainerUpdateIDs'].update(containerupdateids)
 
     def convert_path(self, path):
         filepath = path
@@ -3258,6 +3758,120 @@ order by albumartist limit ?, ?
             return album, None
         return newalbum, dup
 
+    def get_track_items(self, c, ids):
+        # returns the stored TrackItems for the track ids that have them, keyed on id
+        items = {}
+        if not self.track_items:
+            return items
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            statement = "select id, item, browseitem, filetype, transcodetype, contenttype, cover, artid from TrackItems where options = ? and id in (%s)" % ','.join('?' * len(chunk))
+            try:
+                c.execute(statement, (self.track_item_options, ) + tuple(chunk))
+            except sqlite3.Error, e:
+                # database was created before movetags stored track items
+                log.debug("track items not available: %s" % e.args[0])
+                self.track_items = False
+                return {}
+            for row in c:
+                items[row[0]] = row[1:]
+        return items
+
+    def build_track_item(self, row):
+        # returns the item for a tracks row that has no stored TrackItem,
+        # registering its files with the webserver
+        id, id2, parentID, duplicate, title, artist, album, genre, tracknumber, year, albumartist, composer, codec, length, size, created, path, filename, discnumber, comment, folderart, trackart, bitrate, samplerate, bitspersample, channels, mime, lastmodified, upnpclass, folderartid, trackartid, inserted, lastplayed, playcount, lastscanned = row
+        mime = fixMime(mime)
+        cover, artid = self.choosecover(folderart, trackart, folderartid, trackartid)
+
+        # TODO: automate mount
+        wsfile = filename
+        wspath = os.path.join(path, filename)
+        path = self.convert_path(path)
+        filepath = path + filename
+        filepath = encode_path(filepath)
+        filepath = escape(filepath, escape_entities)
+        protocol = getProtocol(mime)
+        contenttype = mime
+        filetype = getFileType(filename)
+        
+        transcode, newtype = checktranscode(filetype, bitrate, samplerate, bitspersample, channels, codec)
+        if transcode:
+            dummyfile = self.dbname + '.' + id + '.' + newtype
+        else:
+            dummyfile = self.dbname + '.' + id + '.' + filetype
+        res = self.proxyaddress + '/WMPNSSv3/' + dummyfile
+        if transcode:
+            log.debug('\ndummyfile: %s\nwsfile: %s\nwspath: %s\ncontenttype: %s\ntranscodetype: %s' % (dummyfile, wsfile, wspath, contenttype, newtype))
+            dummystaticfile = webserver.TranscodedFileSonos(dummyfile, wsfile, wspath, newtype, contenttype, cover=cover)
+            self.proxy.wmpcontroller.add_transcoded_file(dummystaticfile)
+        else:
+            log.debug('\ndummyfile: %s\nwsfile: %s\nwspath: %s\ncontenttype: %s' % (dummyfile, wsfile, wspath, contenttype))
+            dummystaticfile = webserver.StaticFileSonos(dummyfile, wsfile, wspath, contenttype, cover=cover)
+            self.proxy.wmpcontroller.add_static_file(dummystaticfile)
+        
+        if cover != '' and not cover.startswith('EMBEDDED_'):
+            cvfile = getFile(cover)
+            cvpath = cover
+            coverfiletype = getFileType(cvfile)
+            dummycoverfile = self.dbname + '.' + str(artid) + '.' + coverfiletype
+            coverres = self.proxyaddress + '/WMPNSSv3/' + dummycoverfile
+            dummycoverstaticfile = webserver.StaticFileSonos(dummycoverfile, cvfile, cvpath)    # TODO: pass contenttype
+            self.proxy.wmpcontroller2.add_static_file(dummycoverstaticfile)
+        
+        duration = maketime(float(length))
+
+        if title == '': title = '[unknown title]'
+        if artist == '': artist = '[unknown artist]'
+        else: artist = self.get_artist(artist, self.now_playing_artist, self.now_playing_artist_combiner)
+        if albumartist == '': albumartist = '[unknown albumartist]'
+        else: albumartist = self.get_artist(albumartist, self.now_playing_artist, self.now_playing_artist_combiner)
+        if album == '': album = '[unknown album]'
+#        title = escape(title, escape_entities_quotepos)
+#        artist = escape(artist, escape_entities_quotepos)
+#        albumartist = escape(albumartist, escape_entities_quotepos)
+#        album = escape(album, escape_entities_quotepos)
+        title = escape(title)
+        artist = escape(artist)
+        albumartist = escape(albumartist)
+        album = escape(album)
+        tracknumber = self.convert_tracknumber(tracknumber)
+
+        ret = '<item id="%s" parentID="%s" restricted="true">' % (id, parentID)
+        ret += '<dc:title>%s</dc:title>' % (title)
+        ret += '<upnp:artist role="AlbumArtist">%s</upnp:artist>' % (albumartist)
+        ret += '<upnp:artist role="Performer">%s</upnp:artist>' % (artist)
+        ret += '<upnp:album>%s</upnp:album>' % (album)
+        if tracknumber != 0:
+            ret += '<upnp:originalTrackNumber>%s</upnp:originalTrackNumber>' % (tracknumber)
+        ret += '<upnp:class>%s</upnp:class>' % (upnpclass)
+        ret += '<res duration="%s" protocolInfo="%s">%s</res>' % (duration, protocol, res)
+#####        ret += '<desc id="cdudn" nameSpace="urn:schemas-rinconnetworks-com:metadata-1-0/">%s</desc>' % (self.wmpudn)
+#        if cover != '' and not cover.startswith('EMBEDDED_'):
+#            ret += '<upnp:albumArtURI>%s</upnp:albumArtURI>' % (coverres)
+        ret += '</item>'
+        return ret
+
+    def add_track_item(self, trackitem, id, path, filename, browse=False):
+        # registers the track's files with the webserver and returns its item
+        item, browseitem, filetype, transcodetype, contenttype, cover, artid = trackitem
+        dummyfile = self.dbname + '.' + id + '.' + filetype
+        wspath = os.path.join(path, filename)
+        if transcodetype:
+            dummystaticfile = webserver.TranscodedFileSonos(dummyfile, filename, wspath, transcodetype, contenttype, cover=cover)
+            self.proxy.wmpcontroller.add_transcoded_file(dummystaticfile)
+        else:
+            dummystaticfile = webserver.StaticFileSonos(dummyfile, filename, wspath, contenttype, cover=cover)
+            self.proxy.wmpcontroller.add_static_file(dummystaticfile)
+        if cover != '' and not cover.startswith('EMBEDDED_'):
+            cvfile = getFile(cover)
+            dummycoverfile = self.dbname + '.' + str(artid) + '.' + getFileType(cvfile)
+            dummycoverstaticfile = webserver.StaticFileSonos(dummycoverfile, cvfile, cover)    # TODO: pass contenttype
+            self.proxy.wmpcontroller2.add_static_file(dummycoverstaticfile)
+        if browse and browseitem:
+            item = browseitem
+        return item % self.track_item_slots
+
     def choosecover(self, folderart, trackart, folderartid, trackartid):
         log.debug(folderart)
         log.debug(trackart)
@@ -3400,38 +4014,6 @@ def fixcolonequals(clist):
         cdict[n] = v
     return cdict
 
-def maketime(seconds):
-    if int(seconds) == 0:
-        return "00:00:00.000"
-    h = int(seconds / 3600)
-    seconds -= h * 3600
-    m = int(seconds / 60)
-    seconds -= m * 60
-    s = seconds
-    return '%d:%02d:%02d.000' % (h,m,s)
-
-def fixMime(mime):
-    if mime == 'audio/x-flac':
-        mime = 'audio/flac'
-    elif mime == 'audio/vorbis':
-        mime = 'application/ogg'
-
-
-    elif mime == 'audio/mp3':
-        mime = 'audio/mpeg'
-
-
-    return mime
-
-def getProtocol(mime):
-#    return 'http-get:*:%s:*' % mime    
-    return 'http-get:*:%s:%s' % (mime, 'DLNA.ORG_PN=MP3;DLNA.ORG_OP=01;DLNA.ORG_CI=0')
-
-
-
-def getFileType(filename):
-    return filename.split('.')[-1]
-
 def getFile(path):
     return path.split(os.sep)[-1]
 
@@ -81,7 +81,7 @@ import ConfigParser
 import StringIO
 import codecs
 
-from data import ListDataController, GetDataController, PlayController, GetDeviceController, SetRendererController, PollRendererController, ActionRendererController, PollServerController, PollQueueController
+from data import ListDataController, GetDataController, PlayController, GetDeviceController, SetRendererController, PollRendererController, ActionRendererController, PollServerController, PollQueueController, JSONDataController
 
 #import log
 from brisa.core import log
@@ -99,13 +99,16 @@ import re
 
 from xml.sax.saxutils import escape, unescape
 
-from Queue import Queue, Empty
 from threading import Lock
 import datetime
+import time
     
 from brisa.upnp.control_point.service import Service, SubscribeRequest
 
 from proxy import Proxy
+from browsestore import BrowseStore, BrowseRecord, BrowseSource
+from playclock import PlaybackClock
+from eventdispatch import EventDispatcher
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
@@ -128,6 +131,7 @@ from brisa.core.threaded_call import run_async_function, run_async_call
 from brisa.utils.looping_call import LoopingCall
 
 from music_items import music_item, dump_element, prettyPrint, getAlbumArtURL
+from lastchange import parse_lastchange, MetadataCache, AVT_NS, RCS_NS
 
 from sonos_service import radiotimeMediaCollection, radiotimeMediaMetadata
 
@@ -163,8 +167,6 @@ class ControlPointWeb(object):
     now_playing_pos = ''
     now_playing_percent = ''
     processing_event = False
-    event_queue = Queue()
-    last_event_seq = {}
     event_lock = Lock()
     album_art = ''
 
@@ -178,18 +180,7 @@ class ControlPointWeb(object):
     current_track_relative_time_position = ''
     messagebar = ''
 
-    prev_now_playing_dict = {}
-    prev_now_extras_dict = {}
-    prev_now_playing_pos = '-'
-    prev_now_playing_percent = '-'
-    prev_current_volume = '-'
-    prev_volume_fixed = '-'
-    prev_volume_mute = '-'
-    prev_play_state = '-'
-    prev_album_art = '-'
-
     queue_updateid = ''
-    prev_queue_updateid = '-'
 
     current_queue_length = -1
     current_queue_updateid = -1
@@ -523,6 +514,53 @@ Music/Rating                101     object.container
     except ConfigParser.NoOptionError:
         pass
 
+    # web client ini vars
+
+    # how long a web client waiting for renderer changes is held before it
+    # is answered with no change, and how many are held at once (each uses
+    # one of the data webserver's threads, clients over this poll instead)
+    renderer_wait_timeout = 20
+    renderer_wait_clients = 2
+    try:        
+        renderer_wait_timeout = int(config.get('INI', 'renderer_wait_timeout'))
+    except ConfigParser.NoOptionError:
+        pass
+    try:        
+        renderer_wait_clients = int(config.get('INI', 'renderer_wait_clients'))
+    except ConfigParser.NoOptionError:
+        pass
+    # seconds getData waits for a browse to fill the requested set of data
+    getdata_timeout = 30
+    try:        
+        getdata_timeout = int(config.get('INI', 'getdata_timeout'))
+    except ConfigParser.NoOptionError:
+        pass
+    # megabytes of browse results kept for the web UI
+    browse_store_size = 16
+    try:        
+        browse_store_size = int(config.get('INI', 'browse_store_size'))
+    except ConfigParser.NoOptionError:
+        pass
+    # the position isn't evented, so it is worked out from the last one read
+    # from the renderer, which is read again when the renderer's state or
+    # track changes or once it is this many seconds old
+    position_resync_interval = 30
+    try:        
+        position_resync_interval = int(config.get('INI', 'position_resync_interval'))
+    except ConfigParser.NoOptionError:
+        pass
+    # events processed this many seconds after they arrived are logged
+    event_lag_warning = 2.0
+    try:        
+        event_lag_warning = float(config.get('INI', 'event_lag_warning'))
+    except ConfigParser.NoOptionError:
+        pass
+    # the position is refreshed for waiting clients (at most once this many
+    # seconds) while the renderer is playing
+    position_interval = 1.0
+    # milliseconds a client that could not be held waits before asking again
+    renderer_poll_interval = 1000
+
     ###########################################################################
     # __init__
     ###########################################################################
@@ -531,6 +569,16 @@ Music/Rating                101     object.container
 
         log.debug("__init__")
 
+        # playback position of the current renderer
+        self.position_clock = PlaybackClock(self.position_resync_interval)
+
+        # events are processed in order on their own thread - one is enough
+        # as they are all for the current renderer and server
+        self.event_dispatcher = EventDispatcher(self.process_device_event, 1, self.event_lag_warning, 'pycpoint-events')
+
+        # parsed track metadata keyed on the raw DIDL-Lite from events
+        self.metadata_cache = MetadataCache(self.parse_event_metadata)
+
         if not self.options.proxyonly:
 
             self.control_point = ControlPointSonos(self.ws_port)
@@ -645,18 +693,29 @@ Music/Rating                101     object.container
 
             self.rootmenus = []
             
-            self.gdatasets = {}
-            self.gdatakeys = {}
-            self.gdataparentkey = {}
-            self.gdatatracks = {}
-            self.gdata_lastindex = {}
-            self.gdataparent = {}
+            # browse results, in sets that are filled by the async browse
+            # calls and marked complete (or their browse failed) under
+            # gdata_condition, getdata waits on it
+            self.gdatastore = BrowseStore(self.browse_store_size * 1024 * 1024)
+            self.gdata_condition = self.gdatastore.condition
+            self.gdata_failed = {}
 
             self.queue_entry = None
+
+            # renderer data as last sent to the web clients, each entry
+            # stamped with the state version it last changed in. Clients
+            # waiting on rendererWait are woken when the version changes
+            self.renderer_state = {}
+            self.renderer_state_version = {}
+            self.renderer_version = 0
+            self.renderer_condition = threading.Condition()
+            self.renderer_waiters = 0
+            self.position_time = 0
             
             getdevicecontroller = GetDeviceController(self.devicedata, 'deviceData')
             setrenderercontroller = SetRendererController(self.renderermetadata, 'rendererData', self.setrenderer)
             pollrenderercontroller = PollRendererController(self.rendererdata, 'rendererPoll', self.pollrenderer)
+            waitrenderercontroller = GetDataController(None, 'rendererWait', self.waitrenderer)
             actionrenderercontroller = ActionRendererController(self.rendererdata, 'rendererAction', self.actionrenderer)
             pollservercontroller = PollServerController(self.servermetadata, 'serverPoll', self.pollserver)
             pollqueuecontroller = PollQueueController(self.queuedata, 'queuePoll', self.pollqueue)
@@ -665,11 +724,18 @@ Music/Rating                101     object.container
             getdatacontroller = GetDataController(None, 'getData', self.getdata)
             playcontroller = PlayController('playData', self.playdata)
 
+            # v2 - the same data as JSON
+            v2getdatacontroller = JSONDataController('getData', self.getdata_v2)
+            v2waitrenderercontroller = JSONDataController('rendererWait', self.waitrenderer_v2)
+            v2pollrenderercontroller = JSONDataController('rendererPoll', self.pollrenderer_v2)
+            v2pollqueuecontroller = JSONDataController('queuePoll', self.pollqueue_v2)
+
             ws = self.control_point._event_listener.srv
             res = webserver.CustomResource('data')
             res.add_resource(getdevicecontroller)
             res.add_resource(setrenderercontroller)
             res.add_resource(pollrenderercontroller)
+            res.add_resource(waitrenderercontroller)
             res.add_resource(actionrenderercontroller)
             res.add_resource(pollservercontroller)
             res.add_resource(pollqueuecontroller)
@@ -677,6 +743,12 @@ Music/Rating                101     object.container
             res.add_resource(rootmenucontroller)
             res.add_resource(getdatacontroller)
             res.add_resource(playcontroller)
+            v2 = webserver.CustomResource('v2')
+            v2.add_resource(v2getdatacontroller)
+            v2.add_resource(v2waitrenderercontroller)
+            v2.add_resource(v2pollrenderercontroller)
+            v2.add_resource(v2pollqueuecontroller)
+            res.add_resource(v2)
             ws.add_resource(res)
 
             # start MSEARCH
@@ -740,7 +812,12 @@ Music/Rating                101     object.container
         del self.rootdata[:]
         self.rootdatakeys.clear()
         self.rootdata_lastindex = 0
-        self.gdatasets.clear()
+        self.gdata_condition.acquire()
+        try:
+            self.gdatastore.clear()
+            self.gdata_failed.clear()
+        finally:
+            self.gdata_condition.release()
         self.set_server_device(device)
         # sort the root data
         self.rootdata = sorted(self.rootdata, key=self.gettitle)
@@ -781,7 +858,8 @@ Music/Rating                101     object.container
     def update_queuedata(self, title, id, type, ref):
         menu = self.get_server_menu_type(id, type)
         new_entry = ref + "::" + 'R'  + "::" + menu + "::" + title
-        self.queuedata.append(new_entry + self.data_delim)
+        if new_entry + self.data_delim not in self.queuedata:
+            self.queuedata.append(new_entry + self.data_delim)
         self.queuedatakeys[new_entry] = (id, type)
         return new_entry
 
@@ -831,6 +909,27 @@ Music/Rating                101     object.container
         datastart = int(datas[1])
         datacount = int(datas[2])
 
+        # remove data from end of entry
+        colpos = entry.rfind('::')
+        entrykey = entry[:colpos]
+        if len(entries) == 6:
+            colpos = entrykey.rfind('::')
+            entrykey = entrykey[:colpos]
+            colpos = entrykey.rfind('::')
+            entrykey = entrykey[:colpos]
+
+        if id_passed == True:
+            passed = (s_id, s_type)
+        else:
+            passed = None
+        state, records, info = self.browse_window(entry, entryref, entrykey, passed, dataseq, datacount, searchstring, searchoperator)
+        return self.gdata_strings(state, records, info)
+
+    def browse_window(self, entry, entryref, entrykey, passed, dataseq, datacount, searchstring, searchoperator):
+        # get a window of the data for an entry, browsing it on the first
+        # call. Returns the state of the set for the window, its records and
+        # its (returned, total) (or the message if the browse failed)
+
         # process dataseq
         if dataseq == 0:
             # special case - do not browse on first call as it's already been done
@@ -841,33 +940,27 @@ Music/Rating                101     object.container
         elif dataseq > 1:
             first_call = False
 
-        # remove data from end of entry
-        colpos = entry.rfind('::')
-        entrykey = entry[:colpos]
-        if len(entries) == 6:
-            colpos = entrykey.rfind('::')
-            entrykey = entrykey[:colpos]
-            colpos = entrykey.rfind('::')
-            entrykey = entrykey[:colpos]
-
         # get set key
         setkey = entryref + ':' + str(dataseq)
         setparent = entryref
 
+        record = self.gdatastore.find(entrykey)
         if entrykey in self.rootdatakeys:
             id, type = self.rootdatakeys[entrykey]
         elif entrykey in self.queuedatakeys:
             id, type = self.queuedatakeys[entrykey]
-        elif entrykey in self.gdatakeys:
-            id, type = self.gdatakeys[entrykey]
+        elif record != None:
+            id, type = record.id, record.type
+        # check for special case (after checking in key stores in case they have more up to date info)
+        elif passed != None:
+            id, type = passed
         else:
-            # check for special case (after checking in key stores in case they have more up to date info)
-            if id_passed == True:
-                id = s_id
-                type = s_type
-            else:
+            # the entry may have been evicted, try browsing for it again
+            record = self.restore_gdata_record(entrykey)
+            if record == None:
                 print "entry '" + str(entrykey) + "' not found in rootdata/queuedata/gdata."
-                return []
+                return 'NOTFOUND', [], None
+            id, type = record.id, record.type
         
         # save queue entry if queue
         if id == 'Q:0' and first_call == True:
@@ -884,31 +977,55 @@ Music/Rating                101     object.container
         print "setkey: " + str(setkey)
         print "first_call: " + str(first_call)
         print "dataseq: " + str(dataseq)
-        if setkey in self.gdatasets:
-            print "len: " + str(len(self.gdatasets[setkey]))
         
         if first_call == True:
             # first time through, process the browse
-            self.gdata_lastindex[setparent] = 0
-            self.process_browse(type, id, searchstring=searchstring, searchoperator=searchoperator, name=rootname, sequence=dataseq, count=datacount, setkey=setkey)
-            return self.gdatasets[setkey]
+            source = BrowseSource(type, id, searchstring, searchoperator, rootname, datacount)
+            self.start_gdata_browse(setparent, source)
+            # the first browse call is synchronous, so don't wait for it
+            return self.wait_gdata_dataset(setkey, 0)
         else:
-            # not first time, check if the data is ready from the first browse initiated async calls
-            if setkey in self.gdatasets:
-                if dataseq == 1:
-                    # special case where initial browse has already been done - don't know count so just return what we have
-                    return self.gdatasets[setkey]
-                setsize = len(self.gdatasets[setkey])
-                if setsize == datacount + 1:    # +1 to cater for the result entry
-                    # data for this set is complete, return it
-                    return self.gdatasets[setkey]
-                elif setsize == datacount + 2:    # +1 to cater for the result entry, plus Napster index starts at zero and affects the last set in a multiple return
-                    # TODO: make this Napster specific
-                    # data for this set is complete, return it
-                    return self.gdatasets[setkey]
-            # not ready, return wait with count so far
-            dataset = ['NOTREADY' + self.data_delim]
-            return dataset
+            if self.gdatastore.was_evicted(setkey):
+                # the set has been dropped from the store, browse again
+                if self.start_gdata_browse(setparent):
+                    return self.wait_gdata_dataset(setkey, self.getdata_timeout)
+            # not first time, wait for the async calls initiated by the first
+            # browse to fill this set (or the browse to fail)
+            return self.wait_gdata_dataset(setkey, self.getdata_timeout)
+
+    def start_gdata_browse(self, setparent, source=None):
+        # browse for the sets of setparent, from source or (if not passed)
+        # the source it was last browsed from. Returns False if there isn't one
+        if source == None:
+            source = self.gdatastore.get_source(setparent)
+            if source == None or source.type == None:
+                return False
+            source = BrowseSource(source.type, source.id, source.searchstring, source.searchoperator, source.name, source.count)
+        self.reset_gdata_datasets(setparent)
+        self.gdatastore.start_browse(setparent, source)
+        self.process_browse(source.type, source.id, searchstring=source.searchstring, searchoperator=source.searchoperator, name=source.name, sequence=1, count=source.count, setkey=setparent + ':1')
+        return True
+
+    def restore_gdata_record(self, entrykey):
+        # browse again for an entry whose set has been evicted, returning its
+        # record (or None if it can't be browsed for)
+        ref = entrykey.split('::')[0]
+        setparent = self.getparentref(ref)
+        if not ref.startswith(setparent + '_') or not self.start_gdata_browse(setparent):
+            return None
+        index = int(ref[len(setparent)+1:])
+        # the sets are filled in order, wait for them until the entry's turns up
+        sequence = 1
+        seen = 0
+        while True:
+            state, records, info = self.wait_gdata_dataset(setparent + ':' + str(sequence), self.getdata_timeout)
+            if state != 'COMPLETE':
+                return None
+            record = self.gdatastore.find(entrykey)
+            seen += len(records)
+            if record != None or seen >= index or seen >= info[1]:
+                return record
+            sequence += 1
 
     def browse_queue(self, param):
 
@@ -956,12 +1073,13 @@ Music/Rating                101     object.container
         setkey = entryref + ':' + str(dataseq)
         setparent = entryref
 
+        record = self.gdatastore.find(entrykey)
         if entrykey in self.rootdatakeys:
             id, type = self.rootdatakeys[entrykey]
         elif entrykey in self.queuedatakeys:
             id, type = self.queuedatakeys[entrykey]
-        elif entrykey in self.gdatakeys:
-            id, type = self.gdatakeys[entrykey]
+        elif record != None:
+            id, type = record.id, record.type
         else:
             print "entry '" + str(entrykey) + "' not found in rootdata/queuedata/gdata."
             return
@@ -974,7 +1092,7 @@ Music/Rating                101     object.container
             rootname = ''
         
         # process the browse
-        self.gdata_lastindex[setparent] = 0
+        self.gdatastore.start_browse(setparent, BrowseSource(type, id, searchstring, searchoperator, rootname, datacount))
         self.process_browse(type, id, searchstring=searchstring, searchoperator=searchoperator, name=rootname, sequence=dataseq, count=datacount, setkey=setkey)
 
     def getrootref(self, ref):
@@ -996,7 +1114,7 @@ Music/Rating                101     object.container
 
     def update_gdata(self, title, id, type, res=None, xml=None, searchtype=None, searchtitle=None, searchoperators=None, sequence=0, setkey='', parentid=None, extras=None):
         setparent = setkey.split(':')[0]
-        ref = self.gdataparent[setparent] + '_' + str(self.gdata_lastindex[setparent]+1)
+        ref = self.gdatastore.next_ref(setparent)
         if res != None:
             entrytype = 'T'
         else:
@@ -1008,44 +1126,136 @@ Music/Rating                101     object.container
                 else:
                     entrytype = 'C'
         menu = self.get_server_menu_type(id, type)
-        new_entry = ref + '::' + entrytype + '::' + menu + '::' + title
-
-        self.gdatakeys[new_entry] = (id, type)
-        if parentid != None:
-            self.gdataparentkey[id] = parentid
-        if res != None:
-            self.gdatatracks[new_entry] = (res, xml)
 
-        # append id and type in case receiver is caching
-        new_entry += '::' + id + '::' + type
-
-        # append any search criteria to end of entry (but not to the keys/tracks)
+        # the set holds records, formatted for the data protocol asked for
+        record = BrowseRecord(ref, entrytype, menu, title, id, type, parentid=parentid, extras=extras, res=res, xml=xml)
         if searchtype != None:
-            new_entry += self.search_delim + searchtype + '::' + searchtitle
+            record.search = searchtype
+            record.searchtitle = searchtitle
         if searchoperators != None:
-            operators = self.codeoperators(searchoperators)
-            new_entry += '::' + operators
+            record.operators = self.codeoperators(searchoperators)
+        if sequence == 0:
+            # not browsed for a window, keep the record outside the window sets
+            setkey = setparent + ':0'
+        self.gdatastore.add_record(setkey, record)
+
+    def gdata_entry(self, record):
+        # the delimited string for a record
+        new_entry = record.key()
+        # append id and type in case receiver is caching
+        new_entry += '::' + record.id + '::' + record.type
+        # append any search criteria to end of entry (but not to the keys/tracks)
+        if record.search != None:
+            new_entry += self.search_delim + record.search + '::' + record.searchtitle
+        if record.operators != None:
+            new_entry += '::' + record.operators
         # append any extras to end of entry    
-        if extras != None:
-            new_entry += self.extras_delim + extras
-        self.gdata_lastindex[setparent] += 1
-
-        if sequence != 0:
-            self.gdatasets[setkey].append(new_entry + self.data_delim)
-
+        if record.extras != None:
+            new_entry += self.extras_delim + record.extras
+        return new_entry + self.data_delim
+
+    def gdata_strings(self, state, records, info):
+        # the delimited strings for a window of data
+        if state == 'NOTFOUND':
+            return []
+        elif state == 'FAILED':
+            return ['FAILED::' + info + self.data_delim]
+        elif state == 'NOTREADY':
+            return ['NOTREADY' + self.data_delim]
+        dataset = [self.gdata_entry(record) for record in records]
+        if info != None:
+            returned, total = info
+            dataset.append("RETURN::" + str(returned) + ':' + str(total) + self.data_delim)
+        return dataset
+
+    def gdata_json(self, state, records, info):
+        # a window of data for the v2 protocol
+        if state == 'NOTFOUND':
+            return {'state': 'notfound'}
+        elif state == 'FAILED':
+            return {'state': 'failed', 'message': info}
+        elif state == 'NOTREADY':
+            return {'state': 'notready'}
+        items = []
+        for record in records:
+            item = {'ref': record.ref, 'class': record.entryclass, 'menu': record.menu, 'title': record.title, 'id': record.id, 'type': record.type}
+            if record.search != None:
+                item['search'] = record.search
+                item['searchtitle'] = record.searchtitle
+            if record.operators != None:
+                item['operators'] = record.operators.split(',')
+            if record.extras != None:
+                item['extras'] = dict([e.split('=', 1) for e in record.extras.split('::') if '=' in e])
+            items.append(item)
+        data = {'state': 'complete', 'items': items}
+        if info != None:
+            data['returned'], data['total'] = info
+        else:
+            data['state'] = 'partial'
+        return data
 
     def initialise_gdata_dataset(self, sequence=0, setkey=''):
         if sequence != 0:
-            setparent = setkey.split(':')[0]
-            self.gdatasets[setkey] = []
-            self.gdataparent[setparent] = setparent
+            self.gdatastore.new_set(setkey)
 
     def finalise_gdata_dataset(self, sequence=0, returned=0, total=0, setkey=''):
         if sequence != 0:
-            if len(self.gdatasets[setkey]) == 0:
+            browseset = self.gdatastore.get_set(setkey)
+            if browseset != None and len(browseset.records) == 0:
                 # nothing was returned, add a dummy entry for display
                 self.update_gdata('Nothing found', 'DUMMY', 'DUMMY', sequence=sequence, setkey=setkey)
-            self.gdatasets[setkey].append("RETURN::" + str(returned) + ':' + str(total) + self.data_delim)
+            self.gdata_condition.acquire()
+            try:
+                self.gdatastore.complete_set(setkey, (returned, total))
+                self.gdata_condition.notifyAll()
+            finally:
+                self.gdata_condition.release()
+
+    def fail_gdata_dataset(self, setkey, message):
+        # the browse for this set failed, so neither it nor any later set of
+        # the browse will be filled
+        setparent, sequence = setkey.split(':')
+        self.gdata_condition.acquire()
+        try:
+            self.gdata_failed[setparent] = (int(sequence), message)
+            self.gdatastore.abandon_sets(setparent)
+            self.gdata_condition.notifyAll()
+        finally:
+            self.gdata_condition.release()
+
+    def reset_gdata_datasets(self, setparent):
+        # a new browse of setparent is starting, forget any failure of a
+        # previous one (its sets are dropped when the browse is started)
+        self.gdata_condition.acquire()
+        try:
+            self.gdata_failed.pop(setparent, None)
+        finally:
+            self.gdata_condition.release()
+
+    def wait_gdata_dataset(self, setkey, timeout):
+        # wait for the async browse calls to fill the set (or fail). With no
+        # timeout return whatever the set holds
+        setparent, sequence = setkey.split(':')
+        sequence = int(sequence)
+        deadline = time.time() + timeout
+        self.gdata_condition.acquire()
+        try:
+            while True:
+                browseset = self.gdatastore.get_set(setkey)
+                if browseset != None and browseset.complete:
+                    return 'COMPLETE', browseset.records, browseset.complete
+                if setparent in self.gdata_failed:
+                    failedsequence, message = self.gdata_failed[setparent]
+                    if sequence >= failedsequence:
+                        return 'FAILED', [], message
+                remaining = deadline - time.time()
+                if timeout == 0 and browseset != None:
+                    return 'PARTIAL', browseset.records, None
+                elif remaining <= 0:
+                    return 'NOTREADY', [], None
+                self.gdata_condition.wait(remaining)
+        finally:
+            self.gdata_condition.release()
 
     def codeoperators(self, operators):
         # replace symbol operators with symbol=code
@@ -1094,20 +1304,6 @@ Music/Rating                101     object.container
             
         return self.renderermetadata
 
-    def clearprevrendererdata(self):
-        self.prev_now_playing_dict.clear()
-        self.prev_now_extras_dict.clear()
-        self.prev_now_playing_pos = '-'
-        self.prev_now_playing_percent = '-'
-        self.prev_current_volume = '-'
-        self.prev_volume_fixed = '-'
-        self.prev_volume_mute = '-'
-        self.prev_play_state = '-'
-        self.prev_album_art = '-'
-
-    def clearprevrenderermetadata(self):
-        self.prev_queue_updateid = '-'
-
     def pollrenderer(self, param):
         # param will be in utf-8, whereas data is stored in unicode
         param = param.decode('utf-8', 'replace')
@@ -1119,13 +1315,148 @@ Music/Rating                101     object.container
         entries = entry.split('::')
         entrytype = entries[0]
         entryname = entries[1]
+        # optional third entry is the last state version the client has seen
+        version = self.get_client_version(entries, 2)
         # NOTE - at the moment we aren't using the passed renderer data to 
         # get info for that specific renderer...
 #        udn = self.devicedatakeys[entry]
 #        device = self.known_media_renderers[udn]
         self.update_position()
-        self.get_renderer_data()
-        return self.rendererdata
+        self.update_renderer_state()
+        return self.get_renderer_data(version)
+
+    def waitrenderer(self, param):
+        # param will be in utf-8, whereas data is stored in unicode
+        param = param.decode('utf-8', 'replace')
+        # param may contain escaped chars
+        param = unescape(param)
+
+        query = param.split('=')
+        entry = query[1]
+        entries = entry.split('::')
+        # first entry is the last state version the client has seen
+        version = self.get_client_version(entries, 0)
+        # NOTE - as with pollrenderer we aren't using the passed renderer data
+        retry = self.wait_renderer(version)
+        return self.get_renderer_changes(version, retry)
+
+    def wait_renderer(self, version):
+        # wait for the renderer state to change from version. Returns the
+        # milliseconds the client should wait before asking again (0 unless
+        # the client wasn't held and is to poll)
+        if version == 0:
+            # new client (or one from before a restart), send everything
+            self.update_position()
+            self.update_renderer_state()
+            return 0
+
+        self.renderer_condition.acquire()
+        try:
+            held = self.renderer_waiters < self.renderer_wait_clients
+            if held:
+                self.renderer_waiters += 1
+        finally:
+            self.renderer_condition.release()
+        if not held:
+            # too many clients waiting, answer now and have this one poll
+            self.refresh_position()
+            return self.renderer_poll_interval
+
+        # wait for an event to change the state (or the position to move)
+        try:
+            deadline = time.time() + self.renderer_wait_timeout
+            while True:
+                self.renderer_condition.acquire()
+                try:
+                    remaining = deadline - time.time()
+                    if self.renderer_version > version or remaining <= 0:
+                        break
+                    self.renderer_condition.wait(min(remaining, self.position_interval))
+                    changed = self.renderer_version > version
+                finally:
+                    self.renderer_condition.release()
+                if not changed:
+                    self.refresh_position()
+        finally:
+            self.renderer_condition.acquire()
+            self.renderer_waiters -= 1
+            self.renderer_condition.release()
+        return 0
+
+    def refresh_position(self):
+        # the position isn't evented, so while the renderer is playing read
+        # it for the waiting clients, at most once every position_interval
+        if self.play_state != 'PLAYING':
+            return
+        self.renderer_condition.acquire()
+        try:
+            now = time.time()
+            if now - self.position_time < self.position_interval:
+                return
+            self.position_time = now
+        finally:
+            self.renderer_condition.release()
+        self.update_position()
+        self.update_renderer_state()
+
+    def update_renderer_state(self):
+        # stamp the renderer data entries that have changed with a new state
+        # version and wake the clients waiting for changes
+        state = {}
+        for k,v in self.now_playing_dict.iteritems():
+            state[k] = v
+        for k,v in self.now_extras_dict.iteritems():
+            state[k] = v
+        state['POSITION'] = self.now_playing_pos
+        state['PERCENT'] = self.now_playing_percent
+        state['VOLUME'] = ("%.0f" % self.current_volume)
+        state['VOLUME_FIXED'] = str(self.volume_fixed)
+        state['MUTE'] = str(self.volume_mute)
+        state['STATE'] = str(self.play_state)
+        state['ART'] = str(self.album_art)
+        state['QUEUE'] = self.queue_updateid
+        self.renderer_condition.acquire()
+        try:
+            changed = [k for k,v in state.iteritems() if self.renderer_state.get(k) != v]
+            if changed:
+                self.renderer_version += 1
+                for k in changed:
+                    self.renderer_state_version[k] = self.renderer_version
+                self.renderer_condition.notifyAll()
+            # entries no longer sent (e.g. TRACK once a station is playing)
+            for k in self.renderer_state.keys():
+                if not k in state:
+                    del self.renderer_state_version[k]
+            self.renderer_state = state
+        finally:
+            self.renderer_condition.release()
+
+    def renderer_changes(self, version, select=None):
+        # the current version and the renderer data entries (those select
+        # accepts) changed since version
+        changes = {}
+        self.renderer_condition.acquire()
+        try:
+            for k,v in self.renderer_state.iteritems():
+                if self.renderer_state_version[k] > version and (select == None or select(k)):
+                    changes[k] = v
+            return self.renderer_version, changes
+        finally:
+            self.renderer_condition.release()
+
+    def get_renderer_changes(self, version, retry=0, select=None):
+        # the renderer data entries (those select accepts) changed since
+        # version, headed by the current version (and the milliseconds to
+        # wait before asking again if the client is to poll)
+        current, changes = self.renderer_changes(version, select)
+        data = ['VERSION' + "::" + str(current) + self.data_delim]
+        if retry:
+            data.append('RETRY' + "::" + str(retry) + self.data_delim)
+        for k,v in changes.iteritems():
+            data.append(k + "::" + v + self.data_delim)
+        if changes == {}:
+            data.append("NOCHANGE::0" + self.data_delim)
+        return data
 
     def actionrenderer(self, param):
         # param will be in utf-8, whereas data is stored in unicode
@@ -1152,11 +1483,11 @@ Music/Rating                101     object.container
         elif action == 'VOLUME':
             self.do_volume(value)
         self.update_position()
-        self.get_renderer_data()
+        self.update_renderer_state()
         # add any return from action here
 #        new_entry = 'ACTION' + "::" + str(self.@@@@)
 #        self.rendererdata.append(new_entry + self.data_delim)
-        return self.rendererdata
+        return self.get_renderer_data()
 
     def pollserver(self, param):
         # param will be in utf-8, whereas data is stored in unicode
@@ -1169,12 +1500,13 @@ Music/Rating                101     object.container
         entries = entry.split('::')
         entrytype = entries[0]
         entryname = entries[1]
+        # optional third entry is the last state version the client has seen
+        version = self.get_client_version(entries, 2)
         # NOTE - at the moment we aren't using the passed server data to 
         # get info for that specific server...
-        udn = self.devicedatakeys[entry]
+        udn = self.devicedatakeys[entrytype + '::' + entryname]
         device = self.known_media_servers[udn]
-        self.get_server_data()
-        return self.servermetadata
+        return self.get_server_data(version)
 
     def pollqueue(self, param):
         # param will be in utf-8, whereas data is stored in unicode
@@ -1188,91 +1520,93 @@ Music/Rating                101     object.container
 #        entrytype = entries[1]
 #        entryname = entries[3]
 #        deviceentry = entrytype + '::' + entryname
+        # optional fifth entry is the last state version the client has seen
+        version = self.get_client_version(entries, 4)
         
 #        # NOTE - at the moment we aren't using the passed server data to 
 #        # get info for that specific server...
 #        udn = self.devicedatakeys[deviceentry]
 #        device = self.known_media_servers[udn]
-        self.get_queue_data()
-        return self.queuedata
-
-    def get_renderer_data(self):
-        # TODO:
-        #   this will only cater for a single controlpoint at the moment
-        #   - need to pass a controlpoint identifier otherwise a new
-        #     controlpoint won't get data that hasn't changed since the last call
-        #     (alternately we can return all data instead)
-        del self.rendererdata[:]
-        for k,v in self.now_playing_dict.iteritems():
-            if (not k in self.prev_now_playing_dict) or self.prev_now_playing_dict[k] != v:
-                new_entry = k + "::" + v
-                self.rendererdata.append(new_entry + self.data_delim)
-                self.prev_now_playing_dict[k] = v
-        for k,v in self.now_extras_dict.iteritems():
-            if (not k in self.prev_now_extras_dict) or self.prev_now_extras_dict[k] != v:
-                new_entry = k + "::" + v
-                self.rendererdata.append(new_entry + self.data_delim)
-                self.prev_now_extras_dict[k] = v
-        if self.now_playing_pos != self.prev_now_playing_pos:
-            new_entry = 'POSITION' + "::" + self.now_playing_pos
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_now_playing_pos = self.now_playing_pos
-        if self.now_playing_percent != self.prev_now_playing_percent:
-            new_entry = 'PERCENT' + "::" + self.now_playing_percent
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_now_playing_percent = self.now_playing_percent
-        current_volume = ("%.0f" % self.current_volume)
-        if current_volume != self.prev_current_volume:
-            new_entry = 'VOLUME' + "::" + current_volume
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_current_volume = current_volume
-        if self.volume_fixed != self.prev_volume_fixed:
-            new_entry = 'VOLUME_FIXED' + "::" + str(self.volume_fixed)
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_volume_fixed = self.volume_fixed
-        if self.volume_mute != self.prev_volume_mute:
-            new_entry = 'MUTE' + "::" + str(self.volume_mute)
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_volume_mute = self.volume_mute
-        if self.play_state != self.prev_play_state:
-            new_entry = 'STATE' + "::" + str(self.play_state)
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_play_state = self.play_state
-        if self.album_art != self.prev_album_art:
-            new_entry = 'ART' + "::" + str(self.album_art)
-            self.rendererdata.append(new_entry + self.data_delim)
-            self.prev_album_art = self.album_art
-        if self.rendererdata == []:
-            self.rendererdata.append("NOCHANGE::0" + self.data_delim)
-
-    def get_server_data(self):
-        # TODO:
-        #   this will only cater for a single controlpoint at the moment
-        #   - need to pass a controlpoint identifier otherwise a new
-        #     controlpoint won't get data that hasn't changed since the last call
-        #     (alternately we can return all data instead)
-        del self.servermetadata[:]
-#        if self.queue_updateid != self.prev_queue_updateid:
-#            new_entry = 'QUEUE' + "::" + self.queue_updateid
-#            self.servermetadata.append(new_entry + self.data_delim)
-#            self.prev_queue_updateid = self.queue_updateid
-        if self.servermetadata == []:
-            self.servermetadata.append("NOCHANGE::0" + self.data_delim)
+        return self.get_queue_data(version)
+
+    def get_client_version(self, entries, index):
+        # the state version a client passed, 0 (send everything) if it didn't
+        # pass one or passed one from before a restart
+        try:
+            version = int(entries[index])
+        except (IndexError, ValueError):
+            return 0
+        if version < 0 or version > self.renderer_version:
+            return 0
+        return version
+
+    def waitrenderer_v2(self, params):
+        # params: version - the last state version the client has seen
+        version = self.get_client_version([params.get('version', '')], 0)
+        retry = self.wait_renderer(version)
+        current, changes = self.renderer_changes(version)
+        return {'version': current, 'retry': retry, 'changes': changes}
+
+    def pollrenderer_v2(self, params):
+        version = self.get_client_version([params.get('version', '')], 0)
+        self.update_position()
+        self.update_renderer_state()
+        current, changes = self.renderer_changes(version, lambda k: k != 'QUEUE')
+        return {'version': current, 'changes': changes}
+
+    def pollqueue_v2(self, params):
+        version = self.get_client_version([params.get('version', '')], 0)
+        current, changes = self.renderer_changes(version, lambda k: k == 'QUEUE')
+        return {'version': current, 'changes': changes}
+
+    def getdata_v2(self, params):
+        # params: ref, class, menu and title of the entry (plus its id and
+        # type if the client has them), data as seq,start,count and any
+        # search string and (coded) operator
+        # params may contain escaped chars
+        params = dict([(k, unescape(v)) for k, v in params.iteritems()])
+        entryref = params['ref']
+        entrykey = entryref + '::' + params['class'] + '::' + params['menu'] + '::' + params['title']
+        # delimited entry, kept for the queue
+        entry = entrykey
+        passed = None
+        if 'id' in params and 'type' in params:
+            passed = (params['id'], params['type'])
+            entry += '::' + params['id'] + '::' + params['type']
+        entry += '::' + params['data']
+        datas = params['data'].split(',')
+        dataseq = int(datas[0])
+        datacount = int(datas[2])
+        searchstring = params.get('search', '')
+        searchoperator = params.get('operator', '')
+        if searchoperator != '':
+            # operator may be coded
+            searchoperator = self.decodeoperators(searchoperator)
+        state, records, info = self.browse_window(entry, entryref, entrykey, passed, dataseq, datacount, searchstring, searchoperator)
+        return self.gdata_json(state, records, info)
+
+    def get_renderer_data(self, version=0):
+        # the renderer data changed since the client's state version
+        return self.get_renderer_changes(version, select=lambda k: k != 'QUEUE')
+
+    def get_server_data(self, version=0):
+        # no server data is sent at the moment
+        return self.get_renderer_changes(version, select=lambda k: False)
             
-    def get_queue_data(self):
-        # TODO:
-        #   this will only cater for a single controlpoint at the moment
-        #   - need to pass a controlpoint identifier otherwise a new
-        #     controlpoint won't get data that hasn't changed since the last call
-        #     (alternately we can return all data instead)
-        del self.queuedata[:]
-        if self.queue_updateid != self.prev_queue_updateid:
-            new_entry = 'QUEUE' + "::" + self.queue_updateid
-            self.queuedata.append(new_entry + self.data_delim)
-            self.prev_queue_updateid = self.queue_updateid
-        if self.queuedata == []:
-            self.queuedata.append("NOCHANGE::0" + self.data_delim)
+    def get_queue_data(self, version=0):
+        # the queue update id if the queue has changed since the client's
+        # state version
+        return self.get_renderer_changes(version, select=lambda k: k == 'QUEUE')
             
+    def find_gdata_record(self, entry):
+        # the record for an entry, browsing for it again if it was evicted
+        record = self.gdatastore.find(entry)
+        if record == None:
+            record = self.restore_gdata_record(entry)
+            if record == None:
+                raise KeyError(entry)
+        return record
+
     def playdata(self, param):
         # param will be in utf-8, whereas data is stored in unicode
         param = param.decode('utf-8', 'replace')
@@ -1295,9 +1629,10 @@ Music/Rating                101     object.container
             for entry in entrylist:
                 entries = entry.split('::')
                 entryref = entries[0]
-                id, type = self.gdatakeys[entry]
-                if entry in self.gdatatracks.keys():
-                    res, xml = self.gdatatracks[entry]
+                record = self.find_gdata_record(entry)
+                id, type = record.id, record.type
+                if record.res != None:
+                    res, xml = record.res, record.xml
                 else:
                     res = ''
                     xml = ''
@@ -1313,11 +1648,12 @@ Music/Rating                101     object.container
             entryref = entries[0]
 
             print "entry: " + str(entry)
-            id, type = self.gdatakeys[entry]
+            record = self.find_gdata_record(entry)
+            id, type = record.id, record.type
             print "id: " + str(id)
             print "type: " + str(type)
-            if entry in self.gdatatracks.keys():
-                res, xml = self.gdatatracks[entry]
+            if record.res != None:
+                res, xml = record.res, record.xml
             else:
                 res = ''
                 xml = ''
@@ -1363,20 +1699,16 @@ Music/Rating                101     object.container
         print "option: " + str(option)
         
         if option == "PNDQ":
-            self.clearprevrendererdata()
             self.play_now_noqueue()
         elif option == "PNAQ":
-            self.clearprevrendererdata()
             self.play_now_queue()
         elif option == "AQN":
             self.add_queue('NEXT')
         elif option == "AQE":
             self.add_queue('END')
         elif option == "PS":
-            self.clearprevrendererdata()
             self.play_sample_noqueue()
         elif option == "PIQ":            
-            self.clearprevrendererdata()
             self.play_in_queue(position)
             
 
@@ -1717,9 +2049,9 @@ Music/Rating                101     object.container
         # call browse asynchronously
         run_async_call(service.getMetadata,
                        success_callback=self.show_napster_result,
-                       error_callback=self.show_napster_result,
+                       error_callback=self.show_browse_error,
                        success_callback_cargo=(service, id, root, count, returned, sequence, search, searchstring, newtype, setkey), 
-                       error_callback_cargo=(service, id, root, count, returned, sequence, search, searchstring, newtype, setkey),
+                       error_callback_cargo=setkey,
                        delay=0, 
                        id=id,
                        index=returned,
@@ -1729,15 +2061,21 @@ Music/Rating                101     object.container
         # call search asynchronously
         run_async_call(service.search,
                        success_callback=self.show_napster_result,
-                       error_callback=self.show_napster_result,
+                       error_callback=self.show_browse_error,
                        success_callback_cargo=(service, id, root, count, returned, sequence, search, searchstring, newtype, setkey), 
-                       error_callback_cargo=(service, id, root, count, returned, sequence, search, searchstring, newtype, setkey),
+                       error_callback_cargo=setkey,
                        delay=0, 
                        id=id,
                        term=searchstring,
                        index=returned,
                        count=count)
            
+    def show_browse_error(self, setkey, error):
+        # error_callback of the async browses (which is passed its cargo
+        # before the exception)
+        self.set_messagebar(str(error))
+        self.fail_gdata_dataset(setkey, str(error))
+
     def show_napster_result(self, browse_result, cargo):
 
         result = browse_result
@@ -1750,6 +2088,7 @@ Music/Rating                101     object.container
         success = result['success']
         if success != '1':
             self.set_messagebar('Error returned from Napster')
+            self.fail_gdata_dataset(setkey, 'Error returned from Napster')
             return
 
         items = result['collections']
@@ -2222,9 +2561,9 @@ Music/Rating                101     object.container
         # call browse asynchronously
         run_async_call(self.control_point.browse,
                        success_callback=self.show_library_result,
-                       error_callback=self.show_library_result,
+                       error_callback=self.show_browse_error,
                        success_callback_cargo=(id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey), 
-                       error_callback_cargo=(id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey),
+                       error_callback_cargo=setkey,
                        delay=0, 
                        object_id=id,
                        browse_flag='BrowseDirectChildren',
@@ -2235,8 +2574,6 @@ Music/Rating                101     object.container
 
     def show_library_result(self, browse_result, cargo):
 
-        # TODO - fix so that error_callback goes to an error routine and not here!
-
         id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey = cargo
 
 #        if id != self.current_browse_id:
@@ -2244,9 +2581,11 @@ Music/Rating                101     object.container
 #            return
         if 'faultcode' in browse_result:
             self.set_messagebar(browse_result['detail'])
+            self.fail_gdata_dataset(setkey, browse_result['detail'])
             return
         elif not 'Result' in browse_result:
             self.set_messagebar('Unknown response from browse request')
+            self.fail_gdata_dataset(setkey, 'Unknown response from browse request')
             return
         
         items = browse_result['Result']
@@ -2825,9 +3164,9 @@ Music/Rating                101     object.container
         # call browse asynchronously
         run_async_call(self.control_point.browse,
                        success_callback=self.show_browse_result,
-                       error_callback=self.show_browse_result,
+                       error_callback=self.show_browse_error,
                        success_callback_cargo=(id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey, device), 
-                       error_callback_cargo=(id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey, device),
+                       error_callback_cargo=setkey,
                        delay=0, 
                        object_id=id,
                        browse_flag='BrowseDirectChildren',
@@ -2841,9 +3180,9 @@ Music/Rating                101     object.container
         # call search asynchronously
         run_async_call(self.control_point.search,
                        success_callback=self.show_browse_result,
-                       error_callback=self.show_browse_result,
+                       error_callback=self.show_browse_error,
                        success_callback_cargo=(id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey, device), 
-                       error_callback_cargo=(id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey, device),
+                       error_callback_cargo=setkey,
                        delay=0, 
                        container_id=1,
                        search_criteria=searchstring,
@@ -2866,9 +3205,11 @@ Music/Rating                101     object.container
 #            return
         if 'faultcode' in browse_result:
             self.set_messagebar(browse_result['detail'])
+            self.fail_gdata_dataset(setkey, browse_result['detail'])
             return
         elif not 'Result' in browse_result:
             self.set_messagebar('Unknown response from browse request')
+            self.fail_gdata_dataset(setkey, 'Unknown response from browse request')
             return
         
         items = browse_result['Result']
@@ -3322,9 +3663,9 @@ Music/Rating                101     object.container
         # call browse asynchronously
         run_async_call(self.control_point.browsetpms,
                        success_callback=self.show_tpms_result,
-                       error_callback=self.show_tpms_result,
+                       error_callback=self.show_browse_error,
                        success_callback_cargo=(name, id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey), 
-                       error_callback_cargo=(name, id, count, returned, sequence, filter, sort, search, searchstring, newtype, setkey),
+                       error_callback_cargo=setkey,
                        delay=0,
                        name=name, 
                        object_id=id,
@@ -3343,9 +3684,11 @@ Music/Rating                101     object.container
 #            return
         if 'faultcode' in browse_result:
             self.set_messagebar(browse_result['detail'])
+            self.fail_gdata_dataset(setkey, browse_result['detail'])
             return
         elif not 'Result' in browse_result:
             self.set_messagebar('Unknown response from browse request')
+            self.fail_gdata_dataset(setkey, 'Unknown response from browse request')
             return
         
         items = browse_result['Result']
@@ -3593,7 +3936,7 @@ Music/Rating                101     object.container
                 action = 'BROWSE'
                 sortcriteria = self.msms_search_browse_sortcriteria['DEFAULT']
         else:
-            parentid = self.gdataparentkey[id]
+            parentid = self.gdatastore.parent_id(id)
             if parentid in self.msms_search_lookup_item.keys():
                 searchitem = self.msms_search_lookup_item[parentid]
             else:
@@ -3683,7 +4026,7 @@ Music/Rating                101     object.container
                 action = 'BROWSE'
                 sortcriteria = self.msms_search_browse_sortcriteria['DEFAULT']
         else:
-            parentid = self.gdataparentkey[id]
+            parentid = self.gdatastore.parent_id(id)
             if parentid in self.msms_search_lookup_item.keys():
                 searchitem = self.msms_search_lookup_item[parentid]
             else:
@@ -3926,7 +4269,9 @@ Music/Rating                101     object.container
          'RelCount': '2147483647'
          'RelTime': '0:01:29'}
         '''
-        pos = self.control_point.get_position_info()
+        if self.position_clock.needs_sync():
+            self.position_clock.sync(self.control_point.get_position_info())
+        pos = self.position_clock.get_position_info()
         reltime = ''
         if 'RelTime' in pos:
             if pos['RelTime'] != 'NOT_IMPLEMENTED':
@@ -4329,6 +4674,7 @@ Music/Rating                101     object.container
 
     def set_play(self, state):
         self.play_state = state
+        self.position_clock.set_state(state)
         if state == 'PLAYING' or state == 'TRANSITIONING':
             state_label = 'Pause'
         elif state == 'PAUSED_PLAYBACK':
@@ -4354,9 +4700,11 @@ Music/Rating                101     object.container
 
     def next(self):
         self.control_point.next()
+        self.position_clock.track_changed()
 
     def previous(self):
         self.control_point.previous()
+        self.position_clock.track_changed()
 
     def volume(self, volume):
         try:
@@ -4666,9 +5014,6 @@ Music/Rating                101     object.container
         # unsubscribe from events from previous renderer
         current_renderer = self.control_point.get_current_renderer()
 
-        self.clearprevrendererdata()
-        self.clearprevrenderermetadata()
-        
         if current_renderer != renderer:
        
             if current_renderer != None:
@@ -4688,7 +5033,7 @@ Music/Rating                101     object.container
                 self.now_playing_percent = ''
                 self.album_art = ''
                 self.clear_position_info()
-                self.last_event_seq = {}
+                self.event_dispatcher.forget()
                 self.current_queue_length = -1
                 self.current_queue_updateid = -1
                 self.messagebar = ''
@@ -4945,79 +5290,32 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
 
 
     def on_device_event_seq(self, sid, seq, changed_vars):
+        # queue the event for the event dispatcher, which drops events that
+        # are late or superseded and calls process_device_event in sequence
+        self.event_dispatcher.put(sid, seq, changed_vars)
 
-#        print changed_vars
+    def process_device_event(self, sid, seq, changed_vars):
 
-        # check it is a cd event - just pass these through without seq/queueing
-        # remember that we subscribe to cd for ZP renderer as well as all servers
-        current_renderer = self.control_point.get_current_renderer()
-        if current_renderer != None and current_renderer.udn in self.known_zone_players:
-            if self.control_point.get_cd_service(current_renderer).event_sid == sid:    
-                self.process_cd_event_renderer(sid, seq, changed_vars)
-                return
-        else:
-            if self.control_point.get_current_server() != None:
-                if self.control_point.get_cd_service().event_sid == sid:    
-                    self.process_cd_event(sid, seq, changed_vars)
-                    return
+#        print changed_vars
 
-        if self.control_point.get_current_server() != None:
-            if self.control_point.get_cd_service().event_sid == sid:    
-                self.process_cd_event(sid, seq, changed_vars)
-                return
-        else:
+        self.event_lock.acquire()
+        try:
+            # check it is a cd event
+            # remember that we subscribe to cd for ZP renderer as well as all servers
             current_renderer = self.control_point.get_current_renderer()
             if current_renderer != None and current_renderer.udn in self.known_zone_players:
                 if self.control_point.get_cd_service(current_renderer).event_sid == sid:    
                     self.process_cd_event_renderer(sid, seq, changed_vars)
                     return
-    
-        # check it is an rc event - just pass these through without seq/queueing
-        # TODO: add separate queue/seq for these?
-        if 'LastChange' in changed_vars and changed_vars['LastChange'] != None:
-            if self.control_point.get_rc_service().event_sid == sid:    
-                self.process_device_event_seq(sid, seq, changed_vars)
-                return
-    
-        seq = int(seq)
-        # don't process events that come late in sequence, unless it's a dummy event (seq=-1)
-        if seq != -1:
-            for k, v in changed_vars.items():
-    #            if k == "LastChange": print str(datetime.datetime.now()) + " @@@@      event=" + str(k) + " seq=" + str(seq) + " sid=" + sid
-                if (sid, k) in self.last_event_seq:
-    #                if k == "LastChange": print str(datetime.datetime.now()) + " @@@@      last seq=" + str(self.last_event_seq[(sid, k)])
-                    if self.last_event_seq[(sid, k)] > seq:
-    #                    if k == "LastChange": print str(datetime.datetime.now()) + " @@@@      rejected (seq=" + str(seq) + " last seq=" + str(self.last_event_seq[(sid, k)])
-                        self.check_event_queue()
-                        return
-    #            if k == "LastChange": print str(datetime.datetime.now()) + " @@@@      set seq=" + str(seq)
-                self.last_event_seq[(sid, k)] = seq
-
-        # queue up events so they are processed in order
-#        if k == "LastChange": print str(datetime.datetime.now()) + " @@@@      queued"
-        self.event_queue.put((sid, seq, changed_vars))
-        self.check_event_queue()
-
-
-    def check_event_queue(self):
-        # process events from queue one at a time
-#        print str(datetime.datetime.now()) + " @@@@@@    ceq called"
-        to_process = True
-        while to_process == True:
-#            print str(datetime.datetime.now()) + " @@@@@@    loop"
-            self.event_lock.acquire()
-#            print str(datetime.datetime.now()) + " @@@@@@    locked"
-            try:
-                (sid, seq, changed_vars) = self.event_queue.get(False)
-#                print str(datetime.datetime.now()) + " @@@@@@    dequeued"
-                self.process_device_event_seq(sid, seq, changed_vars)
-#                print str(datetime.datetime.now()) + " @@@@@@    after process"
-            except Empty:
-                to_process = False
-#                print str(datetime.datetime.now()) + " @@@@@@    empty"
-            finally:
-                self.event_lock.release()
-#                print str(datetime.datetime.now()) + " @@@@@@    finally"
+            if self.control_point.get_current_server() != None:
+                if self.control_point.get_cd_service().event_sid == sid:    
+                    self.process_cd_event(sid, seq, changed_vars)
+                    return
+
+            self.process_device_event_seq(sid, seq, changed_vars)
+            self.update_renderer_state()
+        finally:
+            self.event_lock.release()
 
 
     def process_cd_event(self, sid, seq, changed_vars):
@@ -5040,6 +5338,7 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
                     if self.queue_entry != None:
                         self.browse_queue(self.queue_entry)
                         self.queue_updateid = containerupdate[1]
+                        self.update_renderer_state()
 
 
     def process_device_event_seq(self, sid, seq, changed_vars):
@@ -5062,9 +5361,7 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
             if self.control_point.get_rc_service().event_sid == sid:
 #            if self.control_point.get_current_renderer().get_rc_service().event_sid == sid:
                 # event from RenderingControl
-                ns = "{urn:schemas-upnp-org:metadata-1-0/RCS/}"
-                elt = self.from_string(changed_vars['LastChange'])
-                self.remove_namespace(elt, ns)
+                elt = parse_lastchange(changed_vars['LastChange'], RCS_NS, channels=True)
                 # check if it is initial event message
                 if self.current_renderer_events_rc == {}:
                     # save all tags
@@ -5120,10 +5417,7 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
             elif self.control_point.get_at_service().event_sid == sid or (self.control_point.get_at_service().event_sid == '' and self.control_point.get_current_renderer().udn == sid):
                 # event from AVTransport
 #                print str(datetime.datetime.now()) + " @@@@@@@@  AVT start"
-                # TODO: check if we need to remove the ns, and if it is actually removed anyway
-                ns = "{urn:schemas-upnp-org:metadata-1-0/AVT/}"
-                elt = self.from_string(changed_vars['LastChange'])
-                self.remove_namespace(elt, ns)
+                elt = parse_lastchange(changed_vars['LastChange'], AVT_NS)
                 # check if it is initial event message
                 if self.current_renderer_events_avt == {}:
                     # save all tags
@@ -5146,6 +5440,9 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
                         self.current_renderer_events_avt[key] = value
                     # process changed tags (after saving them as need all related ones to be updated too)
                     for key, value in tag_list.iteritems():
+                        if key == 'CurrentTrackURI' or key == 'CurrentTrack':
+                            # the position is of a different track
+                            self.position_clock.track_changed()
                         # set GUI as appropriate
                         if key == 'CurrentTrackMetaData':
                             self.now_playing, self.now_extras, self.now_playing_dict, self.now_extras_dict, aaURI = self.current_music_item.unwrap_metadata(self.current_renderer_events_avt)
@@ -5308,118 +5605,100 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
             '''
 
 
-    def process_event_tags_rc(self, elt, event_list):
-        # save values
-        InstanceID = elt.find('InstanceID')
-        if InstanceID != None:
-            event_list['InstanceID'] = InstanceID.get('val')    # not checking this at present, assuming zero
-            for child in elt.findall('InstanceID/*'):
-                nodename = child.tag                
-                nodechannel = child.get('channel')
-                if nodechannel != None:
-                    nodename += '_' + nodechannel
-                val = child.get('val')
-                event_list[nodename] = val
-#                print "rc: " + str(nodename) + " = " + str(val)
+    def process_event_tags_rc(self, values, event_list):
+        # save values (InstanceID not checked at present, assuming zero)
+        event_list.update(values)
                 
-    def process_event_tags_avt(self, elt, event_list):
-        # save values
-        
-        print "elt: " + str(elt)
-        
-        InstanceID = elt.find('InstanceID')
-        
-        print "InstanceID: " + str(InstanceID)
+    def process_event_tags_avt(self, values, event_list):
+        # save values (InstanceID not checked at present, assuming zero)
+        current_renderer = self.control_point.get_current_renderer()
+        is_sonos = current_renderer.udn in self.known_zone_players
+        for nodename, val in values.iteritems():
+            event_list[nodename] = val
+            # check for metadata associated with tag
+            if nodename.endswith('MetaData'):
+                if val != '' and val != 'NOT_IMPLEMENTED':
+                    elt = self.metadata_cache.get(val, is_sonos)
+                    if elt != None:
+                        event_list[nodename] = elt
+
+    def parse_event_metadata(self, val, is_sonos):
+        # parse the DIDL-Lite of a MetaData event value into a didl object,
+        # returns None if there is nothing to parse (callers keep the string)
+        # - called through self.metadata_cache so repeated metadata is only parsed once
+#        log.debug('PROCESS EVENT TAGS AVT val: %s' % val)
+        # get the item element from within the DIDL-lite element
         
-        if InstanceID != None:
-            event_list['InstanceID'] = InstanceID.get('val')    # not checking this at present, assuming zero
-            
-            print "val: " + event_list['InstanceID']
-            
-            for child in elt.findall('InstanceID/*'):
-                nodename = child.tag
-                val = child.get('val')
-                event_list[nodename] = val
-#                print "avt: " + str(nodename) + " = " + str(val)
-                # check for metadata associated with tag
-                if nodename.endswith('MetaData'):
-                    if val != '' and val != 'NOT_IMPLEMENTED':
-    #                    log.debug('PROCESS EVENT TAGS AVT val: %s' % val)
-                        # get the item element from within the DIDL-lite element
-                        
-                        # Sonos has an issue with returning more than 1024 characters in the val attrib of
-                        # r:EnqueuedTransportURIMetaData and AVTransportURIMetaData in a NOTIFY
-                        # (strangely there is no problem with CurrentTrackMetaData)
-                        # NOTE - when Sonos sets those itself it doesn't set some elements so they don't exceed 1024
-                        # - if those elements are not complete, ignore them (TODO: work out whether that affects 
-                        # any further processing we do that needs them)
-                        # TODO: work out how to stop these attribs exceeding 1024 chars
-
-                        if val.endswith('</DIDL-Lite>'):
-
-                            # sometimes an empty DIDL-Lite is returned
-                            eitem = ElementItem().from_string(val)
-                            if eitem:
-
-                                item = eitem[0]
-                                # get the class of the item
-                                upnp_class = find(item, 'upnp', 'class').text
-
-                                # check if current renderer is a zone player
-                                current_renderer = self.control_point.get_current_renderer()
-
-                                is_sonos = False
-                                if current_renderer.udn in self.known_zone_players:
-                                    is_sonos = True
-                                    # as it's a Sonos, parse the attributes into a Sonos object to capture the extended elements
-                                    if upnp_class == 'object.item.audioItem.audioBroadcast':
-                                        elt = SonosAudioBroadcast()
-                                    elif upnp_class == 'object.item.audioItem.musicTrack':
-                                        elt = SonosMusicTrack()
-                                    elif upnp_class == 'object.item.audioItem.musicTrack.recentShow':
-                                        elt = SonosMusicTrackShow()
-                                    elif upnp_class == 'object.item':
-                                        elt = SonosItem()
-                                        '''                                    
-                                        <r:EnqueuedTransportURI val="x-rincon-playlist:RINCON_000E5830D2F001400#A:ALBUMARTIST/Jeff%20Buckley/"/>
-                                        <r:EnqueuedTransportURIMetaData val="<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">
-                                            <item id="A:ALBUMARTIST/Jeff%20Buckley/" parentID="A:ALBUMARTIST/Jeff%20Buckley" restricted="true">
-                                                <dc:title>All</dc:title>
-                                                <upnp:class>object.container.playlistContainer.sameArtist</upnp:class>
-                                                <desc id="cdudn" nameSpace="urn:schemas-rinconnetworks-com:metadata-1-0/">RINCON_AssociatedZPUDN</desc>
-                                            </item>
-                                        </DIDL-Lite>                                    
-                                        '''
+        # Sonos has an issue with returning more than 1024 characters in the val attrib of
+        # r:EnqueuedTransportURIMetaData and AVTransportURIMetaData in a NOTIFY
+        # (strangely there is no problem with CurrentTrackMetaData)
+        # NOTE - when Sonos sets those itself it doesn't set some elements so they don't exceed 1024
+        # - if those elements are not complete, ignore them (TODO: work out whether that affects 
+        # any further processing we do that needs them)
+        # TODO: work out how to stop these attribs exceeding 1024 chars
+
+        if val.endswith('</DIDL-Lite>'):
+
+            # sometimes an empty DIDL-Lite is returned
+            eitem = ElementItem().from_string(val)
+            if eitem:
+
+                item = eitem[0]
+                # get the class of the item
+                upnp_class = find(item, 'upnp', 'class').text
+
+                if is_sonos:
+                    # as it's a Sonos, parse the attributes into a Sonos object to capture the extended elements
+                    if upnp_class == 'object.item.audioItem.audioBroadcast':
+                        elt = SonosAudioBroadcast()
+                    elif upnp_class == 'object.item.audioItem.musicTrack':
+                        elt = SonosMusicTrack()
+                    elif upnp_class == 'object.item.audioItem.musicTrack.recentShow':
+                        elt = SonosMusicTrackShow()
+                    elif upnp_class == 'object.item':
+                        elt = SonosItem()
+                        '''                                    
+                        <r:EnqueuedTransportURI val="x-rincon-playlist:RINCON_000E5830D2F001400#A:ALBUMARTIST/Jeff%20Buckley/"/>
+                        <r:EnqueuedTransportURIMetaData val="<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">
+                            <item id="A:ALBUMARTIST/Jeff%20Buckley/" parentID="A:ALBUMARTIST/Jeff%20Buckley" restricted="true">
+                                <dc:title>All</dc:title>
+                                <upnp:class>object.container.playlistContainer.sameArtist</upnp:class>
+                                <desc id="cdudn" nameSpace="urn:schemas-rinconnetworks-com:metadata-1-0/">RINCON_AssociatedZPUDN</desc>
+                            </item>
+                        </DIDL-Lite>                                    
+                        '''
     # XML created by selecting all from artist
     # THIS NEEDS TESTING...                                    
-                                    elif upnp_class.startswith('object.container.playlistContainer'):
-                                        elt = PlaylistContainer()
-                                    else:
-                                        # oops, don't know what we're dealing with - pass to non-sonos processing
-                                        # TODO: decide which other classes we need to Sonos-ise
-                                        is_sonos = False
-                                    if is_sonos:
-                                        elt.from_element(item)
-
-                                if not is_sonos:
-                                    # not a Sonos or we don't recognise the class, get the outer class name
-                                    # TODO: do we want to move this to didl-lite (so it recognises the classes from there)?
-                                    names = upnp_class.split('.')
-                                    class_name = names[-1]
-                                    class_name = "%s%s" % (class_name[0].upper(), class_name[1:])
-                                    try:
-                                        upnp_class = eval(class_name)
-                                        elt = upnp_class()
-                                        elt.from_element(item)
-    #                                    print "@@ elt: " + str(elt)
-                                    except Exception, e:
-                                        raise UnknownClassError('Unknown upnp class: ' + upnp_class) 
-
-                                event_list[nodename] = elt
-
+                    elif upnp_class.startswith('object.container.playlistContainer'):
+                        elt = PlaylistContainer()
+                    else:
+                        # oops, don't know what we're dealing with - pass to non-sonos processing
+                        # TODO: decide which other classes we need to Sonos-ise
+                        is_sonos = False
+                    if is_sonos:
+                        elt.from_element(item)
+
+                if not is_sonos:
+                    # not a Sonos or we don't recognise the class, get the outer class name
+                    # TODO: do we want to move this to didl-lite (so it recognises the classes from there)?
+                    names = upnp_class.split('.')
+                    class_name = names[-1]
+                    class_name = "%s%s" % (class_name[0].upper(), class_name[1:])
+                    try:
+                        upnp_class = eval(class_name)
+                        elt = upnp_class()
+                        elt.from_element(item)
+#                        print "@@ elt: " + str(elt)
+                    except Exception, e:
+                        raise UnknownClassError('Unknown upnp class: ' + upnp_class) 
+
+                return elt
+
+        return None
 
     def get_position_info(self):
         self.current_position = self.control_point.get_position_info()
+        self.position_clock.sync(self.current_position)
         self.current_track = self.current_position['Track']
         self.current_track_duration = self.current_position['TrackDuration']
         self.current_track_URI = self.current_position['TrackURI']
@@ -5428,6 +5707,7 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
 
     def clear_position_info(self):
         self.current_position = {}
+        self.position_clock.reset()
         self.current_track = '-1'
         self.current_track_duration = ''
         self.current_track_URI = ''
@@ -5452,7 +5732,7 @@ DEBUG	sonos                         :2059:on_device_event() device_event c_v: {'
         log.debug('Event subscribe done cargo=%s sid=%s timeout=%s', cargo, subscription_id, timeout)
 
     def _event_renewal_callback(self, cargo, subscription_id, timeout):
-# TODO: add error processing for if renewal fails - basically resubscribe. NEW - check if this is catered for in 0.10.0
+# failed renewals are resubscribed by the subscription manager, the new sid arrives on _event_subscribe_callback
         log.debug('Event renew done cargo=%s sid=%s timeout=%s', cargo, subscription_id, timeout)
 
     def _event_unsubscribe_callback(self, cargo, subscription_id):
@@ -0,0 +1,567 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# UPnP ContentDirectory SearchCriteria parsing for the proxy.
+#
+# Criteria are parsed to a normalized AST. The AST is split into a shape
+# (the AST with the property values taken out) and the values, and each
+# shape is compiled once to a SearchPlan, which the proxy dispatches on and
+# which holds parameterized SQL for searches that can be run against the
+# tracks table. Later requests of the same shape only bind their values.
+#
+# When movetags has built the TrackSearch full text index, startsWith on the
+# indexed properties of a track search is answered from it rather than with
+# a LIKE scan of tracks. The index matches words (the first word of the
+# value must start the field, each other word must start a word of it) so
+# its candidates are then checked with the LIKE, which keeps the UPnP
+# semantics. contains is always a LIKE scan: its value can start in the
+# middle of a word, which the index can't find (dc:title contains "ove"
+# finds "Love"). The index is only used for track class searches on the
+# proxy's own library; container class searches, and the searches
+# pycpoint.search_media_server sends to a server, aren't changed.
+#
+#   searchCrit ::= searchExp | '*'
+#   searchExp  ::= relExp | searchExp logOp searchExp | '(' searchExp ')'
+#   relExp     ::= property binOp quotedVal | property 'exists' boolVal
+#   binOp      ::= '=' | '!=' | '<' | '<=' | '>' | '>=' | 'contains' |
+#                  'doesNotContain' | 'derivedfrom' | 'startsWith'
+#   logOp      ::= 'and' | 'or'      ('and' binds tighter)
+
+import re
+import array
+import sqlite3
+import threading
+
+class SearchCriteriaError(ValueError):
+    pass
+
+_token_re = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(!=|<=|>=|=|<|>)|([^\s()"=<>!]+))')
+_unescape_re = re.compile(r'\\(.)')
+
+RELOPS = ('=', '!=', '<', '<=', '>', '>=')
+STRINGOPS = ('contains', 'doesnotcontain', 'derivedfrom', 'startswith')
+
+# AST nodes are tuples:
+#   ('all',)
+#   ('and', (node, ...)) / ('or', (node, ...))
+#   ('rel', property, op, value)
+#   ('exists', property, bool)
+# In a shape the values of rel nodes other than upnp:class are None, the
+# class of a search decides which query is run so it stays in the shape.
+
+def tokenize(criteria):
+    tokens = []
+    pos = 0
+    end = len(criteria.rstrip())
+    while pos < end:
+        m = _token_re.match(criteria, pos)
+        if not m:
+            raise SearchCriteriaError('Bad search criteria at %d: %s' % (pos, criteria))
+        lparen, rparen, quoted, op, word = m.groups()
+        if lparen:
+            tokens.append(('(', None))
+        elif rparen:
+            tokens.append((')', None))
+        elif quoted is not None:
+            tokens.append(('value', _unescape_re.sub(r'\1', quoted)))
+        elif op:
+            tokens.append(('op', op))
+        else:
+            tokens.append(('word', word))
+        pos = m.end()
+    return tokens
+
+class _Parser(object):
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.tokens = tokenize(criteria)
+        self.pos = 0
+
+    def error(self, msg):
+        raise SearchCriteriaError('%s in search criteria: %s' % (msg, self.criteria))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] == None:
+            self.error('Unexpected end')
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if self.tokens == [('word', '*')]:
+            return ('all',)
+        if not self.tokens:
+            self.error('Empty')
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error('Unexpected %s' % str(self.peek()[1]))
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.is_word('or'):
+            self.pos += 1
+            nodes.append(self.parse_and())
+        return make_node('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_primary()]
+        while self.is_word('and'):
+            self.pos += 1
+            nodes.append(self.parse_primary())
+        return make_node('and', nodes)
+
+    def is_word(self, word):
+        kind, value = self.peek()
+        return kind == 'word' and value.lower() == word
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == '(':
+            node = self.parse_or()
+            if self.next()[0] != ')':
+                self.error('Missing )')
+            return node
+        if kind != 'word':
+            self.error('Expected property, got %s' % value)
+        prop = value
+        kind, op = self.next()
+        if kind == 'word' and op.lower() == 'exists':
+            kind, value = self.next()
+            if kind != 'word' or value.lower() not in ('true', 'false'):
+                self.error('Expected true or false')
+            return ('exists', prop, value.lower() == 'true')
+        if kind == 'word' and op.lower() in STRINGOPS:
+            op = op.lower()
+        elif kind != 'op':
+            self.error('Unknown operator %s' % op)
+        kind, value = self.next()
+        if kind != 'value':
+            self.error('Expected quoted value')
+        return ('rel', prop, op, value)
+
+def make_node(logop, nodes):
+    if len(nodes) == 1:
+        return nodes[0]
+    # flatten nested and/and, or/or
+    children = []
+    for node in nodes:
+        if node[0] == logop:
+            children.extend(node[1])
+        else:
+            children.append(node)
+    return (logop, tuple(children))
+
+def parse(criteria):
+    '''
+    Parses SearchCriteria to a normalized AST - operands of and/or are
+    flattened and sorted, so criteria that differ only in order give the
+    same AST.
+    '''
+    return normalize(_Parser(criteria).parse())
+
+def normalize(node):
+    if node[0] in ('and', 'or'):
+        children = [normalize(child) for child in node[1]]
+        children.sort(key=lambda n: (repr(split_values(n)[0]), repr(n)))
+        return (node[0], tuple(children))
+    return node
+
+def split_values(node):
+    '''
+    Returns (shape, values) for an AST, values in the order their
+    placeholders appear in the shape.
+    '''
+    values = []
+    def strip(node):
+        if node[0] in ('and', 'or'):
+            return (node[0], tuple([strip(child) for child in node[1]]))
+        if node[0] == 'rel' and node[1] != 'upnp:class':
+            values.append(node[3])
+            return ('rel', node[1], node[2], None)
+        return node
+    return strip(node), values
+
+# columns of the tracks table for the properties controllers search on
+track_columns = {
+    'dc:title': 'title',
+    'dc:creator': 'artist',
+    'upnp:artist': 'artist',
+    'microsoft:artistPerformer': 'artist',
+    'microsoft:artistAlbumArtist': 'albumartist',
+    'upnp:album': 'album',
+    'upnp:genre': 'genre',
+    'upnp:author': 'composer',
+    'microsoft:authorComposer': 'composer',
+    'upnp:originalTrackNumber': 'tracknumber',
+    'dc:date': 'year',
+    'dc:description': 'comment',
+}
+
+# columns of the TrackSearch full text index for the properties that can
+# be searched through it (its docid is the rowid of the track)
+search_columns = {
+    'dc:title': 'title',
+    'dc:creator': 'artist',
+    'upnp:artist': 'artist',
+    'microsoft:artistPerformer': 'artist',
+    'microsoft:artistAlbumArtist': 'albumartist',
+    'upnp:album': 'album',
+    'upnp:genre': 'genre',
+    'upnp:author': 'composer',
+    'microsoft:authorComposer': 'composer',
+    'dc:description': 'comment',
+}
+
+TRACK_CLASS = 'object.item.audioItem.musicTrack'
+
+# operators the TrackSearch index can find every match of
+SEARCH_INDEX_OPS = ('startswith', )
+
+word_split = re.compile(r'[\W_]+', re.UNICODE)
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_words(value):
+    return [w.lower() for w in word_split.split(value) if w]
+
+def match_query(column, value, startswith=False):
+    '''
+    Returns the TrackSearch match expression for the words of value in
+    column, e.g. 'title:^love* title:me*' for startsWith "Love Me".
+    '''
+    words = ['%s:%s*' % (column, w) for w in search_words(value)]
+    if startswith and words:
+        words[0] = '%s:^%s' % (column, words[0][len(column) + 1:])
+    return ' '.join(words)
+
+def search_rank(matchinfo):
+    '''
+    SQL function ranking a TrackSearch match from its matchinfo (default
+    'pcx' format): for each word and column, the hits in the track over the
+    hits in all tracks, so rare words and repeated words count most.
+    '''
+    info = array.array('I', str(matchinfo))
+    phrases, columns = info[0], info[1]
+    score = 0.0
+    for i in range(2, 2 + phrases * columns * 3, 3):
+        if info[i]:
+            score += float(info[i]) / info[i + 1]
+    return score
+
+def has_search_index(db):
+    '''
+    True if the library database at connection db has the TrackSearch
+    full text index.
+    '''
+    try:
+        n, = db.execute("select count(*) from sqlite_master where type='table' and name='TrackSearch'").fetchone()
+    except sqlite3.Error, e:
+        print "Error checking search index:", e.args[0]
+        return False
+    return n != 0
+
+class SearchPlan(object):
+    '''
+    Compiled form of a criteria shape.
+
+    upnp_class   - class searched for, class_op its operator ('=' or
+                   'derivedfrom'), None if the shape has no single class
+    refid_exists - value of '@refID exists' or None
+    fields       - names of the other properties compared with '=' in a
+                   plain and of conditions, in shape order
+    where        - parameterized SQL condition over the tracks table, None
+                   if the shape cannot be run against it
+    index_where  - where with contains/startsWith answered from the
+                   TrackSearch index, None if the shape makes no use of it
+    index_match  - binders of the index terms that every result must match
+                   (from the top level and of the shape); they are combined
+                   into a single match whose matchinfo ranks the results,
+                   and are not repeated in index_where
+    '''
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.uses = 0
+        self.upnp_class = None
+        self.class_op = None
+        self.refid_exists = None
+        self.fields = ()
+        self.simple = True
+        if shape[0] == 'and':
+            terms = shape[1]
+        elif shape[0] == 'all':
+            terms = ()
+        else:
+            terms = (shape, )
+        fields = []
+        for term in terms:
+            if term[0] == 'rel' and term[1] == 'upnp:class' and self.upnp_class == None:
+                self.class_op, self.upnp_class = term[2], term[3]
+            elif term[0] == 'exists' and term[1] == '@refID' and self.refid_exists == None:
+                self.refid_exists = term[2]
+            elif term[0] == 'rel' and term[2] == '=':
+                fields.append(term[1])
+            else:
+                self.simple = False
+        self.fields = tuple(fields)
+        try:
+            self.where, self.binders = self._compile(shape, [0])
+        except KeyError:
+            self.where, self.binders = None, []
+        self.index_where, self.index_binders, self.index_match = None, [], []
+        self.index_values = []
+        if self.is_track_search():
+            match = []
+            where, binders = self._compile(shape, [0], True, match)
+            if self.index_values:
+                self.index_where, self.index_binders, self.index_match = where, binders, match
+
+    def is_search(self, upnp_class, class_op='='):
+        '''
+        True for a class search with no refIDs, e.g. upnp:class =
+        "object.container.album.musicAlbum" and @refID exists false.
+        '''
+        return self.upnp_class == upnp_class and self.class_op == class_op and self.refid_exists == False
+
+    def is_track_search(self):
+        return self.where != None and self.where != '0'
+
+    def has_fields(self, *names):
+        return self.simple and sorted(self.fields) == sorted(names)
+
+    def field_key(self):
+        '''
+        Returns the sorted field names, None if the shape is not a plain
+        and of conditions.
+        '''
+        if not self.simple:
+            return None
+        return tuple(sorted(self.fields))
+
+    def bind(self, values):
+        '''
+        Returns the SQL parameters for the values of a criteria.
+        '''
+        return tuple([binder(values[i]) for i, binder in self.binders])
+
+    def bind_index(self, values):
+        '''
+        Returns (match, parameters of index_where) for the values of a
+        criteria, match is None if the plan has no top level index terms.
+        '''
+        match = None
+        if self.index_match:
+            match = ' '.join([binder(values[i]) for i, binder in self.index_match])
+        return match, tuple([binder(values[i]) for i, binder in self.index_binders])
+
+    def _compile(self, node, counter, use_index=False, match=None):
+        # returns (sql, binders) with an (index of the value, binder) for
+        # each ? in sql, raises KeyError for anything the tracks table
+        # cannot answer. counter holds the index of the next value.
+        # With use_index the index answers what it can; match is None or
+        # the list that index terms every result must match are added to,
+        # other index terms become subqueries.
+        kind = node[0]
+        if kind == 'all':
+            return '1', []
+        if kind in ('and', 'or'):
+            # fold the conditions that are constant for tracks
+            absorb, identity = kind == 'and' and ('0', '1') or ('1', '0')
+            parts = []
+            binders = []
+            if kind == 'or':
+                match = None
+            for child in node[1]:
+                sql, child_binders = self._compile(child, counter, use_index, match)
+                if sql != identity:
+                    parts.append(sql)
+                    binders.extend(child_binders)
+            if absorb in parts:
+                return absorb, []
+            if not parts:
+                return identity, []
+            if len(parts) == 1:
+                return parts[0], binders
+            return '(%s)' % (' %s ' % kind).join(parts), binders
+        if kind == 'exists':
+            prop, exists = node[1], node[2]
+            if prop == '@refID':
+                # tracks are never references
+                return exists and '0' or '1', []
+            column = track_columns[prop]
+            if exists:
+                return "(%s is not null and %s != '')" % (column, column), []
+            return "(%s is null or %s = '')" % (column, column), []
+        prop, op, value = node[1], node[2], node[3]
+        if prop == 'upnp:class':
+            if op == 'derivedfrom':
+                is_class = TRACK_CLASS == value or TRACK_CLASS.startswith(value + '.')
+            elif op == '=':
+                is_class = TRACK_CLASS == value
+            elif op == '!=':
+                is_class = TRACK_CLASS != value
+            else:
+                raise KeyError(op)
+            return is_class and '1' or '0', []
+        index = counter[0]
+        counter[0] += 1
+        if use_index and op in SEARCH_INDEX_OPS and prop in search_columns:
+            # the index finds the candidates, the LIKE below checks them
+            self.index_values.append(index)
+            search_column = search_columns[prop]
+            binder = lambda v: match_query(search_column, v, op == 'startswith')
+            like, like_binders = self._compile(node, [index])
+            if match != None:
+                match.append((index, binder))
+                return like, like_binders
+            return "(tracks.rowid in (select docid from TrackSearch where TrackSearch match ?) and %s)" % like, [(index, binder)] + like_binders
+        column = track_columns[prop]
+        if op in RELOPS:
+            return '%s %s ?' % (column, op), [(index, lambda v: v)]
+        if op == 'contains':
+            return "%s like ? escape '\\'" % column, [(index, lambda v: '%%%s%%' % like_escape(v))]
+        if op == 'doesnotcontain':
+            return "%s not like ? escape '\\'" % column, [(index, lambda v: '%%%s%%' % like_escape(v))]
+        if op == 'startswith':
+            return "%s like ? escape '\\'" % column, [(index, lambda v: '%s%%' % like_escape(v))]
+        raise KeyError(op)
+
+class Search(object):
+    '''
+    A parsed criteria: its plan and the values to bind to it.
+    '''
+
+    def __init__(self, plan, values):
+        self.plan = plan
+        self.values = values
+        self.fields = dict(zip(plan.fields, values[:len(plan.fields)])) if plan.simple else {}
+
+    def params(self):
+        return self.plan.bind(self.values)
+
+    def can_use_index(self):
+        '''
+        True if the plan uses the TrackSearch index and every value it
+        searches the index for has a word in it.
+        '''
+        if self.plan.index_where == None:
+            return False
+        for i in self.plan.index_values:
+            if not search_words(self.values[i]):
+                return False
+        return True
+
+    def index_params(self):
+        return self.plan.bind_index(self.values)
+
+class PlanCache(object):
+    '''
+    Cache of SearchPlans keyed by criteria shape. Controllers page through
+    results with the same criteria, so the last parsed criteria are kept as
+    well and a repeated request is a dictionary lookup. get_plans() lists
+    the cached shapes with their use counts.
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans = {}
+        self._searches = {}
+        self._lock = threading.Lock()
+
+    def get(self, criteria):
+        '''
+        Parses criteria and returns its Search. Raises SearchCriteriaError
+        for criteria that cannot be parsed.
+        '''
+        self._lock.acquire()
+        try:
+            search = self._searches.get(criteria)
+            if search != None:
+                self.hits += 1
+                search.plan.uses += 1
+                return search
+        finally:
+            self._lock.release()
+        shape, values = split_values(parse(criteria))
+        self._lock.acquire()
+        try:
+            plan = self._plans.get(shape)
+            if plan == None:
+                self.misses += 1
+                if len(self._plans) >= self.maxsize:
+                    self._plans.clear()
+                    self._searches.clear()
+                plan = SearchPlan(shape)
+                self._plans[shape] = plan
+            else:
+                self.hits += 1
+            plan.uses += 1
+            search = Search(plan, values)
+            if len(self._searches) >= self.maxsize:
+                self._searches.clear()
+            self._searches[criteria] = search
+        finally:
+            self._lock.release()
+        return search
+
+    def get_plans(self):
+        '''
+        Returns (shape, uses, tracks SQL) for each cached plan, most used
+        first.
+        '''
+        self._lock.acquire()
+        try:
+            plans = self._plans.values()
+        finally:
+            self._lock.release()
+        return [(format_shape(plan.shape), plan.uses, plan.where) for plan in sorted(plans, key=lambda p: -p.uses)]
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._plans.clear()
+            self._searches.clear()
+        finally:
+            self._lock.release()
+
+def format_shape(node):
+    '''
+    Returns a shape as criteria text, with ? for the values.
+    '''
+    kind = node[0]
+    if kind == 'all':
+        return '*'
+    if kind in ('and', 'or'):
+        return '(%s)' % (' %s ' % kind).join([format_shape(child) for child in node[1]])
+    if kind == 'exists':
+        return '%s exists %s' % (node[1], node[2] and 'true' or 'false')
+    if node[3] == None:
+        return '%s %s ?' % (node[1], node[2])
+    return '%s %s "%s"' % (node[1], node[2], node[3])
@@ -0,0 +1,116 @@
+#
+# Micro-benchmark for SearchCriteria dispatch (searchcriteria.py) against the
+# previous startswith/split('=') matching in DummyContentDirectory.soap_Search,
+# using criteria sent by Sonos and WMP controllers. Also checks that searches
+# answered from the TrackSearch index match what LIKE would.
+#
+# usage: python searchcriteriatest.py [iterations]
+#
+
+import sys
+import timeit
+import sqlite3
+
+from searchcriteria import PlanCache, parse, split_values
+
+CRITERIA = [
+    'upnp:class = "object.container.person.musicArtist" and @refID exists false',
+    'upnp:class = "object.container.person.musicArtist" and @refID exists false and upnp:genre = "Alt. Rock"',
+    'upnp:class = "object.container.album.musicAlbum" and @refID exists false and microsoft:artistAlbumArtist = "1 Giant Leap"',
+    'upnp:class derivedfrom "object.item.audioItem" and @refID exists false and microsoft:artistAlbumArtist = "1 Giant Leap" and upnp:album = "1 Giant Leap"',
+    'upnp:class derivedfrom "object.item.audioItem" and @refID exists false and upnp:genre = "Alt. Rock" and microsoft:artistAlbumArtist = "Elvis Costello" and upnp:album = "Spike"',
+]
+
+def old_dispatch(searchCriteria):
+    # the checks soap_Search made for a tracks for genre/artist/album search
+    if searchCriteria.startswith('upnp:class = "object.container.person.musicArtist" and @refID exists false'):
+        if searchCriteria == 'upnp:class = "object.container.person.musicArtist" and @refID exists false':
+            return ()
+        criteria = searchCriteria.split('=')
+        if criteria[1].endswith('upnp:genre '):
+            return (criteria[2][1:][1:-1], )
+    elif searchCriteria.startswith('upnp:class = "object.container.album.musicAlbum" and @refID exists false'):
+        criteria = searchCriteria.split('=')
+        if criteria[1].endswith('microsoft:artistAlbumArtist '):
+            return (criteria[2][1:][1:-1], )
+    elif searchCriteria.startswith('upnp:class derivedfrom "object.item.audioItem" and @refID exists false'):
+        criteria = searchCriteria.split('=')
+        if len(criteria) == 3 and criteria[0].endswith('microsoft:artistAlbumArtist '):
+            return (criteria[1][1:-16][1:-1], criteria[2][1:][1:-1])
+        if len(criteria) == 4:
+            return (criteria[1][1:-33][1:-1], criteria[2][1:-16][1:-1], criteria[3][1:][1:-1])
+
+def index_search(db, search):
+    # runs a search as the proxy does when the TrackSearch index can be used
+    assert search.can_use_index()
+    match, params = search.index_params()
+    where = search.plan.index_where
+    if match != None:
+        statement = "select title from tracks, (select docid from TrackSearch where TrackSearch match ?) as m where tracks.rowid = m.docid and %s order by title" % where
+        params = (match, ) + params
+    else:
+        statement = "select title from tracks where %s order by title" % where
+    return [row[0] for row in db.execute(statement, params)]
+
+def check_index_semantics(cache):
+    # the index must not change what contains and startsWith match
+    db = sqlite3.connect(':memory:')
+    db.execute('create table tracks (title text, artist text, album text, genre text, albumartist text, composer text, comment text, tracknumber integer, year integer, duplicate integer)')
+    db.execute('create virtual table TrackSearch using fts4(title, artist, albumartist, album, composer, genre, comment, tokenize=unicode61 "remove_diacritics=1")')
+    for title in ['Love Me Do', 'Lovely', 'Glove', 'Love You Me', 'Stop! In the Name of Love']:
+        rowid = db.execute("insert into tracks values (?, 'A', 'B', 'Pop', 'A', '', '', 1, 2000, 0)", (title, )).lastrowid
+        db.execute("insert into TrackSearch (docid, title, artist, albumartist, album, composer, genre, comment) values (?, ?, 'A', 'A', 'B', '', 'Pop', '')", (rowid, title))
+    track = 'upnp:class derivedfrom "object.item.audioItem" and @refID exists false and '
+    # contains is a substring match, so it can't use the index
+    search = cache.get(track + 'dc:title contains "ove"')
+    assert not search.can_use_index()
+    rows = [row[0] for row in db.execute('select title from tracks where %s order by title' % search.plan.where, search.params())]
+    assert rows == ['Glove', 'Love Me Do', 'Love You Me', 'Lovely', 'Stop! In the Name of Love'], rows
+    # startsWith: index candidates checked against the LIKE
+    assert index_search(db, cache.get(track + 'dc:title startsWith "Love"')) == ['Love Me Do', 'Love You Me', 'Lovely']
+    assert index_search(db, cache.get(track + 'dc:title startsWith "Love Me"')) == ['Love Me Do']
+    assert index_search(db, cache.get(track + '(dc:title startsWith "Love Me" or dc:title startsWith "Glo")')) == ['Glove', 'Love Me Do']
+    # container class searches don't use the index
+    search = cache.get('upnp:class = "object.container.album.musicAlbum" and @refID exists false and upnp:album startsWith "Love"')
+    assert search.plan.index_where == None
+
+def new_dispatch(cache, searchCriteria):
+    search = cache.get(searchCriteria)
+    return search.plan, search.fields
+
+def main(argv):
+    n = 2000
+    if len(argv) > 1:
+        n = int(argv[1])
+
+    # check the parser gets the values the old matching got
+    cache = PlanCache()
+    for criteria in CRITERIA:
+        old = old_dispatch(criteria)
+        shape, values = split_values(parse(criteria))
+        assert sorted(old) == sorted(values), (old, values)
+
+    # generic track search run from its compiled plan
+    db = sqlite3.connect(':memory:')
+    db.execute('create table tracks (title text, artist text, album text, genre text, albumartist text, composer text, tracknumber integer, year integer, duplicate integer)')
+    db.execute("insert into tracks values ('Love 100%', 'A', 'B', 'Pop', 'A', '', 1, 2000, 0)")
+    db.execute("insert into tracks values ('Lovely', 'C', 'D', 'Rock', 'C', '', 1, 2001, 0)")
+    search = cache.get('upnp:class derivedfrom "object.item" and (dc:title contains "100%" or upnp:genre = "Rock")')
+    rows = db.execute('select title from tracks where %s order by title' % search.plan.where, search.params()).fetchall()
+    assert rows == [(u'Love 100%', ), (u'Lovely', )], rows
+    check_index_semantics(cache)
+
+    criteria = CRITERIA[-1]
+    t_old = min(timeit.repeat(lambda: old_dispatch(criteria), number=n, repeat=3)) / n
+    t_cold = min(timeit.repeat(lambda: new_dispatch(PlanCache(), criteria), number=n, repeat=3)) / n
+    t_new = min(timeit.repeat(lambda: new_dispatch(cache, criteria), number=n, repeat=3)) / n
+    print 'old startswith/split dispatch: %7.1fus' % (t_old * 1e6)
+    print 'parse and compile plan:        %7.1fus' % (t_cold * 1e6)
+    print 'plan cache (repeated request): %7.1fus' % (t_new * 1e6)
+    print
+    print 'hits %d, misses %d' % (cache.hits, cache.misses)
+    for shape, uses, where in cache.get_plans():
+        print '%6d  %s\n        -> %s' % (uses, shape, where)
+
+if __name__ == '__main__':
+    main(sys.argv)
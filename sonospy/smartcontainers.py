@@ -0,0 +1,125 @@
+#
+# pycpoint
+#
+# Copyright (c) 2009 Mark Henkelis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Mark Henkelis <mark.henkelis@tesco.net>
+
+# Smart containers - lists of the tracks most recently played, most played,
+# most recently added and most recently added but never played.
+#
+# Rather than sorting the tracks each time one is browsed, the top tracks
+# of each are kept in SmartContainerTracks in the library database. movetags
+# rebuilds them after a scan, and the playcount updates (from playcounts and
+# playtags) add the tracks played to them, so the proxy only has to read
+# them in order.
+
+import sqlite3
+
+DEFAULT_SIZE = 100
+
+# id, title, tracks column the container is ordered on (highest first) and
+# the condition for a track to be in it (duplicates never are)
+SMART_CONTAINERS = [('RecentlyPlayed', 'Recently Played', 'lastplayed', "duplicate = 0 and ifnull(nullif(lastplayed, ''), 0) > 0"),
+                    ('MostPlayed', 'Most Played', 'playcount', "duplicate = 0 and ifnull(nullif(playcount, ''), 0) > 0"),
+                    ('RecentlyAdded', 'Recently Added', 'inserted', "duplicate = 0"),
+                    ('NeverPlayed', 'Never Played', 'inserted', "duplicate = 0 and ifnull(nullif(playcount, ''), 0) = 0")]
+
+SMART_CONTAINER_IDS = [container[0] for container in SMART_CONTAINERS]
+
+# the containers plays change
+PLAYED_CONTAINER_IDS = ['RecentlyPlayed', 'MostPlayed', 'NeverPlayed']
+
+def create_smart_containers(c):
+    '''
+    Creates the smart container tables if they don't exist.
+    '''
+    c.execute('SELECT count(*) FROM sqlite_master WHERE type="table" AND name="SmartContainers"')
+    n, = c.fetchone()
+    if n == 0:
+        c.execute('''create table SmartContainers (id text primary key, size integer)''')
+        c.execute('''create table SmartContainerTracks (container text, track_id text, value real)''')
+        c.execute('''create unique index inxSmartContainerTracks on SmartContainerTracks (container, track_id)''')
+        c.execute('''create index inxSmartContainerTrackValues on SmartContainerTracks (container, value)''')
+
+def rebuild_smart_containers(c, size=DEFAULT_SIZE):
+    '''
+    Refills the smart containers, with up to size tracks each, from the
+    tracks table.
+    '''
+    for id, title, column, condition in SMART_CONTAINERS:
+        c.execute("insert or replace into SmartContainers values (?, ?)", (id, size))
+        c.execute("delete from SmartContainerTracks where container=?", (id, ))
+        # compared as numbers, as some databases hold them as text
+        value = "cast(ifnull(nullif(%s, ''), 0) as real)" % column
+        c.execute("""insert into SmartContainerTracks select ?, id, %s from tracks
+                     where %s order by %s desc limit ?""" % (value, condition, value), (id, size))
+
+def trim_smart_container(c, id, size):
+    c.execute("""delete from SmartContainerTracks where container=? and rowid not in
+                 (select rowid from SmartContainerTracks where container=? order by value desc limit ?)""", (id, id, size))
+
+def update_smart_containers(c, track_ids):
+    '''
+    Updates the smart containers for plays of the tracks with track_ids
+    (once their playcount and lastplayed have been updated).
+    '''
+    c.execute("select id, size from SmartContainers")
+    sizes = dict(c.fetchall())
+    ids = [(track_id, ) for track_id in track_ids]
+    for id, column in [('RecentlyPlayed', 'lastplayed'), ('MostPlayed', 'playcount')]:
+        if not id in sizes:
+            continue
+        # playcount and lastplayed only go up, so the tracks played either
+        # move up in the container or join it (pushing others out)
+        c.executemany("""insert or replace into SmartContainerTracks
+                         select '%s', id, cast(%s as real) from tracks where id=? and duplicate = 0""" % (id, column), ids)
+        trim_smart_container(c, id, sizes[id])
+    if 'NeverPlayed' in sizes:
+        c.executemany("""delete from SmartContainerTracks where container='NeverPlayed' and track_id=?""", ids)
+        c.execute("""select count(*) from SmartContainerTracks where container='NeverPlayed'""")
+        missing = sizes['NeverPlayed'] - c.fetchone()[0]
+        if missing > 0:
+            c.execute("""insert into SmartContainerTracks select 'NeverPlayed', id, cast(ifnull(nullif(inserted, ''), 0) as real) from tracks
+                         where duplicate = 0 and ifnull(nullif(playcount, ''), 0) = 0
+                         and id not in (select track_id from SmartContainerTracks where container='NeverPlayed')
+                         order by cast(ifnull(nullif(inserted, ''), 0) as real) desc limit ?""", (missing, ))
+
+def get_smart_containers(c):
+    '''
+    Returns (id, title) of the smart containers the database has.
+    '''
+    try:
+        c.execute("select id from SmartContainers")
+    except sqlite3.Error:
+        # database was created before smart containers
+        return []
+    ids = set([row[0] for row in c.fetchall()])
+    return [(id, title) for id, title, column, condition in SMART_CONTAINERS if id in ids]
+
+def get_smart_container_tracks(c, id, start, count):
+    '''
+    Returns the ids of count tracks of smart container id from start, and
+    the number of tracks in it.
+    '''
+    try:
+        c.execute("select count(*) from SmartContainerTracks where container=?", (id, ))
+        total, = c.fetchone()
+        c.execute("""select track_id from SmartContainerTracks where container=?
+                     order by value desc, track_id limit ?, ?""", (id, start, count))
+        return [row[0] for row in c.fetchall()], total
+    except sqlite3.Error:
+        return [], 0
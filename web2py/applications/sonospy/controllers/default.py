@@ -4,7 +4,9 @@ import re
 from xml.sax.saxutils import escape, unescape
 import os
 import socket
-import time
+import gzip
+from cStringIO import StringIO
+from gluon.contrib import simplejson
 from struct import pack
 if os.name != 'nt':
     import fcntl
@@ -91,13 +93,53 @@ def get_message(datadict):
         message = messagestring.split('::')[1]
     return message
 
-def get_return(datadict):
-    # remove any return from the end of the controlpoint response and return it
-    ret = None
-    if datadict[len(datadict)-1].startswith('RETURN::'):
-        retstring = datadict.pop()
-        ret = retstring.split('::')[1]
-    return ret
+# ask for v2 data gzipped (not worth it when pycpoint is on this machine)
+v2_gzip = False
+
+def request_version(name):
+    # get the state version the client passed in request var name, 0 (all
+    # of the state) if it didn't pass one or it isn't a number
+    try:
+        return int(request.vars.get(name) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def get_v2_data(name, params):
+    # get the JSON data the controlpoint returns for name and params, with
+    # strings in utf-8
+    query = {}
+    for k, v in params.iteritems():
+        if isinstance(v, unicode):
+            v = v.encode('utf-8')
+        query[k] = v
+    if v2_gzip:
+        query['gzip'] = '1'
+    f = urllib.urlopen('http://' + ip_address + ':50101/data/v2/' + name + '?' + urllib.urlencode(query))
+    datastring = f.read()
+    if f.info().get('Content-Encoding') == 'gzip':
+        datastring = gzip.GzipFile(fileobj=StringIO(datastring)).read()
+    return make_utf8(simplejson.loads(datastring))
+
+def make_utf8(data):
+    # convert the unicode strings in decoded JSON data to utf-8
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    elif isinstance(data, dict):
+        return dict([(make_utf8(k), make_utf8(v)) for k, v in data.iteritems()])
+    elif isinstance(data, list):
+        return [make_utf8(v) for v in data]
+    return data
+
+def v2_entry(record):
+    # the delimited entry for a v2 data record, escaped as unwrap_data does
+    entry = '::'.join([record['ref'], record['class'], record['menu'], record['title'], record['id'], record['type']])
+    if 'search' in record:
+        entry += ':::' + record['search'] + '::' + record['searchtitle']
+    if 'operators' in record:
+        entry += '::' + ','.join(record['operators'])
+    if 'extras' in record:
+        entry += '::::' + '::'.join([k + '=' + record['extras'][k] for k in ('creator', 'album', 'art') if k in record['extras']])
+    return escape(entry, escape_entities_quotepos)
 
 def index():
     response.flash = T('Welcome to sonospy')
@@ -248,14 +290,14 @@ def setrenderer():
             dataout += "update_queueentry('" + text + "');"
             queueentry = text
 
-    # get the now playing data for this renderer
-    datastring=urllib.urlopen('http://' + ip_address + ':50101/data/rendererPoll?data='+pentry).read()
-    datadict = unwrap_data(datastring)
+    # get the now playing data for this renderer (version 0 gets all of it)
+    # and start waiting for it to change
+    data = get_v2_data('rendererWait', {'version': '0'})
 
-    print "rendererPoll: " + str(datadict)
+    print "rendererWait: " + str(data)
     print
 
-    pollout = formatrendererstatus(datadict)
+    pollout = formatrendererwait(data, '')
 
     # create queue browse script if appropriate
     queuescript = ''
@@ -300,22 +342,47 @@ def controlrenderer():
     
 def pollrenderer():
     # get the current play status of the current renderer
-    ptitle = escape(request.vars.renderertitle, url_escape_entities)
-    ptype = request.vars.renderertype
-    ptarget = request.vars.renderertarget
-    pentry = ptype + '::' + ptitle
-    datastring=urllib.urlopen('http://' + ip_address + ':50101/data/rendererPoll?data='+pentry).read()
-    datadict = unwrap_data(datastring)
-    out = formatrendererstatus(datadict)
+    # NOTE - the controlpoint only reports on the current renderer, so the
+    # renderer title and type aren't passed
+    pversion = request_version('rendererversion')
+    data = get_v2_data('rendererPoll', {'version': pversion})
+    out = formatrendererwait(data, '', False)
+    return out
+
+def waitrenderer():
+    # wait for the play status of the current renderer to change since the
+    # version passed
+    pversion = request_version('rendererversion')
+    qcall = request.vars.queuecall
+    data = get_v2_data('rendererWait', {'version': pversion})
+    out = formatrendererwait(data, qcall)
     return out
 
-def formatrendererstatus(datadict):
+def formatrendererwait(data, qcall, wait=True):
+    # format the renderer changes, recording the state version they bring
+    # the client up to, and schedule the next wait. Waits return the queue
+    # changes too, so bring the queue version up to date as well
+    version = str(data['version'])
+    out = "setrendererversion(" + version + ");"
+    if wait:
+        out += "setqueueversion(" + version + ");"
+    changes = data['changes']
+    if 'QUEUE' in changes:
+        # the queue has changed, need to update it
+        # qcall contains a pre-formatted ajax call for the queue
+        del changes['QUEUE']
+        if qcall and qcall != 'nothing':
+            out += qcall
+    out += formatrendererstatus(changes)
+    if wait:
+        out += "waitrenderer(" + str(data.get('retry', 0)) + ");"
+    return out
+
+def formatrendererstatus(changes):
     # format the renderer play status
     out = ''
-    for item in datadict:
-        entry = item.split('::')
-        id = entry[0]
-        if len(entry) == 1:
+    for id, text in changes.iteritems():
+        if text == None:
             # some entries can validly have blank text
             if id == 'TRACK' or id == 'ARTIST' or id == 'ALBUM' or id == 'STATION' or id == 'ONNOW' or id == 'INFO':
                 text = '-'
@@ -326,7 +393,7 @@ def formatrendererstatus(datadict):
                 # entry has no text, ignore entry
                 continue
         else:
-            text = entry[1]
+            text = escape(text, escape_entities_quotepos)
         if id == 'TRACK':
             out += "jQuery('#TITLE1').html('Track');"
             out += "jQuery('#LINE1').html('" + text + "');"
@@ -394,20 +461,17 @@ def pollqueue():
 #    print "queueentry: " + str(request.vars.queueentry)
 #    print "queuecall: " + str(request.vars.queuecall)
     # get the current update status of the current queue
-    qentry = escape(request.vars.queueentry, url_escape_entities)
+    # NOTE - the controlpoint only reports on the current queue, so the
+    # queue entry isn't passed
     qcall = request.vars.queuecall
-
-    datastring=urllib.urlopen('http://' + ip_address + ':50101/data/queuePoll?data='+qentry).read()
-    datadict = unwrap_data(datastring)
-    out = ''
-    for item in datadict:
-        entry = item.split('::')
-        id = entry[0]
-        text = entry[1]
-        if id == 'QUEUE':
-            # the queue has changed, need to update it
-            # qcall contains a pre-formatted ajax call for the queue
-            out += qcall
+    qversion = request_version('queueversion')
+
+    data = get_v2_data('queuePoll', {'version': qversion})
+    out = "setqueueversion(" + str(data['version']) + ");"
+    if 'QUEUE' in data['changes']:
+        # the queue has changed, need to update it
+        # qcall contains a pre-formatted ajax call for the queue
+        out += qcall
     return out
 
 def getrootdata():
@@ -575,45 +639,36 @@ def getdata():
     datastart = int(datas[1])
     datacount = int(datas[2])
 
-    # format request entry
-    pentry = pid + '::' + ptype + '::' + pmenu + '::' + ptitle
+    # format request params
+    params = {'ref': pid, 'class': ptype, 'menu': pmenu, 'title': request.vars.paramtitle, 'data': pdata}
     
-    # append server id and type if passed
+    # add server id and type if passed
     if s_vars == True:
-        pentry += '::' + ps_id + '::' + ps_type
+        params['id'] = ps_id
+        params['type'] = ps_type
 
-    pentry += '::' + pdata
-
-    # append search vars if present    
+    # add search vars if present    
     if psearch != "":
-        pentry += ':::' + psearch    
+        params['search'] = request.vars.searchstring
     if poperator != "":
-        pentry += '::' + poperator
-    print "entry: " + str(pentry)
-
-    gotdata = False
-    while gotdata == False:
-        # get data from the server
-        datastring=urllib.urlopen('http://' + ip_address + ':50101/data/getData?data='+pentry).read()
-        datadict = unwrap_data(datastring)
-        # check whether we have received any data
-        if datadict[0].startswith('NOTREADY'):
-            time.sleep(0.3)
-        else:
-            gotdata = True            
-
-    # remove any message
+        params['operator'] = poperator
+    print "params: " + str(params)
+
+    # get data from the server (it waits for the data to be ready)
+    data = get_v2_data('getData', params)
+    # check whether the browse failed or didn't return in time
+    if data['state'] == 'failed':
+        message = data['message'].replace('\\', '\\\\').replace('"', '\\"')
+        return 'setmessagebar("' + message + '");'
+    elif data['state'] == 'notready':
+        return 'setmessagebar("Timed out waiting for data");'
+    elif data['state'] == 'notfound':
+        return 'setmessagebar("Entry not found");'
+
+    # get the return totals
     messagescript = ''
-    message = get_message(datadict)
-    if message != None:
-        messagescript = 'setmessagebar("' + message + '");'
-
-    # remove any return totals (must be present)
-    messagescript = ''
-    ret = get_return(datadict)
-    rets = ret.split(':')
-    retcount = int(rets[0])
-    rettotal = int(rets[1])
+    retcount = data['returned']
+    rettotal = data['total']
     newtotal = datastart + retcount
 
     # special case - reset dataseq if it was called with zero
@@ -660,39 +715,25 @@ def getdata():
     prevseparate = False
     firstseparate = True
     
-    for item in datadict:
+    for record in data['items']:
 
-        extraentry = None
-        rementry = item
-        if '::::' in rementry:
-            # this entry contains extra details
-            entries = rementry.split('::::')
-            rementry = entries[0]
-            extraentry = entries[1].split('::')
-        if ':::' in rementry:
+        extraentry = record.get('extras')
+        if 'search' in record:
             # this entry contains search criteria
-            entries = rementry.split(':::')
-            rementry = entries[0]
-            searchentry = entries[1].split('::')
-            searchtype = searchentry[0]
-            if len(searchentry) >= 2:
-                searchcriteria = searchentry[1]
-            else:
-                searchcriteria = None
-            if len(searchentry) == 3:
-                searchoperators = searchentry[2]
+            searchtype = escape(record['search'], escape_entities_quotepos)
+            searchcriteria = escape(record['searchtitle'], escape_entities_quotepos)
+            if 'operators' in record:
+                searchoperators = escape(','.join(record['operators']), escape_entities_quotepos)
             else:
                 searchoperators = None
-        # must be a base entry
-        entry = rementry.split('::')
         
-        id = entry[0]
-        type = entry[1]
-        menu = entry[2]
-        text = entry[3]
+        id = record['ref']
+        type = record['class']
+        menu = record['menu']
+        text = escape(record['title'], escape_entities_quotepos)
         
-#        s_id = entry[4]
-#        s_type = entry[5]
+#        s_id = record['id']
+#        s_type = record['type']
         
         target = 'target' + str(id)
         atarget = '"atarget' + id + '"'
@@ -802,17 +843,16 @@ def getdata():
         extraalbum = ''
         extraart = ''
         if extraentry != None:
-            for ex in extraentry:
-                if ex.startswith('creator='):
-                    extracreator = ex[8:]
-                    extras += '<span class="extra"> [' + extracreator + ']</span>'
-                elif ex.startswith('album='):
-                    extraalbum = ex[6:]
-                    extras += '<span class="extra"> [' + extraalbum + ']</span>'
-                elif ex.startswith('art='):
-                    extraart = ex[4:]
+            if 'creator' in extraentry:
+                extracreator = escape(extraentry['creator'], escape_entities_quotepos)
+                extras += '<span class="extra"> [' + extracreator + ']</span>'
+            if 'album' in extraentry:
+                extraalbum = escape(extraentry['album'], escape_entities_quotepos)
+                extras += '<span class="extra"> [' + extraalbum + ']</span>'
+            if 'art' in extraentry:
+                extraart = escape(extraentry['art'], escape_entities_quotepos)
             if type == 'C':     # this works at the moment because the only container with extras is album
-                insertalbum(id, text, extracreator, extraart, item)
+                insertalbum(id, text, extracreator, extraart, v2_entry(record))
                 
         out += '<li tree="closed"' + play + search + '><span type="' + type + '"><a id=' + atarget + ' menu="' + menu + '" type="' + type + '">' + icon + text + extras + '</a></span><span id="s' + target + '"></span><span id="' + target + '"></span>' + multipletargets + '</li>'
 